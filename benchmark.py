@@ -0,0 +1,403 @@
+# BENCHMARKS
+import io
+import os
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from os import path
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from crawler.crawler import ChromeDriver, SUMMARY_SECTIONS, STATISTICS_SECTIONS
+from crawler.parser import parsers, get_parser
+from crawler.preprocessor import (transpose, sort_date_and_remove_nat, rename_columns,
+                                  convert_dtypes, quarterly2yearly, annualize, to_panel,
+                                  fiscal_year_ends, process_text, convert_symbol,
+                                  build_yearly, init_process)
+from crawler.ratelimit import RateController
+from crawler.replay import FixtureStore, ReplayFetcher
+from utils import tools, CRAWLERDIR, FIXTUREDIR
+from utils.history import HistoryStore
+
+PAGESDIR = path.join("crawler", "fixtures", "pages")
+
+
+def timeit(fn, repeat):
+    """Return the best of repeat timings of fn() in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn):
+    """Return the peak bytes allocated while running fn()."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@contextmanager
+def workdir():
+    """Run in a temporary directory with its own data and crawler dirs."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        os.makedirs(CRAWLERDIR)
+        try:
+            yield tmpdir
+        finally:
+            os.chdir(cwd)
+
+
+def bench_parser(args):
+    """Time each html parser on the Summary and Statistics fixture pages.
+
+        Every parser must return the same data as bs4 (the reference)."""
+    with open(path.join(PAGESDIR, "quote", "AAPL.html")) as r_obj:
+        summary = r_obj.read()
+    with open(path.join(PAGESDIR, "quote", "AAPL", "key-statistics.html")) as r_obj:
+        statistics = r_obj.read()
+    sections = SUMMARY_SECTIONS | STATISTICS_SECTIONS
+    cases = {"summary" : lambda p, data: p.parse_summary(summary, data),
+             "statistics" : lambda p, data: p.parse_statistics(statistics, data,
+                                                               sections)}
+
+    results, expected = {}, {}
+    for name in parsers:
+        try:
+            parser = get_parser(name)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        for case, parse in cases.items():
+            data = {}
+            parse(parser, data)
+            expected.setdefault(case, data)
+            assert data == expected[case], f"{name} parses {case} differently from bs4"
+            seconds = timeit(lambda: parse(parser, {}), args.repeat)
+            results[f"parser/{name}/{case}"] = {"ms" : 1000 * seconds,
+                                                "pages_per_s" : 1 / seconds}
+    return results
+
+
+def bench_crawl(args):
+    """Crawl recorded Summary and Statistics pages to summary.csv, offline.
+
+        Runs crawl_summary over the symbols in FIXTUREDIR repeat times per
+        parser in a temporary data directory, without pacing."""
+    store = FixtureStore(path.abspath(FIXTUREDIR))
+    symbols = sorted(set(store.symbols("summary")) & set(store.symbols("statistics")))
+    n = len(symbols) * args.repeat
+    results = {}
+    with workdir():
+        for name in parsers:
+            try:
+                parser = get_parser(name)
+            except Exception as e:
+                print(f"Skipping {name}: {e}")
+                continue
+            driver = ChromeDriver(False, True, fetcher=ReplayFetcher(store),
+                                  parser=parser)
+            driver.rate = RateController(rate=float("inf"), max_rate=float("inf"))
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                driver.crawl_summary(symbols)
+            seconds = time.perf_counter() - start
+            assert not driver.results, f"failed to crawl {dict(driver.results)}"
+            for symbol in symbols:
+                assert tools.get_df("summary", symbol, debug=True) is not None
+            results[f"crawl/{name}/summary"] = {"symbols" : n,
+                                                "seconds" : seconds,
+                                                "symbols_per_s" : n / seconds}
+    return results
+
+
+# synthetic data shaped like Yahoo Finance downloads
+def synth_quarters(n_quarters, last=(2020, 12)):
+    """Return n_quarters quarter-end dates as 'M/D/YYYY', most recent first."""
+    year, month = last
+    dates = []
+    for _ in range(n_quarters):
+        day = pd.Timestamp(year, month, 1).days_in_month
+        dates.append(f"{month}/{day}/{year}")
+        year, month = (year, month - 3) if month > 3 else (year - 1, month + 9)
+    return dates
+
+
+def synth_number(rng, suffixed):
+    """Return a number as Yahoo writes it, e.g. '1,234,567' or '1.2B'."""
+    x = rng.lognormal(16, 3) * (-1 if rng.random() < 0.1 else 1)
+    if suffixed:
+        for suffix, zeros in [("T", 12), ("B", 9), ("M", 6), ("k", 3)]:
+            if abs(x) >= 10**zeros:
+                return f"{x / 10**zeros:.2f}{suffix}"
+    return f"{x:,.0f}" if abs(x) >= 1 else f"{x:.2f}"
+
+
+def synth_cell(rng, suffixed=False):
+    """Return a cell that is missing, a percentage or a number."""
+    if (p := rng.random()) < 0.05:
+        return ""
+    if p < 0.15:
+        return f"{rng.normal(10, 20):.2f}%"
+    return synth_number(rng, suffixed)
+
+
+def synth_statement(rng, filename, n_quarters):
+    """Return a quarterly statement as downloaded: names in rows, 'ttm' and dates in columns."""
+    names = [col for col, fname in tools.col2filename.items()
+             if fname == filename and col != filename]
+    columns = ["ttm"] + synth_quarters(n_quarters)
+    data = [[synth_number(rng, False) if rng.random() > 0.05 else ""
+             for _ in columns] for _ in names]
+    # nested rows are indented with tabs
+    index = [("\t" if i % 3 else "") + name for i, name in enumerate(names)]
+    return pd.DataFrame(data, index=pd.Index(index, name="name"), columns=columns)
+
+
+def synth_tmp(rng):
+    """Return the Statistics row saved by crawl_statistics (tmp.csv)."""
+    names = [col for col, fname in tools.col2filename.items()
+             if fname == "statistics" and col[0] != col[0].lower()
+             and not col.endswith("Ratio") and col != "Fiscal Year Ends"]
+    data = {name + (" (ttm)" if i % 4 == 0 else ""): synth_cell(rng, True)
+            for i, name in enumerate(names)}
+    data["Fiscal Year Ends"] = "Sep 26, 2020"
+    return pd.DataFrame([data], index=pd.Index([tools.get_today()], name="Date"))
+
+
+def synth_valuation(rng, n_quarters):
+    """Return quarterly valuation measures (statistics.csv) as downloaded."""
+    names = ["MarketCap", "EnterpriseValue"] + [
+        col for col, fname in tools.col2filename.items()
+        if fname == "statistics" and col.endswith("Ratio")]
+    columns = ["ttm"] + synth_quarters(n_quarters)
+    data = [[synth_cell(rng, True) for _ in columns] for _ in names]
+    return pd.DataFrame(data, index=pd.Index(names, name="name"), columns=columns)
+
+
+def synth_summary(rng, n_days):
+    """Return n_days of summary rows with suffixed numbers and percentages."""
+    columns = [col for col, fname in tools.col2filename.items()
+               if fname == "summary" and tools.col2dtype.get(col) is None]
+    dates = pd.bdate_range(end="2020-12-31", periods=n_days)[::-1]
+    data = [[synth_cell(rng, True) for _ in columns] for _ in dates]
+    return pd.DataFrame(data, index=pd.Index(dates.date, name="Date"), columns=columns)
+
+
+def synth_history(rng, n_days):
+    """Return n_days of daily prices as saved in symbol_history.csv, latest first."""
+    dates = pd.bdate_range(end="2020-12-31", periods=n_days)[::-1]
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n_days)))
+    return pd.DataFrame(
+        {"Open" : close * rng.uniform(0.98, 1.02, n_days),
+         "High" : close * 1.03, "Low" : close * 0.97, "Close" : close,
+         "Adj Close" : close * 0.99, "Volume" : rng.integers(10**5, 10**8, n_days)},
+        index=pd.Index(dates.strftime("%Y-%m-%d"), name="Date")).round(4)
+
+
+def generate(n_symbols, n_quarters, seed=0):
+    """Write synthetic crawled files of n_symbols symbols under COMPANYDIR."""
+    rng = np.random.default_rng(seed)
+    symbols = [f"S{i:04d}" for i in range(n_symbols)]
+    for symbol in symbols:
+        for filename in ["income_statement", "balance_sheet", "cash_flow"]:
+            tools.to_csv(synth_statement(rng, filename, n_quarters),
+                         tools.get_path(filename, symbol))
+        tools.to_csv(synth_valuation(rng, n_quarters), tools.get_path("statistics", symbol))
+        tools.to_csv(synth_tmp(rng), tools.get_path("tmp", symbol))
+        tools.to_csv(synth_summary(rng, n_quarters), tools.get_path("summary", symbol))
+    return symbols
+
+
+def bench_preprocess(args):
+    """Time each preprocessing stage on synthetic symbols.
+
+        In-memory stages (transpose, rename_columns, convert_dtypes,
+        quarterly2yearly per symbol, annualize over one panel per statement)
+        run over the statements of every symbol and keep the best of rounds
+        timings; process_text, convert_symbol and build_yearly run once over
+        the files, regenerated for the memory pass. Each stage reports
+        seconds, symbols and cells per second, and peak traced memory.
+        init_process is timed on fresh files and on a rerun, which skips
+        every file as unchanged."""
+    results = {}
+    def record(stage, seconds, peak, n_cells):
+        results[f"preprocess/{stage}"] = {
+            "seconds" : seconds,
+            "symbols_per_s" : args.symbols / seconds,
+            "cells_per_s" : n_cells / seconds,
+            "peak_mb" : peak / 2**20}
+
+    with workdir(), redirect_stdout(io.StringIO()):
+        symbols = generate(args.symbols, args.quarters)
+        raws = [tools.get_df(filename, symbol, convert_index_to_datetime=False)
+                for symbol in symbols
+                for filename in ["income_statement", "balance_sheet", "cash_flow"]]
+        n_cells = sum(df.size for df in raws)
+
+        transposed = [sort_date_and_remove_nat(transpose(df)) for df in raws]
+        converted = [df.copy() for df in transposed]
+        for df in converted:
+            df.columns = rename_columns(df.columns)
+            convert_dtypes(df)
+        panels = [to_panel(dict(zip(symbols, converted[i::3]))) for i in range(3)]
+        months = fiscal_year_ends(symbols)
+        stages = {
+            "transpose" : lambda: [transpose(df) for df in raws],
+            "rename_columns" : lambda: [rename_columns(df.columns) for df in transposed],
+            "convert_dtypes" : lambda: [convert_dtypes(df.copy()) for df in transposed],
+            "quarterly2yearly" : lambda: [quarterly2yearly(df, symbol)
+                                          for df, symbol in zip(converted,
+                                                                np.repeat(symbols, 3))],
+            "annualize" : lambda: [annualize(panel, months) for panel in panels]}
+        for stage, fn in stages.items():
+            record(stage, timeit(fn, args.rounds), peak_memory(fn), n_cells)
+
+        files = {
+            "process_text" : lambda: process_text(symbols, True, False),
+            "convert_symbol" : lambda: [convert_symbol(symbol, True, False)
+                                        for symbol in symbols],
+            "build_yearly" : lambda: build_yearly(symbols, False)}
+        seconds = {}
+        for stage, fn in files.items():
+            start = time.perf_counter()
+            fn()
+            seconds[stage] = time.perf_counter() - start
+        tools.cache.clear()
+        generate(args.symbols, args.quarters)
+        for stage, fn in files.items():
+            record(stage, seconds[stage], peak_memory(fn), n_cells)
+
+        # the whole preprocessing, then again without anything crawled since
+        tools.cache.clear()
+        generate(args.symbols, args.quarters)
+        for stage in ["init_process", "init_process_rerun"]:
+            start = time.perf_counter()
+            init_process(symbols, False, False)
+            results[f"preprocess/{stage}"] = {"seconds" : time.perf_counter() - start}
+    return results
+
+
+def bench_history(args):
+    """Time loading long price histories and querying them by date.
+
+        "csv" parses every symbol_history.csv into a DataFrame as analyses
+        do now and looks dates up in its index; "memmap" opens the arrays of
+        HistoryStore (built beforehand) and looks dates up by binary search.
+        Each reports seconds to load and to run the queries, and peak
+        traced memory of loading. The date indexes of the files are also
+        parsed per element with tools.to_date and at once with
+        tools.to_dates."""
+    rng = np.random.default_rng(0)
+    results = {}
+    with workdir(), redirect_stdout(io.StringIO()):
+        symbols = [f"S{i:04d}" for i in range(args.symbols)]
+        for symbol in symbols:
+            tools.to_csv(synth_history(rng, args.days), tools.get_path("history", symbol))
+        store = HistoryStore()
+        store.load(symbols)
+        dates = pd.bdate_range(end="2020-12-31", periods=args.days)
+        queries = [(symbols[i % len(symbols)], dates[j], dates[min(j + 250, len(dates) - 1)])
+                   for i, j in enumerate(rng.integers(0, len(dates), 1000))]
+
+        def load_csv():
+            dfs = {}
+            for symbol in symbols:
+                df = tools.store.read(tools.get_path("history", symbol))
+                df.index = pd.to_datetime(df.index)
+                dfs[symbol] = df.sort_index()
+            return dfs
+
+        def query_csv(dfs):
+            for symbol, start, end in queries:
+                dfs[symbol].loc[start]
+                dfs[symbol].loc[start:end]
+
+        def query_memmap(histories):
+            for symbol, start, end in queries:
+                histories[symbol].at(start)
+                histories[symbol].between(start, end)
+
+        for name, load, query in [("csv", load_csv, query_csv),
+                                  ("memmap", lambda: store.load(symbols), query_memmap)]:
+            loaded = load()
+            results[f"history/{name}"] = {
+                "load_seconds" : timeit(load, args.rounds),
+                "query_ms" : timeit(lambda: query(loaded), args.rounds)
+                             / len(queries) * 1000,
+                "peak_mb" : peak_memory(load) / 2**20}
+
+        indexes = [tools.store.read(tools.get_path("history", symbol)).index
+                   for symbol in symbols]
+        n_dates = sum(len(index) for index in indexes)
+        for name, fn in [("dates_map", lambda: [index.map(tools.to_date)
+                                                for index in indexes]),
+                         ("dates_vectorized", lambda: [tools.to_dates(index).date
+                                                       for index in indexes])]:
+            seconds = timeit(fn, args.rounds)
+            results[f"history/{name}"] = {"seconds" : seconds,
+                                          "dates_per_s" : n_dates / seconds}
+    return results
+
+
+suites = {"parser" : bench_parser, "crawl" : bench_crawl, "preprocess" : bench_preprocess,
+          "history" : bench_history}
+
+
+def compare(results, inpath):
+    """Print the change of each timing against results saved in inpath."""
+    with open(inpath, "r") as r_obj:
+        before = json.load(r_obj)
+    for name, result in results.items():
+        if name not in before:
+            continue
+        for k, v in result.items():
+            if k.endswith(("seconds", "_per_s", "ms")) and before[name].get(k):
+                print(f"{name} {k}: {before[name][k]:.3f} -> {v:.3f} "
+                      f"({v / before[name][k]:.2f}x)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suites", nargs="*", default=list(suites),
+                        help=f"Benchmarks to run from {list(suites)}")
+    parser.add_argument("--repeat", action="store", type=int, default=20,
+                        dest="repeat", help="Number of repetitions per benchmark")
+    parser.add_argument("--rounds", action="store", type=int, default=3,
+                        dest="rounds", help="Number of timings per preprocessing stage")
+    parser.add_argument("--symbols", action="store", type=int, default=20,
+                        dest="symbols", help="Number of synthetic symbols to preprocess")
+    parser.add_argument("--quarters", action="store", type=int, default=20,
+                        dest="quarters", help="Number of quarters per synthetic symbol")
+    parser.add_argument("--days", action="store", type=int, default=5000,
+                        dest="days", help="Number of days per synthetic price history")
+    parser.add_argument("--output", action="store", default=None, dest="output",
+                        help="Save results to a .json file")
+    parser.add_argument("--compare", action="store", default=None, dest="compare",
+                        help="Compare with results saved by a previous --output")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {}
+    for suite in args.suites:
+        results.update(suites[suite](args))
+    for name, result in results.items():
+        print(name, " ".join(f"{k}={v:.3f}" for k, v in result.items()))
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w") as w_obj:
+            json.dump(results, w_obj, indent=4)
@@ -0,0 +1,113 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from utils import tools
+from utils.metrics import metrics
+from crawler.fetcher import FetchError, HTTPFetcher
+from crawler.ratelimit import RateController
+from crawler.crawler import (summaryurl, statisticsurl, has_table, has_statistics,
+                             SUMMARY_SECTIONS)
+
+
+class AsyncCrawler:
+    """Crawl Summary and Statistics pages of many symbols concurrently.
+
+        At most concurrency requests are in flight, paced per host by a
+        RateController of its own, so that pages of all types on one host
+        share its rate. rate (requests per second) is where each host starts
+        and the most it is allowed to reach. Requests go through the HTTP
+        fetcher of driver, whose connection pool is sized to concurrency.
+        Fetching, parsing (driver.parse_summary/parse_statistics), storing
+        rows with driver.save and results with driver.report run in a
+        thread pool, as in ChromeDriver.crawl_summary, so that neither
+        blocking I/O nor parsing stalls the event loop."""
+    def __init__(self, driver, concurrency=32, rate=None):
+        self.driver = driver
+        self.fetcher = driver.fetcher or HTTPFetcher()
+        if hasattr(self.fetcher, "resize"): # recorded pages need no connections
+            self.fetcher.resize(concurrency)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.limiters = {} # host -> RateController
+
+    def limiter(self, host):
+        """Return the RateController of host, capped at self.rate if given."""
+        if host not in self.limiters:
+            self.limiters[host] = (RateController() if self.rate is None else
+                                   RateController(self.rate,
+                                                  min_rate=min(0.05, self.rate),
+                                                  max_rate=self.rate))
+        return self.limiters[host]
+
+    async def fetch(self, url, endpoint, ready):
+        """Return the page source of url, or None if it could not be fetched."""
+        limiter = self.limiter(host := urlsplit(url).netloc)
+        async with self.semaphore:
+            await limiter.async_wait(host)
+            start = time.monotonic()
+            try:
+                html = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.fetcher.get, url)
+            except FetchError:
+                limiter.failure(host)
+                self.driver.failed(endpoint, "fetcher")
+                return
+            limiter.success(host, seconds := time.monotonic() - start)
+            self.driver.loaded(endpoint, "fetcher", seconds)
+        return html if ready(html) else None
+
+    async def crawl_symbol(self, symbol):
+        start = time.perf_counter()
+        data = {"Date" : tools.get_today(), "Symbol" : symbol}
+        # [Summary, Statistics]
+        result = [False, False]
+        loop = asyncio.get_running_loop()
+        for _ in range(self.driver.max_trial):
+            summary, statistics = await asyncio.gather(
+                self.fetch(summaryurl(symbol), "summary", has_table)
+                if not result[0] else asyncio.sleep(0),
+                self.fetch(statisticsurl(symbol), "statistics", has_statistics)
+                if not result[1] else asyncio.sleep(0))
+            if summary:
+                await loop.run_in_executor(self.executor, self.driver.parse_summary,
+                                           summary, data)
+                result[0] = True
+            if statistics:
+                await loop.run_in_executor(self.executor, self.driver.parse_statistics,
+                                           statistics, data, SUMMARY_SECTIONS)
+                result[1] = True
+            if self.driver.finished(result):
+                break
+
+        name = "summary"
+        if self.driver.finished(result):
+            await loop.run_in_executor(self.executor, self.driver.save, name, symbol, data)
+        # concurrent symbols share driver.reason, so name the pages that failed
+        reason = ", ".join(f"{page} not fetched"
+                           for page, ok in zip(("summary", "statistics"), result) if not ok)
+        await loop.run_in_executor(self.executor, self.driver.report, symbol, name, result,
+                                   start, reason)
+        seconds = time.perf_counter() - start
+        status = "ok" if self.driver.finished(result) else "failed"
+        metrics.observe("crawler_symbol_seconds", seconds, section=name)
+        metrics.inc("crawler_symbols_total", section=name, status=status)
+        tools.log(f"[{symbol}] Crawled {name} ({status})", self.driver.debug,
+                  verbose=False, symbol=symbol, stage=name,
+                  duration=round(seconds, 3))
+
+    async def crawl(self, symbols):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(self.concurrency) as self.executor:
+            errors = await asyncio.gather(
+                *(self.crawl_symbol(symbol) for symbol in symbols),
+                return_exceptions=True)
+        for symbol, error in zip(symbols, errors):
+            if isinstance(error, Exception):
+                tools.log(f"[{symbol}] Failure crawling summary: {error}",
+                          self.driver.debug, symbol=symbol, stage="summary")
+
+    def crawl_summary(self, symbols):
+        """Crawl data to get saved in symbol_summary.csv."""
+        asyncio.run(self.crawl(symbols))
@@ -1,16 +1,22 @@
+import os
 import time
+import shutil
+import itertools
 from os import path
 from collections import defaultdict
 
 import pandas as pd
-from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
 
-from utils import tools, COMPANYDIR
+from utils import tools
+from utils.metrics import metrics
+from crawler.fetcher import FetchError, get_fetcher
+from crawler.parser import get_parser
+from crawler.ratelimit import RateController
 from crawler.preprocessor import process_summary
 from localpaths import DOWNLOADPATH, DRIVERPATH, ID, PASSWORD
 
@@ -33,11 +39,31 @@ def historyurl(t):
     return f"https://finance.yahoo.com/quote/{t}/history?p={t}"
 
 
+# sections of Statistics saved in summary.csv and in statistics.csv
+SUMMARY_SECTIONS = {"Stock Price History", "Share Statistics"}
+STATISTICS_SECTIONS = {"Fiscal Year", "Profitability", "Management Effectiveness",
+                       "Income Statement", "Balance Sheet",
+                       "Cash Flow Statement", "Dividends & Splits"}
+
+# checks that a page fetched without Chrome has the content we parse
+def has_table(html):
+    return "<table" in html
+def has_statistics(html):
+    return 'data-test="qsp-statistics"' in html
+
+# numbers sessions of a process that download to their own directory
+session_ids = itertools.count()
+
+
 class ChromeDriver:
-    def __init__(self, init, debug, headless=True):
+    def __init__(self, init, debug, headless=True, fetcher=None, parser=None,
+                 result_store=None, isolate_downloads=False):
         self.init = init
         self.debug = debug
-        self.results = defaultdict(dict)
+        self.headless = headless and not self.init
+        self.results = defaultdict(dict) # failed sections of this session
+        self.result_store = result_store # results shared by all crawl processes
+        self.reason = None # why the last page failed
         if self.init or self.debug:
             self.currency_of_last_symbol = None
             self.last_symbol_is_stock = None
@@ -45,8 +71,35 @@ class ChromeDriver:
             self.currencys = []
         self.timeout = 5 # how many seconds to wait
         self.max_trial = 3 # how many times to try
-
-        self.init_driver(headless and not self.init)
+        self.compact_every = 20 # how many appended rows before compacting
+        self.rate = RateController() # pacing of page loads per endpoint
+        self.pages = 0 # pages loaded in the current Chrome session
+        self.parser = get_parser(parser) # html parser of Summary and Statistics
+        # sessions crawling in parallel download the same file names, so each
+        # gets a directory of its own under DOWNLOADPATH, removed on quit
+        self.isolate_downloads = isolate_downloads
+        self.download_dir = (path.join(DOWNLOADPATH,
+                                       f"session-{os.getpid()}-{next(session_ids)}")
+                             if isolate_downloads else DOWNLOADPATH)
+
+        # fetcher for static pages, Chrome is only started when needed
+        self.fetcher = get_fetcher(fetcher)
+        self._driver = None
+        if self.fetcher is None:
+            self.start()
+
+
+    @property
+    def driver(self):
+        """Selenium driver, started (and signed in if init) on first use."""
+        if self._driver is None:
+            self.start()
+        return self._driver
+
+
+    def start(self):
+        """Start ChromeDriver and sign in if init."""
+        self.init_driver(self.headless)
         if self.init:
             self.signin()
 
@@ -74,8 +127,13 @@ class ChromeDriver:
                  "profile.managed_default_content_settings.media_stream" : 2}
         if not self.init: # cookie must be enabled to sign in
             prefs["profile.managed_default_content_settings.cookies"] = 2
+        if self.isolate_downloads:
+            os.makedirs(self.download_dir, exist_ok=True)
+            prefs["download.default_directory"] = path.abspath(self.download_dir)
+            prefs["download.prompt_for_download"] = False
         options.add_experimental_option("prefs", prefs)
-        self.driver = webdriver.Chrome(DRIVERPATH, options=options)
+        self._driver = webdriver.Chrome(DRIVERPATH, options=options)
+        self.pages = 0
 
 
     def signin(self):
@@ -116,70 +174,165 @@ class ChromeDriver:
 
     def reboot(self):
         """Reboot driver."""
-        self.driver.quit()
-        self.sleep(600) # rest for 10 minutes
-        self.init_driver()
+        self.quit()
+        self.reason = "browser rebooted"
+        metrics.inc("crawler_reboots_total")
+        self.rate.failure("browser")
+        # rest longer after each consecutive failure
+        self.sleep(self.rate.backoff(), reason="backoff")
+        self.init_driver(self.headless)
         self.signin()
 
 
     def close(self):
         """Close driver."""
-        self.driver.close()
+        if self._driver is not None:
+            self._driver.close()
 
 
     def quit(self):
         """Quit driver."""
-        self.driver.quit()
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
+        if self.fetcher is not None:
+            self.fetcher.close()
+        if self.isolate_downloads:
+            shutil.rmtree(self.download_dir, ignore_errors=True)
 
 
-    def sleep(self, t=6):
+    def sleep(self, t=6, reason="wait"):
         """Sleep crawler."""
-        return time.sleep(t)
+        with metrics.timer("crawler_sleep_seconds", reason=reason):
+            return time.sleep(t)
+
+
+    def pace(self, endpoint):
+        """Wait until self.rate allows another request to endpoint."""
+        with metrics.timer("crawler_sleep_seconds", reason="pace"):
+            self.rate.wait(endpoint)
+
+
+    def loaded(self, endpoint, source, seconds):
+        """Count a page of endpoint loaded from source in seconds."""
+        self.rate.success(endpoint, seconds)
+        metrics.observe("crawler_page_load_seconds", seconds,
+                        endpoint=endpoint, source=source)
+
+
+    def failed(self, endpoint, source):
+        """Count a page of endpoint that failed to load from source."""
+        self.reason = f"{endpoint} failed to load from {source}"
+        self.rate.failure(endpoint)
+        metrics.inc("crawler_page_failures_total", endpoint=endpoint, source=source)
+
+
+    def get(self, url, endpoint):
+        """Load url in Chrome once self.rate allows another request to endpoint."""
+        self.pace(endpoint)
+        start = time.monotonic()
+        self.driver.get(url)
+        self.pages += 1
+        self.loaded(endpoint, "chrome", time.monotonic() - start)
+        self.record(url)
+
+
+    def report(self, symbol, section, result, start, reason=None):
+        """Record result of crawling section of symbol since start (perf_counter).
+
+            Failures are kept in self.results; every result also goes to
+            self.result_store, if any, with reason (self.reason by default)."""
+        if not self.finished(result):
+            self.results[symbol][section] = result
+        if self.result_store is not None:
+            self.result_store.add(symbol, section, result, time.perf_counter() - start,
+                                  reason or self.reason)
+
+
+    def record(self, url, html=None):
+        """Hand the page loaded in Chrome to a recording fetcher, if any."""
+        if (record := getattr(self.fetcher, "record", None)) is not None:
+            record(url, html if html is not None else self.driver.page_source)
+
+
+    def page_source(self, url, endpoint, condition, ready):
+        """Return the page source of url.
+
+            The page is fetched with self.fetcher if given and ready(html)
+            says the content is there; otherwise it is loaded in Chrome and
+            waited on with condition. Requests are paced by self.rate, which
+            is told how long the page took or that it failed. An offline
+            fetcher (replaying recorded pages) never falls back to Chrome."""
+        self.pace(endpoint)
+        if self.fetcher is not None:
+            start = time.monotonic()
+            try:
+                if ready(html := self.fetcher.get(url)):
+                    self.loaded(endpoint, "fetcher", time.monotonic() - start)
+                    return html
+                metrics.inc("crawler_page_incomplete_total", endpoint=endpoint)
+            except FetchError:
+                self.failed(endpoint, "fetcher")
+            if self.fetcher.offline:
+                raise TimeoutException(f"{url} is not available offline")
+        start = time.monotonic()
+        try:
+            self.driver.get(url)
+            self.pages += 1
+            with metrics.timer("crawler_wait_seconds", endpoint=endpoint):
+                WebDriverWait(self.driver, self.timeout).until(condition)
+        except TimeoutException:
+            self.failed(endpoint, "chrome")
+            raise
+        self.loaded(endpoint, "chrome", time.monotonic() - start)
+        self.record(url, html := self.driver.page_source)
+        return html
 
 
     def parse(self, tr):
-        """Parse row element from table into column and value."""
-        # choose any char not commonly used
-        splitted = tr.get_text("|").split("|")
-        val = (splitted[-1] if (col := splitted[0]) != "Earnings Date"
-               else "".join(splitted[1:]))
-        return col, val # column, value
-
-
-    def save(self, col, symbol, data, sep=",", index_col=0, backup=True):
-        """Save data."""
-        if not path.exists(dir_ := path.join(COMPANYDIR, symbol)):
-            tools.mkdir(dir_)
-        inpath = tools.get_path(col, symbol)
-
-        if self.debug:
-            if not path.exists(debugdir := path.join(dir_, "debug")):
-                tools.mkdir(debugdir)
-            inpath = tools.get_path(col, symbol, debug=self.debug)
-
-        #  backup
-        if not self.debug and backup and path.exists(inpath):
-            if not path.exists(backdir := path.join(dir_, "backup")):
-                tools.mkdir(backdir)
-            tools.cp(inpath, tools.get_path(col, symbol, backup=True))
+        """Parse row element (of self.parser's tree) into column and value."""
+        return self.parser.parse(tr)
+
+
+    def parse_summary(self, html_content, data):
+        """Parse the first two tables of Summary section into data."""
+        with metrics.timer("crawler_parse_seconds", page="summary"):
+            self.parser.parse_summary(html_content, data)
+
+
+    def parse_statistics(self, html_content, data, sections):
+        """Parse tables under the given section headers of Statistics into data."""
+        with metrics.timer("crawler_parse_seconds", page="statistics"):
+            self.parser.parse_statistics(html_content, data, sections)
+
+
+    def save(self, col, symbol, data, backup=True):
+        """Save data.
+
+            Rows are appended to the store's journal instead of rewriting the
+            whole file, and the journal is compacted into the file every
+            self.compact_every rows. The previous version is snapshotted as
+            backup on each save (hard links, so it costs no copy of the file)."""
+        start = time.perf_counter()
+        inpath = tools.get_path(col, symbol, debug=self.debug)
 
         # convert data to df
         if not isinstance(data, list):
             data = [data]
         curdf = pd.DataFrame(data)
-        curdf["Date"] = curdf["Date"].apply(tools.to_date)
+        curdf["Date"] = tools.to_dates(curdf["Date"]).date
         curdf.set_index("Date", inplace=True)
         process_summary(curdf)
 
-        if path.exists(inpath):
-            # concatenate with existing file, remove any duplicate row
-            maindf = tools.path2df(inpath, sep=sep, index_col=index_col)
-            maindf = maindf[maindf.index != tools.get_today()]
-            curdf = pd.concat([curdf, maindf], axis=0)
+        if not self.debug and backup and tools.store.exists(inpath):
+            tools.store.backup(inpath, tools.get_path(col, symbol, backup=True))
 
-        # sort and save
-        curdf.sort_index(ascending=False, inplace=True)
-        curdf.to_csv(inpath, index=True)
+        # append, a row with the same date replaces the existing one on read
+        tools.store.append(curdf, inpath)
+        if tools.store.pending(inpath) >= self.compact_every:
+            with metrics.timer("crawler_compact_seconds", file=col):
+                tools.store.compact(inpath)
+        metrics.observe("crawler_save_seconds", time.perf_counter() - start, file=col)
 
 
     def is_stock(self):
@@ -220,7 +373,7 @@ class ChromeDriver:
 
     def exist(self, symbol):
         """Return True if symbol exists, else False."""
-        self.driver.get(summaryurl(symbol)) # check Summary section
+        self.get(summaryurl(symbol), "summary") # check Summary section
         try:
             WebDriverWait(self.driver, self.timeout).until(
                 EC.visibility_of_element_located((
@@ -232,30 +385,31 @@ class ChromeDriver:
             return True
 
         else:
-            self.sleep()
             return False
 
 
     def mv_downloaded(self, symbol, from_, to_):
         """Move downloaded file from from_ to to_."""
-        tools.mv(path.join(DOWNLOADPATH, from_),
+        tools.mv(path.join(self.download_dir, from_),
                  tools.get_path(to_, symbol, debug=self.debug))
 
 
     def crawl_summary(self, symbols):
         """Crawl data to get saved in symbol_summary.csv."""
         for symbol in symbols:
+            start = time.perf_counter()
+            self.reason = None
             data = {"Date" : tools.get_today(), "Symbol" : symbol}
             # [Summary, Statistics]
             result = [False, False]
             for _ in range(self.max_trial):
                 if not result[0]: # crawl summary section
                     try:
-                        self.driver.get(summaryurl(symbol))
-
-                        WebDriverWait(self.driver, self.timeout).until(
+                        html_content = self.page_source(
+                            summaryurl(symbol), "summary",
                             EC.visibility_of_all_elements_located((By.TAG_NAME,
-                                                                   "table")))
+                                                                   "table")),
+                            has_table)
 
                     except TimeoutException:
                         pass
@@ -264,22 +418,16 @@ class ChromeDriver:
                         self.reboot()
 
                     else:
-                        html_content = self.driver.page_source
-                        soup = BeautifulSoup(html_content, "html.parser")
-                        for table in soup.find_all("table")[:2]:
-                            for tr in table.find_all("tr"):
-                                col, val = self.parse(tr)
-                                data[col] = val
+                        self.parse_summary(html_content, data)
 
                         result[0] = True
-                        self.sleep(3)
 
                 if not result[1]:
                     try:
-                        self.driver.get(statisticsurl(symbol))
-                        WebDriverWait(self.driver, self.timeout).until(
-                            EC.visibility_of_element_located((
-                                By.ID, "Main")))
+                        html_content = self.page_source(
+                            statisticsurl(symbol), "statistics",
+                            EC.visibility_of_element_located((By.ID, "Main")),
+                            has_statistics)
 
                     except TimeoutException:
                         pass
@@ -288,29 +436,25 @@ class ChromeDriver:
                         self.reboot()
 
                     else:
-                        html_content = self.driver.page_source
-                        soup = BeautifulSoup(html_content, "html.parser")
-                        for section in soup.find_all(
-                                "section", {"data-test":"qsp-statistics"}):
-                            for div in section.find_all("div"):
-                                children = list(div.children)
-                                if len(children) == 2 and children[0].text in {
-                                        "Stock Price History", "Share Statistics"}:
-                                    for tr in children[1].find_all("tr"):
-                                        col, val = self.parse(tr)
-                                        data[col] = val
+                        self.parse_statistics(html_content, data,
+                                              SUMMARY_SECTIONS)
 
                         result[1] = True
-                        self.sleep(3)
 
                 if self.finished(result):
                     break
 
             name = "summary"
-            if not self.finished(result):
-                self.results[symbol][name] = result
-            else:
+            if self.finished(result):
                 self.save(name, symbol, data)
+            self.report(symbol, name, result, start)
+            seconds = time.perf_counter() - start
+            status = "ok" if self.finished(result) else "failed"
+            metrics.observe("crawler_symbol_seconds", seconds, section=name)
+            metrics.inc("crawler_symbols_total", section=name, status=status)
+            tools.log(f"[{symbol}] Crawled {name} ({status})", self.debug,
+                      verbose=False, symbol=symbol, stage=name,
+                      duration=round(seconds, 3))
 
 
     def crawl_history(self, symbol):
@@ -365,7 +509,9 @@ class ChromeDriver:
             is_max = True
 
         if self.last_symbol_is_stock:
-            self.driver.get(historyurl(symbol))
+            start = time.perf_counter()
+            self.reason = None
+            self.get(historyurl(symbol), "history")
             is_max = False
             # [Historical Prices, Dividends Only, Stock Splits]
             result = [False, False, False]
@@ -373,8 +519,8 @@ class ChromeDriver:
                 downloaded = f"{symbol}.csv"
                 if not result[0]:
                     name = "history"
-                    if not self.debug and path.exists(tools.get_path(name,
-                                                                     symbol)):
+                    if not self.debug and tools.store.exists(
+                            tools.get_path(name, symbol)):
                         result[0] = True
 
                     else:
@@ -389,7 +535,7 @@ class ChromeDriver:
                                                name)
 
                         except TimeoutException:
-                            pass
+                            self.failed("history", "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -399,8 +545,8 @@ class ChromeDriver:
 
                 if not result[1]:
                     name = "Dividends Only"
-                    if not self.debug and path.exists(tools.get_path(name,
-                                                                     symbol)):
+                    if not self.debug and tools.store.exists(
+                            tools.get_path(name, symbol)):
                         result[1] = True
 
                     else:
@@ -415,7 +561,7 @@ class ChromeDriver:
                             self.mv_downloaded(symbol, downloaded, name)
 
                         except TimeoutException:
-                            pass
+                            self.failed("history", "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -425,8 +571,8 @@ class ChromeDriver:
 
                 if not result[2]:
                     name = "Stock Splits"
-                    if not self.debug and path.exists(tools.get_path(name,
-                                                                     symbol)):
+                    if not self.debug and tools.store.exists(
+                            tools.get_path(name, symbol)):
                         result[2] = True
                     else:
                         try:
@@ -440,7 +586,7 @@ class ChromeDriver:
                             self.mv_downloaded(symbol, downloaded, name)
 
                         except TimeoutException:
-                            pass
+                            self.failed("history", "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -452,9 +598,7 @@ class ChromeDriver:
                     break
                 self.driver.refresh()
 
-            if not self.finished(result):
-                self.results[symbol]["history"] = result
-            self.sleep()
+            self.report(symbol, "history", result, start)
 
 
     def crawl_financials(self, symbol):
@@ -483,6 +627,8 @@ class ChromeDriver:
             self.sleep(3) # wait to download
 
         if self.last_symbol_is_stock:
+            start = time.perf_counter()
+            self.reason = None
             # [Income Statement, Balance Sheet, Cash Flow]
             result = [False, False, False]
             for _ in range(self.max_trial):
@@ -491,17 +637,17 @@ class ChromeDriver:
                     name = "income_statement"
                     if self.init or self.debug:
                         try:
-                            self.driver.get(incomestatementurl(symbol))
+                            self.get(incomestatementurl(symbol), name)
                             self.currency_of_last_symbol = self.get_currency()
 
-                            if not path.exists(tools.get_path(name, symbol)):
+                            if not tools.store.exists(tools.get_path(name, symbol)):
                                 click_quarterly_and_download()
                                 self.mv_downloaded(symbol,
                                                    f"{symbol}_quarterly_financials.csv",
                                                    name)
 
                         except TimeoutException:
-                            pass
+                            self.failed(name, "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -511,20 +657,20 @@ class ChromeDriver:
 
                 if not result[1]:
                     name = "balance_sheet"
-                    if not self.debug and path.exists(tools.get_path(name,
-                                                                     symbol)):
+                    if not self.debug and tools.store.exists(
+                            tools.get_path(name, symbol)):
                         result[1] = True
 
                     else:
                         try:
-                            self.driver.get(balancesheeturl(symbol))
+                            self.get(balancesheeturl(symbol), name)
                             click_quarterly_and_download()
                             self.mv_downloaded(symbol,
                                                f"{symbol}_quarterly_balance-sheet.csv",
                                                name)
 
                         except TimeoutException:
-                            pass
+                            self.failed(name, "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -534,20 +680,20 @@ class ChromeDriver:
 
                 if not result[2]:
                     name = "cash_flow"
-                    if not self.debug and path.exists(tools.get_path(name,
-                                                                     symbol)):
+                    if not self.debug and tools.store.exists(
+                            tools.get_path(name, symbol)):
                         result[2] = True
 
                     else:
                         try:
-                            self.driver.get(cashflowurl(symbol))
+                            self.get(cashflowurl(symbol), name)
                             click_quarterly_and_download()
                             self.mv_downloaded(symbol,
                                                f"{symbol}_quarterly_cash-flow.csv",
                                                name)
 
                         except TimeoutException:
-                            pass
+                            self.failed(name, "chrome")
 
                         except StaleElementReferenceException:
                             self.reboot()
@@ -558,28 +704,27 @@ class ChromeDriver:
                 if self.finished(result):
                     break
 
-            if not self.finished(result):
-                self.results[symbol]["financials"] = result
-
-            self.sleep()
+            self.report(symbol, "financials", result, start)
 
 
     def crawl_statistics(self, symbol):
         """Crawl statistics.csv."""
+        start = time.perf_counter()
+        self.reason = None
         result = [False, False]
         data = {}
-        self.driver.get(statisticsurl(symbol))
-        self.sleep(3)
+        loaded = False # whether statistics page is loaded in Chrome
         for _ in range(self.max_trial):
             name = "tmp"
-            if not self.debug and path.exists(tools.get_path(name, symbol)):
+            if not self.debug and tools.store.exists(tools.get_path(name, symbol)):
                 result[0] = True
 
             else:
                 try:
-                    WebDriverWait(self.driver, self.timeout).until(
-                        EC.visibility_of_element_located((
-                            By.ID, "Main")))
+                    html_content = self.page_source(
+                        statisticsurl(symbol), "statistics",
+                        EC.visibility_of_element_located((By.ID, "Main")),
+                        has_statistics)
 
                 except TimeoutException:
                     pass
@@ -588,46 +733,38 @@ class ChromeDriver:
                     self.reboot()
 
                 else: # crawl statistics with bs4
-                    html_content = self.driver.page_source
-                    soup = BeautifulSoup(html_content, "html.parser")
-                    for section in soup.find_all(
-                            "section", {"data-test":"qsp-statistics"}):
-                        for div in section.find_all("div"):
-                            children = list(div.children)
-                            if len(children) == 2 and children[0].text in {
-                                    "Fiscal Year", "Profitability",
-                                    "Management Effectiveness",
-                                    "Income Statement", "Balance Sheet",
-                                    "Cash Flow Statement", "Dividends & Splits"}:
-                                for tr in children[1].find_all("tr"):
-                                    col, val = self.parse(tr)
-                                    data[col] = val
+                    self.parse_statistics(html_content, data,
+                                          STATISTICS_SECTIONS)
 
                     self.save(name, symbol, data)
                     result[0] = True
 
             name = "statistics"
-            if not self.debug and path.exists(tools.get_path(name, symbol)):
+            if not self.debug and tools.store.exists(tools.get_path(name, symbol)):
                 result[1] = True
 
             else:
                 try: # download quarterly statistics
+                    if not loaded:
+                        self.get(statisticsurl(symbol), name)
+                        loaded = True
                     WebDriverWait(self.driver, self.timeout).until(
                         EC.element_to_be_clickable((
                             By.CSS_SELECTOR,
                             "section[data-test='qsp-statistics'] div>span>button"))
                         ).click()
-                    self.sleep()
+                    self.sleep() # wait to download
                     # move downloaded file to symbol dir
                     self.mv_downloaded(symbol,
                                        f"{symbol}_quarterly_valuation_measures.csv",
                                        name)
 
                 except TimeoutException:
-                    pass
+                    self.failed(name, "chrome")
 
                 except StaleElementReferenceException:
                     self.reboot()
+                    loaded = False
 
                 else:
                     result[1] = True
@@ -635,10 +772,7 @@ class ChromeDriver:
             if self.finished(result):
                 break
 
-        if not self.finished(result):
-            self.results[symbol]["statistics"] = result
-
-        self.sleep()
+        self.report(symbol, "statistics", result, start)
 
 
     def crawl_profile_info(self, symbols):
@@ -650,11 +784,9 @@ class ChromeDriver:
                 try:
                     # crawl 'Stock' column
                     is_stock = self.is_stock()
-                    self.sleep(3)
                     # crawl 'Currency' column
-                    self.driver.get(incomestatementurl(symbol))
+                    self.get(incomestatementurl(symbol), "income_statement")
                     currency = self.get_currency()
-                    self.sleep(3)
 
                 except:
                     pass
@@ -0,0 +1,78 @@
+from urllib.parse import urlsplit, urlunsplit
+
+import urllib3
+
+USERAGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+             " AppleWebKit/537.36 (KHTML, like Gecko)"
+             " Chrome/74.0.3729.157 Safari/537.36")
+
+
+class FetchError(Exception):
+    pass
+
+
+class HTTPFetcher:
+    """Fetch static pages with plain GET requests.
+
+        Connections are pooled and kept alive per host, so crawling many
+        symbols reuses a handful of sockets instead of a browser per page.
+        Set host (e.g. "http://127.0.0.1:8000") to send every request to a
+        stand-in server instead of finance.yahoo.com."""
+    name = "http"
+    offline = False
+
+    def __init__(self, timeout=5, retries=2, maxsize=4, host=None):
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.maxsize = maxsize # connections kept alive per host
+        self.pool = self.make_pool()
+
+    def make_pool(self):
+        return urllib3.PoolManager(
+            maxsize=self.maxsize,
+            block=False,
+            headers={"User-Agent" : USERAGENT},
+            timeout=urllib3.Timeout(total=self.timeout),
+            retries=urllib3.Retry(total=self.retries, backoff_factor=0.5,
+                                  status_forcelist=[500, 502, 503, 504]))
+
+    def resize(self, maxsize):
+        """Keep maxsize connections per host alive, e.g. one per concurrent request."""
+        if maxsize != self.maxsize:
+            self.maxsize = maxsize
+            self.pool.clear()
+            self.pool = self.make_pool()
+
+    def url(self, url):
+        if not self.host:
+            return url
+        host = urlsplit(self.host)
+        return urlunsplit(urlsplit(url)._replace(scheme=host.scheme,
+                                                 netloc=host.netloc))
+
+    def get(self, url):
+        """Return the page source of url."""
+        try:
+            response = self.pool.request("GET", self.url(url))
+        except urllib3.exceptions.HTTPError as e:
+            raise FetchError(f"GET {url} failed: {e}")
+        if response.status != 200:
+            raise FetchError(f"GET {url} returned {response.status}")
+        return response.data.decode("utf-8", errors="replace")
+
+    def close(self):
+        self.pool.clear()
+
+
+fetchers = {"http" : HTTPFetcher, "selenium" : None}
+
+
+def get_fetcher(fetcher):
+    """Return a fetcher for a name in fetchers (None means Selenium only)."""
+    if not isinstance(fetcher, str):
+        return fetcher
+    if fetcher not in fetchers:
+        raise Exception(f"ERROR get_fetcher(): unknown fetcher '{fetcher}', "
+                        f"choose from {list(fetchers)}")
+    return fetchers[fetcher]() if fetchers[fetcher] else None
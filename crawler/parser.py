@@ -0,0 +1,105 @@
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import html as lxml_html
+except ImportError: # only the bs4 parser is available without lxml
+    lxml_html = None
+
+
+def split_row(text):
+    """Split text of a table row joined by '|' into column and value."""
+    # choose any char not commonly used
+    splitted = text.split("|")
+    val = (splitted[-1] if (col := splitted[0]) != "Earnings Date"
+           else "".join(splitted[1:]))
+    return col, val # column, value
+
+
+class BS4Parser:
+    """Parse pages by building a full BeautifulSoup tree (html.parser)."""
+    name = "bs4"
+
+    def parse(self, tr):
+        """Parse row element from table into column and value."""
+        return split_row(tr.get_text("|"))
+
+    def parse_summary(self, html_content, data):
+        """Parse the first two tables of Summary section into data."""
+        soup = BeautifulSoup(html_content, "html.parser")
+        for table in soup.find_all("table")[:2]:
+            for tr in table.find_all("tr"):
+                col, val = self.parse(tr)
+                data[col] = val
+
+    def parse_statistics(self, html_content, data, sections):
+        """Parse tables under the given section headers of Statistics into data."""
+        soup = BeautifulSoup(html_content, "html.parser")
+        for section in soup.find_all(
+                "section", {"data-test":"qsp-statistics"}):
+            for div in section.find_all("div"):
+                children = list(div.children)
+                if len(children) == 2 and children[0].text in sections:
+                    for tr in children[1].find_all("tr"):
+                        col, val = self.parse(tr)
+                        data[col] = val
+
+
+class LXMLParser:
+    """Parse pages with lxml, visiting only the rows that are saved.
+
+        XPath selects the candidate elements in C, so Python only touches
+        the rows of the first two tables of Summary and the divs of
+        Statistics with a header and a body, instead of every element."""
+    name = "lxml"
+
+    SUMMARY_ROWS = "(//table)[position() <= 2]//tr"
+    STATISTICS_DIVS = "//section[@data-test='qsp-statistics']//div[count(node()) = 2]"
+
+    def parse(self, tr):
+        """Parse row element from table into column and value."""
+        return split_row("|".join(tr.xpath(".//text()")))
+
+    def children(self, div):
+        """Return child nodes of div, text nodes included as in bs4."""
+        nodes = [div.text] if div.text else []
+        for child in div:
+            nodes.append(child)
+            if child.tail:
+                nodes.append(child.tail)
+        return nodes
+
+    def text(self, node):
+        return node if isinstance(node, str) else node.text_content()
+
+    def parse_summary(self, html_content, data):
+        """Parse the first two tables of Summary section into data."""
+        for tr in lxml_html.fromstring(html_content).xpath(self.SUMMARY_ROWS):
+            col, val = self.parse(tr)
+            data[col] = val
+
+    def parse_statistics(self, html_content, data, sections):
+        """Parse tables under the given section headers of Statistics into data."""
+        root = lxml_html.fromstring(html_content)
+        for div in root.xpath(self.STATISTICS_DIVS):
+            header, body = self.children(div)
+            if self.text(header) in sections and not isinstance(body, str):
+                for tr in body.iter("tr"):
+                    col, val = self.parse(tr)
+                    data[col] = val
+
+
+parsers = {"bs4" : BS4Parser, "lxml" : LXMLParser}
+
+
+def get_parser(parser=None):
+    """Return a parser for a name in parsers (None means the fastest available)."""
+    if parser is None:
+        parser = "lxml" if lxml_html is not None else "bs4"
+    if not isinstance(parser, str):
+        return parser
+    if parser not in parsers:
+        raise Exception(f"ERROR get_parser(): unknown parser '{parser}', "
+                        f"choose from {list(parsers)}")
+    if parser == "lxml" and lxml_html is None:
+        raise Exception("ERROR get_parser(): lxml is not installed")
+    return parsers[parser]()
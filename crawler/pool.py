@@ -0,0 +1,123 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+from selenium.common.exceptions import WebDriverException
+
+from utils import tools
+
+try:
+    import psutil
+except ImportError: # memory of sessions is not checked without psutil
+    psutil = None
+
+
+class SessionPool:
+    """Long-lived ChromeDriver sessions leased out to crawl calls.
+
+        Sessions are made with make_driver on demand (at most size of them)
+        and kept warm between leases, so Chrome startup and sign-in are paid
+        once instead of on every run. A session is recycled (quit and
+        replaced) when it fails a health check on lease, or on return when
+        it has loaded max_pages pages in Chrome or its browser processes use
+        more than max_memory bytes (needs psutil, warned once if missing)."""
+    warned = False # about max_memory without psutil
+
+    def __init__(self, make_driver, size=1, max_pages=500, max_memory=2 * 2**30,
+                 debug=False):
+        self.make_driver = make_driver
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.debug = debug
+        self.idle = queue.LifoQueue() # most recently used session first
+        self.created = 0
+        self.lock = threading.Lock()
+        if max_memory and psutil is None and not SessionPool.warned:
+            SessionPool.warned = True
+            tools.log("psutil is not installed, browser sessions are not "
+                      "recycled by memory", debug, level=logging.WARNING)
+
+    def lease(self, timeout=None):
+        """Return an idle healthy session, making one if the pool is not full."""
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    new = self.created < self.size
+                    if new:
+                        self.created += 1
+                if new:
+                    try:
+                        driver = self.make_driver()
+                    except Exception:
+                        with self.lock:
+                            self.created -= 1
+                        raise
+                else:
+                    driver = self.idle.get(timeout=timeout)
+            if self.healthy(driver):
+                driver.results.clear()
+                return driver
+            tools.log("Recycling unhealthy browser session", self.debug)
+            self.discard(driver)
+
+    def release(self, driver):
+        """Return a leased session, recycling it if it is worn out."""
+        if driver.pages >= self.max_pages:
+            tools.log(f"Recycling browser session after {driver.pages} pages",
+                      self.debug)
+            self.discard(driver)
+        elif (memory := self.memory(driver)) > self.max_memory:
+            tools.log(f"Recycling browser session using {memory / 2**20:.0f}MB",
+                      self.debug)
+            self.discard(driver)
+        else:
+            self.idle.put(driver)
+
+    @contextmanager
+    def session(self, timeout=None):
+        driver = self.lease(timeout)
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def healthy(self, driver):
+        """Return False if the browser of driver no longer responds."""
+        if driver._driver is None: # Chrome not started yet
+            return True
+        try:
+            driver._driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def memory(self, driver):
+        """Return resident bytes of the browser processes of driver."""
+        if psutil is None or driver._driver is None:
+            return 0
+        try:
+            process = psutil.Process(driver._driver.service.process.pid)
+            return sum(p.memory_info().rss
+                       for p in [process] + process.children(recursive=True))
+        except (AttributeError, psutil.Error):
+            return 0
+
+    def discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    def close(self):
+        """Quit all idle sessions."""
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
@@ -1,19 +1,32 @@
+import re
 import json
+import traceback
 from os import path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 
-from utils import tools, COMPANYDIR
+from utils import tools, COMPANYDIR, MAPPINGPATH
+from utils.history import history_store
+from utils.manifest import Manifest
+from utils.metrics import metrics
 
 mapping = tools.get_mapping()
 month2digit = mapping["month2digit"]
 col2dtype = mapping["col2dtype"]
 
+# quarterly files summed into yearly files
+STATEMENTS = ["income_statement", "balance_sheet", "cash_flow"]
+# files of a symbol preprocessed by process_text_symbol
+DATASETS = ["dividend", "history", "stock_split"] + STATEMENTS + ["statistics", "summary"]
+# crawled files each dataset is made from, if not only its own
+INPUTS = {"statistics" : ["statistics", "tmp"]}
+
 def sort_date_and_remove_nat(df):
     """Coerce datetime (index) and remove NaT."""
-    df.index = pd.to_datetime(df.index, errors="coerce")
+    df.index = tools.to_dates(df.index)
     df.index.name = "Date"
     # remove non-datetime rows (e.g. 'ttm')
     return df[~pd.isnull(df.index)].sort_index(ascending=False)
@@ -23,30 +36,101 @@ def transpose(df):
     df = df.T.reset_index().rename(columns={"index" : "Date"})
     return df.set_index("Date")
 
+def fiscal_year_end(symbol):
+    try:
+        return tools.get_data("Fiscal Year Ends", symbol, i=0)
+    except KeyError: # statistics without the column
+        return None
+
+
+def fiscal_year_ends(symbols):
+    """Return the month (1-12, NaN if unknown) of the fiscal year end of symbols."""
+    values = pd.Series([fiscal_year_end(symbol) for symbol in symbols], dtype="object")
+    months = tools.to_dates(values).month
+    return pd.Series(np.asarray(months), index=list(symbols), dtype="float")
+
+
+def annualize(panel, fiscal_year_end_months, n_quarter=4):
+    """Sum the quarters of each fiscal year of every symbol of panel at once.
+
+        panel holds the numeric quarterly rows of many symbols under a
+        (Symbol, Date) index. A row of the result is the sum of a quarter and
+        the n_quarter - 1 quarters before it of the same symbol (fewer for
+        the oldest quarters, NaN if all are NaN). Rows are kept if they end
+        in the fiscal year end month of their symbol, or, if no row of the
+        symbol does, every n_quarter-th row from the latest."""
+    panel = panel.sort_index(ascending=[True, False]) # latest quarter first
+    symbols = panel.index.get_level_values(0)
+    codes = pd.factorize(symbols)[0]
+    values = panel.to_numpy(dtype="float")
+    observed = ~np.isnan(values)
+    values = np.where(observed, values, 0.)
+
+    # add the k-th older row where it belongs to the same symbol
+    total, count = values.copy(), observed.astype("int")
+    for k in range(1, n_quarter):
+        same = (codes[:-k] == codes[k:])[:, None]
+        total[:-k] += np.where(same, values[k:], 0.)
+        count[:-k] += np.where(same, observed[k:], 0)
+    sums = np.where(count > 0, total, np.nan)
+
+    months = pd.DatetimeIndex(panel.index.get_level_values(1)).month.to_numpy()
+    at_year_end = months == fiscal_year_end_months.reindex(symbols).to_numpy()
+    aligned = pd.Series(at_year_end).groupby(codes).transform("any").to_numpy()
+    position = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+    keep = np.where(aligned, at_year_end, position % n_quarter == 0)
+    return pd.DataFrame(sums[keep], index=panel.index[keep], columns=panel.columns)
+
+
+def to_panel(dfs):
+    """Stack {symbol : quarterly df} into a numeric panel indexed by (Symbol, Date)."""
+    panel = pd.concat({symbol : df.select_dtypes("number")
+                       for symbol, df in dfs.items()}, names=["Symbol", "Date"])
+    panel.index = pd.MultiIndex.from_arrays(
+        [panel.index.get_level_values(0),
+         tools.to_dates(panel.index.get_level_values(1))], names=["Symbol", "Date"])
+    return panel
+
+
 def quarterly2yearly(df, symbol):
+    """Return yearly df of a quarterly df of symbol (see annualize)."""
     if df.shape[1] < 2:
         return
 
-    n_quarter = 4
+    yearly_df = annualize(to_panel({symbol : df}), fiscal_year_ends([symbol]))
+    return yearly_df.droplevel("Symbol")
 
-    yearly_df = df.iloc[::-1].rolling(n_quarter, min_periods=1).sum().iloc[::-1]
-    try:
-        fiscal_year_ends = (pd.to_datetime(tools.get_data("Fiscal Year Ends",
-                                                          symbol, i=0))
-                            .strftime("%Y-%m"))
-        year_month = yearly_df.index.map(lambda x: x.strftime("%Y-%m"))
-        start_ind = year_month[year_month == fiscal_year_ends].iloc[0]
-    except:
-        start_ind = 0
 
-    return yearly_df.iloc[start_ind : len(yearly_df) : n_quarter, :]
+def build_yearly(symbols, debug, filenames=STATEMENTS):
+    """Write yearly files of the statements of symbols, one panel per statement.
+
+        Fiscal year ends of all symbols are looked up once, and each
+        statement of all symbols is annualized in one vectorized pass."""
+    if not (symbols := list(symbols)):
+        return
+    months = fiscal_year_ends(symbols)
+    for filename in filenames:
+        dfs = {}
+        for symbol in symbols:
+            df = tools.get_df(filename, symbol, debug=debug)
+            if df is not None and len(df) and df.shape[1] >= 2:
+                dfs[symbol] = df
+        if not dfs:
+            continue
+
+        yearly = annualize(to_panel(dfs), months)
+        for symbol, yearly_df in yearly.groupby(level="Symbol", sort=False):
+            columns = dfs[symbol].select_dtypes("number").columns
+            tools.to_csv(yearly_df.droplevel("Symbol")[columns],
+                         tools.get_path(filename, symbol, yearly=True, debug=debug))
+            print(f"Generated {symbol}/{symbol}_yearly_{filename}.csv")
 
 
 def merge_statistics_df(statistics_df, symbol, debug):
     """Merge statistics.csv with tmp.csv."""
     tmp_df = tools.get_df("tmp", symbol, convert_index_to_datetime=False)
     if tmp_df is not None:
-        tmp_df.index.name = "Date"
+        tmp_df = tmp_df.rename_axis("Date") # the cached df is shared
         if len(tmp_df) > 1: # only use the last row if multiple given
             tmp_df = pd.DataFrame(tmp_df.iloc[0, :]).T
         if len(statistics_df) > 0:
@@ -62,9 +146,10 @@ def merge_statistics_df(statistics_df, symbol, debug):
 
         if not debug:
             originalpath = path.join(COMPANYDIR, symbol, "original", "tmp_original.csv")
-            tools.mv(path.join(COMPANYDIR, symbol,
-                               tools.name_append(symbol, "tmp", filetype="csv")),
-                     originalpath)
+            tmppath = path.join(COMPANYDIR, symbol,
+                                tools.name_append(symbol, "tmp", filetype="csv"))
+            tools.store.move(tmppath, originalpath)
+            tools.written[tmppath] = tools.store.signature(tmppath)
 
         new_df.index.name = "Date"
         return new_df
@@ -91,66 +176,121 @@ def rename_columns(columns):
 
     return new_columns
 
-def convert_dtypes(df):
-    """Convert datatypes of columns in-place based on types defined in col2dtype."""
-    def size2digit(text):
-        if "M" in text:
-            try:
-                nfloat = len(text.split("M")[0].split(".")[1])
-            except IndexError:
-                nfloat = 0
-            text = text.replace("M", "".join(["0"] * (6 - nfloat))).replace(".", "")
-        if "B" in text:
-            try:
-                nfloat = len(text.split("B")[0].split(".")[1])
-            except IndexError:
-                nfloat = 0
-            text = text.replace("B", "".join(["0"] * (9 - nfloat))).replace(".", "")
-        if "T" in text:
-            try:
-                nfloat = len(text.split("T")[0].split(".")[1])
-            except IndexError:
-                nfloat = 0
-            text = text.replace("T", "".join(["0"] * (12 - nfloat))).replace(".", "")
-        if "k" in text:
+# "1.5%" (anything else with % goes through the scalar fallback)
+PERCENTAGE_RE = re.compile(r"^[+-]?(?:\d+\.?\d*|\.\d+)%\Z")
+# "1,234" / "-0.5" with commas already removed
+PLAIN_RE = re.compile(r"^[^%MBTk]*\Z")
+# "1.2B", ".5M", "3k" with commas already removed
+SUFFIX_RE = re.compile(r"^([+-]?\d*)(?:\.(\d*))?([MBTk])\Z")
+# number of zeros each suffix stands for
+suffix2zeros = {"M" : 6, "B" : 9, "T" : 12, "k" : 3}
+# any month name, to skip columns without them
+MONTH_RE = re.compile("|".join(month2digit))
+
+
+def size2digit(text):
+    for suffix, n in suffix2zeros.items():
+        if suffix in text:
             try:
-                nfloat = len(text.split("k")[0].split(".")[1])
+                nfloat = len(text.split(suffix)[0].split(".")[1])
             except IndexError:
                 nfloat = 0
-            text = text.replace("k", "".join(["0"] * (3 - nfloat))).replace(".", "")
-        return text
+            text = text.replace(suffix, "".join(["0"] * (n - nfloat))).replace(".", "")
+    return text
 
-    def digitize_month(text):
-        if not isinstance(text, str):
-            return text
 
-        for month in month2digit.keys():
-            if month in text:
-                text = text.replace(month, month2digit[month])
-                break
-        return text
+def percentage2float(text):
+    try:
+        return float(text.replace("%", "")) * 0.01
+    except:
+        return np.nan
 
-    def percentage2float(text):
-        try:
-            return float(text.replace("%", "")) * 0.01
-        except:
-            return np.nan
 
-    def to_numeric(text):
-        if isinstance(text, float) and np.isnan(text):
-            return text
+def to_numeric(text):
+    """Convert a single value, e.g. '1.2B', '3,456' or '12%' into a number."""
+    if isinstance(text, float) and np.isnan(text):
+        return text
+    if "%" in text:
+        return percentage2float(text)
+    if "," in text:
+        text = text.replace(",", "")
+    text = size2digit(text)
+    return pd.to_numeric(text, errors="coerce")
+
+
+def to_numeric_vectorized(series):
+    """Convert a column of strings like to_numeric, but column at a time.
+
+        Percentages, plain numbers and numbers with a single M/B/T/k suffix are
+        rewritten as digits (matched with precompiled regexes) and converted
+        with one pd.to_numeric call; anything else (a small minority) falls back
+        to to_numeric per value, so the result is identical to
+        series.apply(to_numeric). No pandas op runs per kind of value, so short
+        columns (most statements) are as cheap as long ones per value."""
+    if pd.api.types.infer_dtype(series, skipna=True) != "string":
+        return series.apply(to_numeric)
+
+    values = series.to_numpy(dtype="object")
+    res = np.full(len(values), np.nan)
+    numbers, digits, pcts, pct_digits, rest = [], [], [], [], []
+    for i, text in enumerate(values):
+        if not isinstance(text, str): # NaN
+            continue
         if "%" in text:
-            return percentage2float(text)
-        if "," in text:
-            text = text.replace(",", "")
-        text = size2digit(text)
-        return pd.to_numeric(text, errors="coerce")
+            if PERCENTAGE_RE.match(text):
+                pcts.append(i)
+                pct_digits.append(text[:-1])
+            else:
+                rest.append(i)
+            continue
+        text = text.replace(",", "")
+        if PLAIN_RE.match(text):
+            numbers.append(i)
+            digits.append(text)
+        elif match := SUFFIX_RE.match(text):
+            int_, frac, suffix = match.groups()
+            numbers.append(i)
+            digits.append(int_ + (frac or "").ljust(suffix2zeros[suffix], "0"))
+        else:
+            rest.append(i)
+
+    if pcts:
+        res[pcts] = np.array(pct_digits, dtype="float64") * 0.01
+    if numbers:
+        converted = pd.to_numeric(np.array(digits, dtype="object"), errors="coerce")
+        if converted.dtype.kind in "iu" and len(numbers) == len(values):
+            # all integers, keep integer dtype
+            return pd.Series(converted, index=series.index, name=series.name)
+        res[numbers] = converted
+    for i in rest:
+        res[i] = to_numeric(values[i])
+    return pd.Series(res, index=series.index, name=series.name)
+
+
+def digitize_month(series):
+    """Replace the first month name (in month2digit order) of each value by its digit."""
+    if pd.api.types.infer_dtype(series, skipna=True) not in {"string", "mixed"}:
+        return series
+
+    values = series.to_numpy(dtype="object")
+    texts = [(i, text) for i, text in enumerate(values)
+             if isinstance(text, str) and MONTH_RE.search(text)]
+    if not texts: # e.g. dates in digits only
+        return series
+    values = values.copy()
+    for i, text in texts:
+        month = next(month for month in month2digit if month in text)
+        values[i] = text.replace(month, month2digit[month])
+    return pd.Series(values, index=series.index, name=series.name)
+
 
+def convert_dtypes(df):
+    """Convert datatypes of columns in-place based on types defined in col2dtype."""
     for col in df:
         if col in col2dtype:
             if col2dtype[col] == "datetime":
-                dates = df[col].apply(digitize_month)
-                df[col] = dates.apply(pd.to_datetime, errors="coerce")
+                # one call per shape of date, as values may mix formats
+                df[col] = tools.to_dates(digitize_month(df[col])).to_numpy()
 
             elif col2dtype[col] == "bool":
                 df[col] = df[col].astype(col2dtype[col])
@@ -159,129 +299,246 @@ def convert_dtypes(df):
                 pass
 
         elif df[col].dtype == "object":
-            df[col] = df[col].apply(to_numeric)
+            df[col] = to_numeric_vectorized(df[col])
 
 
 def process_text(symbols, init, debug):
     for symbol in symbols:
-        if not path.exists((originalpath := path.join(COMPANYDIR, symbol, "original"))):
-            tools.mkdir(originalpath)
-
-        # sort dividend.csv
-        dividend_df = tools.get_df(filename := "dividend", symbol,
-                                   convert_index_to_datetime=False)
-        if dividend_df is not None:
-            dividend_df = sort_date_and_remove_nat(dividend_df)
-            tools.backup_and_save_df(filename, symbol, dividend_df, init, debug)
-
-        # sort history.csv
-        history_df = tools.get_df(filename := "history", symbol,
-                                  convert_index_to_datetime=False)
-        if history_df is not None:
-            history_df = sort_date_and_remove_nat(history_df)
-            tools.backup_and_save_df(filename, symbol, history_df, init, debug)
-
-        # sort stock_split.csv
-        stock_split_df = tools.get_df(filename := "stock_split", symbol,
-                                      convert_index_to_datetime=False)
-        if stock_split_df is not None:
-            stock_split_df = sort_date_and_remove_nat(stock_split_df)
-            tools.backup_and_save_df(filename, symbol, stock_split_df, init, debug)
-
-        # transpose, sort and create yearly income_statement.csv
-        income_statement_df = tools.get_df(filename := "income_statement", symbol,
-                                           convert_index_to_datetime=False)
-        if income_statement_df is not None and income_statement_df.index.name != "Date":
-            income_statement_df = transpose(income_statement_df)
-            income_statement_df = sort_date_and_remove_nat(income_statement_df)
-            income_statement_df.columns = rename_columns(income_statement_df.columns)
-            tools.backup_and_save_df(filename, symbol, income_statement_df, init, debug)
-
-        # transpose, sort and create yearly balance_sheet.csv
-        balance_sheet_df = tools.get_df(filename := "balance_sheet", symbol,
-                                        convert_index_to_datetime=False)
-        if balance_sheet_df is not None and balance_sheet_df.index.name != "Date":
-            balance_sheet_df = transpose(balance_sheet_df)
-            balance_sheet_df = sort_date_and_remove_nat(balance_sheet_df)
-            balance_sheet_df.columns = rename_columns(balance_sheet_df.columns)
-            tools.backup_and_save_df(filename, symbol, balance_sheet_df, init, debug)
-
-        # transpose, sort and create yearly cash_flow.csv
-        cash_flow_df = tools.get_df(filename := "cash_flow", symbol,
-                                    convert_index_to_datetime=False)
-        if cash_flow_df is not None and cash_flow_df.index.name != "Date":
-            cash_flow_df = transpose(cash_flow_df)
-            cash_flow_df = sort_date_and_remove_nat(cash_flow_df)
-            cash_flow_df.columns = rename_columns(cash_flow_df.columns)
-            tools.backup_and_save_df(filename, symbol, cash_flow_df, init, debug)
-
-        # transpose, sort and merge statistics.csv
-        statistics_df = tools.get_df(filename := "statistics", symbol,
-                                     convert_index_to_datetime=False)
-        if (statistics_df is not None
-                and len(statistics_df.index)
-                and statistics_df.index.name != "Date"):
-            statistics_df = transpose(statistics_df)
-            statistics_df = sort_date_and_remove_nat(statistics_df)
-            statistics_df = merge_statistics_df(statistics_df, symbol, debug)
-            if statistics_df is not None:
-                statistics_df.columns = rename_columns(statistics_df.columns)
-                tools.backup_and_save_df(filename, symbol, statistics_df, init, debug)
-
-        summary_df = tools.get_df(filename := "summary", symbol,
-                                  convert_index_to_datetime=False)
-        if summary_df is not None:
-            summary_df.columns = rename_columns(summary_df.columns)
-            tools.backup_and_save_df(filename, symbol, summary_df, init, debug)
+        process_text_symbol(symbol, init, debug)
+
+
+def process_text_symbol(symbol, init, debug, datasets=None):
+    """Sort, transpose and rename columns of the crawled files of symbol.
+
+        Only files of datasets are processed if given."""
+    if not path.exists((originalpath := path.join(COMPANYDIR, symbol, "original"))):
+        tools.mkdir(originalpath)
+
+    def get_df(filename):
+        if datasets is None or filename in datasets:
+            df = tools.get_df(filename, symbol, convert_index_to_datetime=False)
+            # only labels are replaced below, which leaves the cached df as is
+            return df.copy(deep=False) if df is not None else None
+
+    # sort dividend.csv
+    dividend_df = get_df(filename := "dividend")
+    if dividend_df is not None:
+        dividend_df = sort_date_and_remove_nat(dividend_df)
+        tools.backup_and_save_df(filename, symbol, dividend_df, init, debug)
+
+    # sort history.csv
+    history_df = get_df(filename := "history")
+    if history_df is not None:
+        history_df = sort_date_and_remove_nat(history_df)
+        tools.backup_and_save_df(filename, symbol, history_df, init, debug)
+        history_store.write(symbol, history_df, debug) # memory-mapped copy
+
+    # sort stock_split.csv
+    stock_split_df = get_df(filename := "stock_split")
+    if stock_split_df is not None:
+        stock_split_df = sort_date_and_remove_nat(stock_split_df)
+        tools.backup_and_save_df(filename, symbol, stock_split_df, init, debug)
+
+    # transpose, sort and create yearly income_statement.csv
+    income_statement_df = get_df(filename := "income_statement")
+    if income_statement_df is not None and income_statement_df.index.name != "Date":
+        income_statement_df = transpose(income_statement_df)
+        income_statement_df = sort_date_and_remove_nat(income_statement_df)
+        income_statement_df.columns = rename_columns(income_statement_df.columns)
+        tools.backup_and_save_df(filename, symbol, income_statement_df, init, debug)
+
+    # transpose, sort and create yearly balance_sheet.csv
+    balance_sheet_df = get_df(filename := "balance_sheet")
+    if balance_sheet_df is not None and balance_sheet_df.index.name != "Date":
+        balance_sheet_df = transpose(balance_sheet_df)
+        balance_sheet_df = sort_date_and_remove_nat(balance_sheet_df)
+        balance_sheet_df.columns = rename_columns(balance_sheet_df.columns)
+        tools.backup_and_save_df(filename, symbol, balance_sheet_df, init, debug)
+
+    # transpose, sort and create yearly cash_flow.csv
+    cash_flow_df = get_df(filename := "cash_flow")
+    if cash_flow_df is not None and cash_flow_df.index.name != "Date":
+        cash_flow_df = transpose(cash_flow_df)
+        cash_flow_df = sort_date_and_remove_nat(cash_flow_df)
+        cash_flow_df.columns = rename_columns(cash_flow_df.columns)
+        tools.backup_and_save_df(filename, symbol, cash_flow_df, init, debug)
+
+    # transpose, sort and merge statistics.csv
+    statistics_df = get_df(filename := "statistics")
+    if (statistics_df is not None
+            and len(statistics_df.index)
+            and statistics_df.index.name != "Date"):
+        statistics_df = transpose(statistics_df)
+        statistics_df = sort_date_and_remove_nat(statistics_df)
+        statistics_df = merge_statistics_df(statistics_df, symbol, debug)
+        if statistics_df is not None:
+            statistics_df.columns = rename_columns(statistics_df.columns)
+            tools.backup_and_save_df(filename, symbol, statistics_df, init, debug)
+
+    summary_df = get_df(filename := "summary")
+    if summary_df is not None:
+        summary_df.columns = rename_columns(summary_df.columns)
+        tools.backup_and_save_df(filename, symbol, summary_df, init, debug)
+
+
+def find_new_columns(symbol, debug):
+    """Return {column : filename} for columns of symbol not in mapping.json."""
+    new_columns = {}
+    for fname in ["income_statement", "balance_sheet", "cash_flow"]:
+        if (df := tools.get_df(fname, symbol, debug=debug)) is not None:
+            for col in df.columns:
+                if col not in tools.col2filename and col not in new_columns:
+                    new_columns[col] = fname
+    return new_columns
 
 
-def generate_mapping(symbols, debug):
-    filenames = ["income_statement", "balance_sheet", "cash_flow"]
-    # load mapping
-    with open("crawler/mapping.json", "r") as r_obj:
+def update_mapping(new_columns):
+    """Add new_columns to col2filename in mapping.json (one write)."""
+    with open(MAPPINGPATH, "r") as r_obj:
         mapping = json.load(r_obj)
         col2filename = mapping["col2filename"]
 
-    for symbol in symbols:
-        for fname in filenames:
-            if (df := tools.get_df(fname, symbol, debug=debug)) is not None:
-                for col in df.columns:
-                    if col not in col2filename:
-                        print(f"{print(col)} added to mapping.json")
-                        col2filename[col] = fname
+    for col, fname in new_columns.items():
+        if col not in col2filename:
+            print(f"{col} added to mapping.json")
+            col2filename[col] = fname
     # update mapping
-    with open("crawler/mapping.json", "w") as w_obj:
+    with open(MAPPINGPATH, "w") as w_obj:
         json.dump(mapping, w_obj, indent=4)
 
 
-def init_process(symbols, init, debug):
-    process_text(symbols, init, debug)
+def generate_mapping(symbols, debug):
+    new_columns = {}
+    for symbol in symbols:
+        for col, fname in find_new_columns(symbol, debug).items():
+            new_columns.setdefault(col, fname)
+    update_mapping(new_columns)
 
-    if init or debug:
-        generate_mapping(symbols, debug)
 
-    for symbol in symbols:
-        inpath = tools.get_path("statistics", symbol, debug=debug)
+def convert_symbol(symbol, init, debug, datasets=None):
+    """Convert datatypes of symbol's files (yearly files are made by build_yearly)."""
+    for filename in STATEMENTS + ["statistics", "summary"]:
+        if datasets is not None and filename not in datasets:
+            continue
+        inpath = tools.get_path(filename, symbol, debug=debug)
         df = tools.path2df(inpath)
 
-        for filename in \
-                ["income_statement", "balance_sheet", "cash_flow",
-                 "statistics", "summary"]:
-            inpath = tools.get_path(filename, symbol, debug=debug)
-            df = tools.path2df(inpath)
-
-            if df is not None and len(df):
+        if df is not None and len(df):
+            df = df.copy() # converted in place, the cached df is shared
+            with metrics.timer("preprocess_seconds", stage="convert_dtypes"):
                 convert_dtypes(df)
+            with metrics.timer("preprocess_seconds", stage="save"):
                 tools.backup_and_save_df(filename, symbol, df, init, debug)
-                print(f"Processed {symbol}/{symbol}_{filename}.csv")
-
-                if filename in {"income_statement", "balance_sheet", "cash_flow"}:
-                    yearly_df = quarterly2yearly(df, symbol)
-                    tools.to_csv(yearly_df, tools.get_path(filename,
-                                                           symbol,
-                                                           yearly=True,
-                                                           debug=debug))
-                    print(f"Generated {symbol}/{symbol}_yearly_{filename}.csv")
+            print(f"Processed {symbol}/{symbol}_{filename}.csv")
+
+
+def process_symbols(symbols, init, debug, dirty=None):
+    """Run the whole preprocessing of each symbol.
+
+        Only the datasets in dirty[symbol] are processed if dirty is given.
+        Return a list of (symbol, new columns, error) where error is the
+        traceback if processing failed and None otherwise."""
+    results = []
+    for symbol in symbols:
+        datasets = dirty[symbol] if dirty is not None else None
+        try:
+            with metrics.timer("preprocess_seconds", stage="process_text"):
+                process_text_symbol(symbol, init, debug, datasets)
+            with metrics.timer("preprocess_seconds", stage="find_new_columns"):
+                new_columns = find_new_columns(symbol, debug) if init or debug else {}
+            with metrics.timer("preprocess_seconds", stage="convert_symbol"):
+                convert_symbol(symbol, init, debug, datasets)
+
+        except Exception:
+            metrics.inc("preprocess_symbols_total", status="failed")
+            results.append((symbol, {}, traceback.format_exc()))
+
+        else:
+            metrics.inc("preprocess_symbols_total", status="ok")
+            results.append((symbol, new_columns, None))
+    return results
+
+
+def process_chunk(symbols, init, debug, dirty=None):
+    """Run process_symbols in a worker and return its results, metrics and
+        the signatures of the files it wrote (tools.written)."""
+    metrics.reset()
+    tools.written.clear()
+    return (process_symbols(symbols, init, debug, dirty), metrics.snapshot(),
+            dict(tools.written))
+
+
+def init_process(symbols, init, debug, workers=1, chunksize=None, force=False):
+    """Preprocess symbols, sharded over a process pool if workers > 1.
+
+        Only datasets whose crawled files changed since they were last
+        processed (see Manifest) are processed, and only symbols with any of
+        them are scheduled, unless force. Symbols are scheduled in chunks (by
+        default about four per worker) so that a slow symbol does not hold
+        back a whole shard. Yearly files of the changed statements are built
+        and mapping.json is updated once here instead of by each worker."""
+    symbols = list(symbols)
+    manifest = Manifest(inputs=INPUTS)
+    if force:
+        manifest.clear(debug)
+    dirty = {symbol : datasets for symbol in symbols
+             if (datasets := manifest.dirty(symbol, DATASETS, debug))}
+    # inputs crawled while being processed must stay dirty, so record them as
+    # they were before processing
+    signatures = {symbol : {dataset : manifest.signature(symbol, dataset)
+                            for dataset in datasets}
+                  for symbol, datasets in dirty.items()}
+    n_skipped = len(symbols) * len(DATASETS) - sum(map(len, dirty.values()))
+    metrics.inc("preprocess_skipped_total", n_skipped)
+    symbols = list(dirty)
+
+    tools.written.clear()
+    if workers > 1 and len(symbols) > 1:
+        chunksize = chunksize or max(1, len(symbols) // (workers * 4))
+        results, written = [], {}
+        with ProcessPoolExecutor(workers,
+                                 initializer=tools.set_store,
+                                 initargs=(tools.store.name,)) as executor:
+            futures = [executor.submit(process_chunk, chunk, init, debug,
+                                       {symbol : dirty[symbol] for symbol in chunk})
+                       for i in range(0, len(symbols), chunksize)
+                       if (chunk := symbols[i:i + chunksize])]
+            for future in as_completed(futures):
+                chunk_results, snapshot, chunk_written = future.result()
+                results.extend(chunk_results)
+                metrics.merge(snapshot)
+                written.update(chunk_written)
+    else:
+        results = process_symbols(symbols, init, debug, dirty)
+        written = dict(tools.written)
+
+    # yearly files depend on the statement and the fiscal year end (statistics)
+    with metrics.timer("preprocess_seconds", stage="build_yearly"):
+        for filename in STATEMENTS:
+            build_yearly([symbol for symbol, _, error in results if not error
+                          and {filename, "statistics"} & set(dirty[symbol])],
+                         debug, [filename])
+
+    for symbol, _, error in results:
+        if not error: # failed symbols stay dirty
+            manifest.update(symbol, signatures[symbol], written, debug)
+    manifest.save()
+
+    if init or debug:
+        new_columns = {}
+        for _, columns, _ in results:
+            for col, fname in columns.items():
+                new_columns.setdefault(col, fname)
+        with metrics.timer("preprocess_seconds", stage="update_mapping"):
+            update_mapping(new_columns)
+
+    failed = {symbol : error for symbol, _, error in results if error}
+    for symbol, error in failed.items():
+        tools.log(f"[{symbol}] Failure processing: {error}", debug,
+                  symbol=symbol, stage="preprocess")
+    tools.log(f"Processed {len(results) - len(failed)}/{len(results)} symbols, "
+              f"skipped {n_skipped} unchanged files", debug)
+    return results
 
 
 def process_summary(df):
@@ -0,0 +1,99 @@
+import time
+import random
+import asyncio
+import threading
+from collections import defaultdict
+
+
+class Latency:
+    """Running statistics of response times of one endpoint."""
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.count = 0
+        self.failures = 0
+        self.total = 0.
+        self.ewma = None
+        self.min = None
+        self.max = 0.
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.ewma = (seconds if self.ewma is None
+                     else self.alpha * seconds + (1 - self.alpha) * self.ewma)
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {"requests" : self.count,
+                "failures" : self.failures,
+                "mean" : self.total / self.count if self.count else None,
+                "ewma" : self.ewma,
+                "min" : self.min,
+                "max" : self.max}
+
+
+class RateController:
+    """AIMD pacing of requests per endpoint (e.g. 'summary', 'history').
+
+        Each endpoint starts at rate requests per second. A healthy response
+        adds increase to the rate (up to max_rate) unless it was more than
+        slow times slower than the fastest response seen, in which case the
+        rate is held. A timeout or error multiplies the rate by decrease (down
+        to min_rate). Consecutive failures also grow backoff(), an
+        exponential delay with full jitter used before rebooting the browser.
+        One controller is shared by all crawl methods of a driver."""
+    def __init__(self, rate=0.5, min_rate=0.05, max_rate=5., increase=0.05,
+                 decrease=0.5, slow=3., base_backoff=30., max_backoff=600.):
+        self.initial = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow = slow
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.rates = defaultdict(lambda: self.initial)
+        self.next = defaultdict(float) # endpoint -> earliest time of next request
+        self.latency = defaultdict(Latency)
+        self.failures = 0 # consecutive failures over all endpoints
+        self.lock = threading.Lock()
+
+    def delay(self, endpoint):
+        """Reserve the next request slot of endpoint and return seconds until it."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next[endpoint])
+            self.next[endpoint] = slot + 1 / self.rates[endpoint]
+            return slot - now
+
+    def wait(self, endpoint):
+        time.sleep(self.delay(endpoint))
+
+    async def async_wait(self, endpoint):
+        await asyncio.sleep(self.delay(endpoint))
+
+    def success(self, endpoint, seconds):
+        with self.lock:
+            latency = self.latency[endpoint]
+            latency.add(seconds)
+            self.failures = 0
+            if seconds <= self.slow * latency.min:
+                self.rates[endpoint] = min(self.max_rate,
+                                           self.rates[endpoint] + self.increase)
+
+    def failure(self, endpoint):
+        with self.lock:
+            self.latency[endpoint].failures += 1
+            self.failures += 1
+            self.rates[endpoint] = max(self.min_rate,
+                                       self.rates[endpoint] * self.decrease)
+
+    def backoff(self):
+        """Seconds to rest after the current run of consecutive failures."""
+        cap = min(self.max_backoff, self.base_backoff * 2 ** self.failures)
+        return random.uniform(cap / 2, cap)
+
+    def stats(self):
+        return {endpoint : dict(latency.to_dict(), rate=self.rates[endpoint])
+                for endpoint, latency in self.latency.items()}
@@ -0,0 +1,103 @@
+import re
+import os
+import gzip
+from os import path
+
+from utils import FIXTUREDIR
+from crawler.fetcher import FetchError
+from crawler.crawler import (summaryurl, profileurl, statisticsurl, incomestatementurl,
+                             balancesheeturl, cashflowurl, historyurl)
+
+# pages are recorded per url function
+urlfunctions = {"summary" : summaryurl,
+                "profile" : profileurl,
+                "statistics" : statisticsurl,
+                "income_statement" : incomestatementurl,
+                "balance_sheet" : balancesheeturl,
+                "cash_flow" : cashflowurl,
+                "history" : historyurl}
+
+
+def compile_url(urlfunction):
+    """Return a regex matching the urls made by urlfunction, capturing the symbol."""
+    head, *rest = re.escape(urlfunction("SYMBOL")).split("SYMBOL")
+    return re.compile(f"{head}(?P<symbol>[^/?&]+)" + "(?P=symbol)".join(rest) + "$")
+
+
+urlpatterns = {name : compile_url(fn) for name, fn in urlfunctions.items()}
+
+
+class FixtureStore:
+    """Page sources saved gzipped as root/<url function>/<symbol>.html.gz."""
+    def __init__(self, root=FIXTUREDIR):
+        self.root = root
+
+    def locate(self, url):
+        for name, pattern in urlpatterns.items():
+            if m := pattern.match(url):
+                return path.join(self.root, name, f"{m['symbol']}.html.gz")
+        raise FetchError(f"{url} is not made by any url function")
+
+    def save(self, url, html):
+        outpath = self.locate(url)
+        os.makedirs(path.dirname(outpath), exist_ok=True)
+        with gzip.open(tmppath := f"{outpath}.tmp", "wt", encoding="utf-8") as w_obj:
+            w_obj.write(html)
+        os.replace(tmppath, outpath)
+
+    def load(self, url):
+        try:
+            with gzip.open(self.locate(url), "rt", encoding="utf-8") as r_obj:
+                return r_obj.read()
+        except FileNotFoundError:
+            raise FetchError(f"{url} is not recorded")
+
+    def symbols(self, name):
+        """Return symbols recorded for the url function name."""
+        if not path.exists(dir_ := path.join(self.root, name)):
+            return []
+        return sorted(f[:-len(".html.gz")] for f in os.listdir(dir_)
+                      if f.endswith(".html.gz"))
+
+
+class RecordingFetcher:
+    """Save every page fetched with fetcher (and loaded in Chrome) to store.
+
+        With fetcher None, get() returns an empty page so that every page is
+        loaded in Chrome, which hands the rendered source to record()."""
+    offline = False
+
+    def __init__(self, fetcher=None, store=None):
+        self.fetcher = fetcher
+        self.store = store or FixtureStore()
+
+    def get(self, url):
+        if self.fetcher is None:
+            return ""
+        html = self.fetcher.get(url)
+        self.record(url, html)
+        return html
+
+    def record(self, url, html):
+        try:
+            self.store.save(url, html)
+        except FetchError: # e.g. sign-in page
+            pass
+
+    def close(self):
+        if self.fetcher is not None:
+            self.fetcher.close()
+
+
+class ReplayFetcher:
+    """Serve recorded pages from store; pages not recorded fail without Chrome."""
+    offline = True
+
+    def __init__(self, store=None):
+        self.store = store or FixtureStore()
+
+    def get(self, url):
+        return self.store.load(url)
+
+    def close(self):
+        pass
@@ -0,0 +1,53 @@
+import heapq
+from collections import defaultdict
+
+from utils import tools
+
+
+# sections retried first: summary is crawled every day, history takes longest
+RETRY_PRIORITY = {"summary" : 0, "statistics" : 1, "financials" : 2, "history" : 3}
+
+
+def retry_failures(result_store, session, run_summary, try_crawl, max_retry=2,
+                    debug=False):
+    """Re-crawl only the (symbol, section)s that failed in the last run.
+
+        Retries are popped from a heap by section priority, then by fewest
+        attempts so far. Summary retries are crawled together with
+        run_summary(symbols); the others one by one with a driver from
+        session(), which must be signed in (made with init) as downloads
+        need it, and try_crawl(crawl_fn, symbol, section). A failed retry
+        goes back on the heap with one more attempt, behind the retries of
+        its section with fewer attempts, at most max_retry times. Symbols
+        are not re-checked with driver.exist(), since only stocks have
+        history, financials and statistics results. The retries are a new
+        run of result_store; return the symbols retried other than summary,
+        which need preprocessing again."""
+    heap = [(RETRY_PRIORITY[section], attempts, symbol, section)
+            for symbol, section, _, attempts, _ in result_store.failures()
+            if section in RETRY_PRIORITY]
+    heapq.heapify(heap)
+    tools.log(f"Retrying {len(heap)} failed sections", debug)
+    result_store.start_run()
+
+    summary = []
+    while heap and heap[0][3] == "summary":
+        summary.append(heapq.heappop(heap)[2])
+    if summary:
+        run_summary(summary)
+
+    retries = defaultdict(int)
+    symbols = sorted({symbol for *_, symbol, _ in heap})
+    if not heap:
+        return symbols
+    with session() as driver:
+        while heap:
+            priority, attempts, symbol, section = heapq.heappop(heap)
+            driver.last_symbol_is_stock = True
+            driver.results.pop(symbol, None)
+            if (not try_crawl(getattr(driver, f"crawl_{section}"), symbol, section)
+                    or section in driver.results.get(symbol, {})):
+                retries[symbol, section] += 1
+                if retries[symbol, section] <= max_retry:
+                    heapq.heappush(heap, (priority, attempts + 1, symbol, section))
+    return symbols
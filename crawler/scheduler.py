@@ -0,0 +1,214 @@
+import time
+import itertools
+import traceback
+from collections import defaultdict
+from multiprocessing import Manager, Process, Queue
+
+from utils import tools
+from utils.metrics import metrics
+from crawler.pool import SessionPool
+
+
+def work(worker_id, make_driver, method, tasks, inflight, finished, progress,
+         deltas, debug):
+    """Pull batches from tasks and crawl them until a None sentinel arrives.
+
+        Each batch is crawled with a session leased from the worker's own
+        SessionPool, which keeps the browser warm between batches and runs.
+        method is the name of a driver method, or a function called with
+        (driver, batch). Metrics of each batch are sent to the parent
+        through deltas."""
+    metrics.reset() # forget what was inherited from the parent
+    pool = SessionPool(make_driver, debug=debug)
+    n, busy = 0, 0.
+    try:
+        while (task := tasks.get()) is not None:
+            batch_id, batch = task
+            inflight[worker_id] = task
+            start = time.time()
+            try:
+                with pool.session() as driver:
+                    if isinstance(method, str):
+                        getattr(driver, method)(batch)
+                    else:
+                        method(driver, batch)
+            except Exception:
+                tools.log(f"[{batch[0]}] Failure in worker {worker_id}: "
+                          f"{traceback.format_exc()}", debug,
+                          symbol=batch[0],
+                          stage=method if isinstance(method, str) else "crawl")
+            # send metrics before the batch counts as finished
+            deltas.append(metrics.snapshot())
+            metrics.reset()
+            finished[batch_id] = len(batch)
+            inflight.pop(worker_id, None)
+            n += len(batch)
+            busy += time.time() - start
+            progress[worker_id] = (n, busy)
+    finally:
+        pool.close()
+
+
+class CrawlScheduler:
+    """Crawl symbols with workers that pull batches from a shared queue.
+
+        Unlike striding symbols[i::k] over k processes, a fast worker keeps
+        taking work while a slow one (e.g. rebooting) holds only its current
+        batch. If a worker dies, its in-flight batch is put back on the queue
+        (at most max_requeue times) and a replacement worker is started. A
+        batch taken by a worker that died before marking it in flight is
+        requeued too, once the queue is empty and it has been seen neither
+        in flight nor finished on two polls in a row.
+        Workers outlive run(), so scheduled runs reuse their browser
+        sessions; call close() when done."""
+    def __init__(self, make_driver, method="crawl_summary", n_workers=4,
+                 batch_size=1, stagger=10, max_requeue=2, debug=False):
+        self.make_driver = make_driver # picklable function returning a driver
+        self.method = method
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.stagger = stagger # seconds between worker launches
+        self.max_requeue = max_requeue
+        self.max_restarts = 3 * n_workers # per run
+        self.debug = debug
+        self.manager = None
+        self.procs = {}
+        self.worker_ids = itertools.count()
+        self.batch_ids = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.manager is None:
+            self.manager = Manager()
+            self.tasks = Queue()
+            self.inflight = self.manager.dict()
+            self.finished = self.manager.dict()
+            self.progress = self.manager.dict() # worker_id -> (n_symbols, seconds)
+            self.deltas = self.manager.list() # metrics snapshots of batches
+
+    def spawn(self):
+        worker_id = next(self.worker_ids)
+        self.procs[worker_id] = Process(target=work,
+                                        args=(worker_id, self.make_driver,
+                                              self.method, self.tasks,
+                                              self.inflight, self.finished,
+                                              self.progress, self.deltas,
+                                              self.debug))
+        self.procs[worker_id].start()
+
+    def run(self, symbols, progress=None):
+        """Crawl symbols and return {worker_id : (n_symbols, seconds)} of this run.
+
+            If given, progress (utils.checkpoint.Progress) is stepped for
+            every symbol crawled and its reports are logged."""
+        symbols = list(symbols)
+        batches = {next(self.batch_ids) : symbols[i:i + self.batch_size]
+                   for i in range(0, len(symbols), self.batch_size)}
+        if not batches:
+            return {}
+
+        self.start()
+        before = dict(self.progress)
+        for task in batches.items():
+            self.tasks.put(task)
+
+        for i in range(len(self.procs), min(self.n_workers, len(batches))):
+            if i:
+                time.sleep(self.stagger)
+            self.spawn()
+
+        restarts, attempts = 0, defaultdict(int)
+        def remaining():
+            return [batch_id for batch_id in batches
+                    if batch_id not in self.finished]
+        def requeue(batch_id):
+            if attempts[batch_id] < self.max_requeue:
+                attempts[batch_id] += 1
+                self.tasks.put((batch_id, batches[batch_id]))
+            else:
+                tools.log(f"Giving up on {batches[batch_id]}", self.debug)
+                self.finished[batch_id] = 0
+        lost = set() # batches neither queued, in flight nor finished
+        done = 0 # symbols stepped in progress
+        def advance():
+            nonlocal done
+            n = len(symbols) - sum(len(batches[batch_id]) for batch_id in remaining())
+            for _ in range(done, n):
+                if report := progress.step():
+                    tools.log(f"Crawled {report}", self.debug)
+            done = n
+        while remaining() and self.procs:
+            if progress is not None:
+                advance()
+            for worker_id, proc in list(self.procs.items()):
+                if proc.is_alive():
+                    continue
+                # worker died before the run ended
+                proc.join()
+                del self.procs[worker_id]
+                restarts += 1
+                tools.log(f"Worker {worker_id} died "
+                          f"(exitcode={proc.exitcode})", self.debug)
+                task = self.inflight.pop(worker_id, None)
+                if task is not None and task[0] not in self.finished:
+                    requeue(task[0])
+                if restarts <= self.max_restarts:
+                    self.spawn()
+
+            # a worker may die between tasks.get() and marking its batch in
+            # flight, a live one marks it right after taking it
+            if self.tasks.empty():
+                claimed = {batch_id for batch_id, _ in self.inflight.values()}
+                unclaimed = {batch_id for batch_id in remaining()
+                             if batch_id not in claimed}
+                for batch_id in unclaimed & lost:
+                    tools.log(f"Batch {batches[batch_id]} lost by a worker", self.debug)
+                    requeue(batch_id)
+                lost = unclaimed - lost
+            else:
+                lost = set()
+            time.sleep(1)
+
+        if progress is not None:
+            advance()
+        if n := len(remaining()):
+            tools.log(f"No workers left, {n} batches not crawled", self.debug)
+        for batch_id in batches:
+            self.finished.pop(batch_id, None)
+        while len(self.deltas):
+            metrics.merge(self.deltas.pop(0))
+
+        report = {}
+        for worker_id, (n, seconds) in self.progress.items():
+            n0, seconds0 = before.get(worker_id, (0, 0.))
+            if n > n0:
+                report[worker_id] = (n - n0, seconds - seconds0)
+        self.log_report(report, len(symbols))
+        return report
+
+    def close(self):
+        """Stop workers (quitting their browsers) and the manager."""
+        if self.manager is None:
+            return
+        for _ in self.procs:
+            self.tasks.put(None)
+        for proc in self.procs.values():
+            proc.join()
+        self.procs = {}
+        self.manager.shutdown()
+        self.manager = None
+
+    def log_report(self, report, n_symbols):
+        total = 0
+        for worker_id, (n, seconds) in sorted(report.items()):
+            total += n
+            rate = 60 * n / seconds if seconds else 0
+            tools.log(f"Worker {worker_id}: {n} symbols in {seconds:.0f}s "
+                      f"({rate:.2f} symbols/min)", self.debug)
+        tools.log(f"Crawled {total}/{n_symbols} symbols with "
+                  f"{len(report)} workers", self.debug)
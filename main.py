@@ -3,16 +3,26 @@ import time
 import argparse
 import traceback
 from datetime import datetime
+from functools import partial
 from os import cpu_count, path
 
-from multiprocessing import Process
-
 import schedule
 import pandas as pd
 
+from crawler.aio import AsyncCrawler
 from crawler.crawler import ChromeDriver
+from crawler.fetcher import fetchers, get_fetcher
+from crawler.parser import parsers
+from crawler.pool import SessionPool
+from crawler.replay import FixtureStore, RecordingFetcher, ReplayFetcher
+from crawler.retry import retry_failures
+from crawler.scheduler import CrawlScheduler
 from crawler.preprocessor import init_process
-from utils import tools, DATADIR, PROFILEPATH, PROFILEBACKPATH
+from utils import (tools, storage, logger, DATADIR, FIXTUREDIR, METRICSPATH, PROFILEPATH,
+                   PROFILEBACKPATH)
+from utils.checkpoint import Checkpoint, Progress
+from utils.metrics import metrics
+from utils.results import ResultStore
 
 
 def create_profile():
@@ -36,66 +46,145 @@ def create_profile():
 
 
 def try_crawl(crawl_fn, symbol, fn_name):
+    start = time.perf_counter()
     try:
-        crawl_fn(symbol)
+        with metrics.timer("crawler_symbol_seconds", section=fn_name):
+            crawl_fn(symbol)
     except Exception as e:
-        tools.log(f"[{symbol}] Failure crawling {fn_name}: {e}", debug)
+        metrics.inc("crawler_errors_total", section=fn_name)
+        result_store.add(symbol, fn_name, None, time.perf_counter() - start,
+                         f"{type(e).__name__}: {e}")
+        tools.log(f"[{symbol}] Failure crawling {fn_name}: {e}", debug,
+                  symbol=symbol, stage=fn_name)
         traceback.print_exc()
+        return False
+    return True
 
 
-def download_historical_data(symbols):
-    if not process_only:
-        # Initialize driver
-        driver = ChromeDriver(init, debug, headless)
-
-        # Main loop for initial crawling
-        for i, symbol in enumerate(symbols):
-                if not driver.exist(symbol):
-                    continue
+# sections of the initial crawl, in the order they are crawled
+INIT_SECTIONS = ("history", "financials", "statistics")
 
-                if driver.last_symbol_is_stock:
-                    # crawl Historical Data section
-                    try_crawl(driver.crawl_history, symbol, "history")
-                    # crawl Financials section
-                    try_crawl(driver.crawl_financials, symbol, "financials")
-                    # crawl Statistics section
-                    try_crawl(driver.crawl_statistics, symbol, "statistics")
 
-                driver.reset_last_symbol_info()
+def crawl_init(driver, symbol, checkpoint):
+    """Crawl the sections of symbol not in checkpoint, adding those completed."""
+    if not driver.exist(symbol):
+        stock = False
+    else:
+        if stock := driver.last_symbol_is_stock:
+            for section in INIT_SECTIONS:
+                if (symbol, section) in checkpoint:
+                    continue
+                # crawl Historical Data, Financials or Statistics section
+                if (try_crawl(getattr(driver, f"crawl_{section}"), symbol, section)
+                        and section not in driver.results.get(symbol, {})):
+                    checkpoint.done(symbol, section)
+        driver.reset_last_symbol_info()
 
-        # quit driver
-        driver.quit()
+    if stock is False: # nothing to crawl, unlike a page that did not load (None)
+        for section in INIT_SECTIONS:
+            checkpoint.done(symbol, section)
 
-        tools.log("Failed results:", debug)
-        tools.json_dump(driver.results, debug)
 
-    init_process(symbols, init, debug)
+def crawl_init_batch(driver, symbols, checkpoint):
+    """Crawl symbols in a worker of the initial crawl, syncing checkpoint after."""
+    for symbol in symbols:
+        crawl_init(driver, symbol, checkpoint)
+    checkpoint.sync()
 
 
-def crawl_summary_helper(symbols):
-    driver = ChromeDriver(init, debug, headless)
-    driver.crawl_summary(symbols)
-    driver.quit()
+def download_historical_data(symbols):
+    if not process_only:
+        result_store.start_run()
+        # resume an interrupted initial crawl from its checkpoint
+        with Checkpoint() as checkpoint:
+            progress = Progress(len(symbols))
+            pending = []
+            for symbol in symbols:
+                if all((symbol, section) in checkpoint for section in INIT_SECTIONS):
+                    progress.step(skipped=True)
+                else:
+                    pending.append(symbol)
+            tools.log(f"Initial crawl: {progress}", debug)
+
+            if init_workers > 1:
+                # signed-in sessions pulling symbols from a shared queue, each
+                # downloading to its own directory and appending to the journal
+                with CrawlScheduler(partial(make_driver, isolate_downloads=True),
+                                    partial(crawl_init_batch, checkpoint=checkpoint),
+                                    n_workers=init_workers, debug=debug) as init_scheduler:
+                    init_scheduler.run(pending, progress)
+            else:
+                with sessions.session() as driver:
+                    # Main loop for initial crawling
+                    for symbol in pending:
+                        crawl_init(driver, symbol, checkpoint)
+                        if report := progress.step():
+                            tools.log(f"Initial crawl: {report}", debug)
+            # keep the journal if a batch was given up on or a section failed
+            if missing := checkpoint.missing(symbols, INIT_SECTIONS):
+                tools.log(f"Initial crawl: {len(missing)} sections not crawled, "
+                          f"kept in the checkpoint", debug)
+            else:
+                checkpoint.clear() # went through all symbols
+
+        tools.log("Results:", debug)
+        tools.json_dump(result_store.finish_run(), debug)
+
+    init_process(symbols, init, debug, workers, force=force_process)
+    metrics.dump(METRICSPATH)
+
+
+def make_driver(isolate_downloads=False, signin=False):
+    if replay:
+        fetcher_ = ReplayFetcher(FixtureStore(replay))
+    elif record:
+        fetcher_ = RecordingFetcher(get_fetcher(fetcher), FixtureStore(record))
+    else:
+        fetcher_ = fetcher
+    return ChromeDriver(init or signin, debug, headless, fetcher_, html_parser,
+                        result_store, isolate_downloads)
+
+
+def run_summary(symbols):
+    if async_crawl:
+        with sessions.session() as driver:
+            AsyncCrawler(driver, concurrency, rate).crawl_summary(symbols)
+    else:
+        scheduler.run(symbols)
 
 
 def crawl_summary(symbols):
     if __name__ == "__main__":
-        jobs = []
-        k = cpu_count()
-        for i in range(k):
-            jobs.append(Process(target=crawl_summary_helper,
-                                args=(symbols[i:len(symbols):k],)))
-            jobs[-1].start()
-            time.sleep(10)
-        while jobs:
-            jobs.pop().join()
+        result_store.start_run()
+        run_summary(symbols)
+        # one report of the run, merged from every crawl worker
+        tools.log("Results:", debug)
+        tools.json_dump(result_store.finish_run(), debug)
+        metrics.dump(METRICSPATH)
+
+
+def crawl_failed(max_retry=2):
+    """Re-crawl only the (symbol, section)s that failed in the last run.
+
+        Sections other than summary are downloaded by a signed-in session,
+        as in the initial crawl (e.g. income statements need it), and their
+        symbols are preprocessed again afterwards."""
+    signed_in = SessionPool(partial(make_driver, signin=True), debug=debug)
+    try:
+        symbols = retry_failures(result_store, signed_in.session, run_summary,
+                                 try_crawl, max_retry, debug)
+    finally:
+        signed_in.close()
+    tools.log("Results:", debug)
+    tools.json_dump(result_store.finish_run(), debug)
+    if symbols:
+        init_process(symbols, init, debug, workers, force=force_process)
+    metrics.dump(METRICSPATH)
 
 
 def crawl_profile_info_helper(symbols):
-    driver = ChromeDriver(init, debug, headless)
-    res = driver.crawl_profile_info(symbols)
-    driver.quit()
-    return res
+    with sessions.session() as driver:
+        return driver.crawl_profile_info(symbols)
 
 
 def parse_args():
@@ -110,6 +199,8 @@ def parse_args():
                        help="Override stock_profile.csv")
     parser.add_argument("--process-only", action="store_true", dest="process_only",
                        help="Skip crawling")
+    parser.add_argument("--force-process", action="store_true", dest="force_process",
+                       help="Preprocess all files, also those unchanged since the last run")
     parser.add_argument("--force-summary", action="store_true", dest="force_summary",
                        help="Run crawler to get summary.csv")
     parser.add_argument("--k", action="store", default=None, dest="k",
@@ -118,7 +209,56 @@ def parse_args():
                        help="Run crawler in headless mode")
     parser.add_argument("--profile-info", action="store_true", dest="profile_info",
                        help="Crawl profile info")
-    return parser.parse_args()
+    parser.add_argument("--workers", action="store", type=int, default=1, dest="workers",
+                       help="Number of processes for preprocessing")
+    parser.add_argument("--init-workers", action="store", type=int, default=1,
+                       dest="init_workers",
+                       help="Number of signed-in browser sessions for initial crawling")
+    parser.add_argument("--crawl-workers", action="store", type=int, default=cpu_count(),
+                       dest="crawl_workers",
+                       help="Number of browser processes for crawling summary")
+    parser.add_argument("--fetcher", action="store", default="http", dest="fetcher",
+                       choices=list(fetchers),
+                       help="Fetch static pages over plain HTTP or only with Chrome")
+    parser.add_argument("--parser", action="store", default=None, dest="html_parser",
+                       choices=list(parsers),
+                       help="Select html parser of summary and statistics pages")
+    parser.add_argument("--record", action="store", nargs="?", const=FIXTUREDIR,
+                       default=None, dest="record",
+                       help="Save fetched pages to a fixture directory")
+    parser.add_argument("--replay", action="store", nargs="?", const=FIXTUREDIR,
+                       default=None, dest="replay",
+                       help="Crawl summary and statistics offline from a fixture "
+                            "directory (not with --init, --retry-failed or --profile-info)")
+    parser.add_argument("--retry-failed", action="store_true", dest="retry_failed",
+                       help="Re-crawl only the sections that failed in the last run")
+    parser.add_argument("--async", action="store_true", dest="async_crawl",
+                       help="Crawl summary with asyncio over HTTP instead of Chrome")
+    parser.add_argument("--concurrency", action="store", type=int, default=32,
+                       dest="concurrency",
+                       help="Number of concurrent requests with --async")
+    parser.add_argument("--rate", action="store", type=float, default=5, dest="rate",
+                       help="Most requests per second per host with --async")
+    parser.add_argument("--metrics-port", action="store", type=int, default=None,
+                       dest="metrics_port",
+                       help="Serve Prometheus metrics on this port while scheduled")
+    parser.add_argument("--metrics-host", action="store", default="127.0.0.1",
+                       dest="metrics_host",
+                       help="Address to serve metrics on (0.0.0.0 for all interfaces)")
+    parser.add_argument("--store", action="store", default="csv", dest="store",
+                       choices=list(storage.stores),
+                       help="Select storage backend for company data")
+    parser.add_argument("--migrate-store", action="store_true", dest="migrate_store",
+                       help="Copy existing .csv files into the selected store")
+    args = parser.parse_args()
+    # only summary and statistics pages are recorded, downloads need Chrome online
+    online = [flag for flag, on in [("--init", args.init),
+                                    ("--retry-failed", args.retry_failed),
+                                    ("--profile-info", args.profile_info)] if on]
+    if args.replay and online:
+        parser.error(f"--replay only crawls summary and statistics offline, "
+                     f"it cannot be used with {', '.join(online)}")
+    return args
 
 parser = parse_args()
 # switches
@@ -127,12 +267,36 @@ debug = parser.debug # run with first 5 symbols
 schedule_crawler = not parser.no_schedule
 override_profile = parser.override_profile
 process_only = parser.process_only
+force_process = parser.force_process
 force_summary = parser.force_summary
 k = parser.k
 headless = not parser.no_headless
 profile_info = parser.profile_info
+migrate_store = parser.migrate_store
+workers = parser.workers
+init_workers = parser.init_workers
+crawl_workers = parser.crawl_workers
+fetcher = parser.fetcher
+html_parser = parser.html_parser
+record = parser.record
+replay = parser.replay
+retry_failed = parser.retry_failed
+async_crawl = parser.async_crawl
+concurrency = parser.concurrency
+rate = parser.rate
+metrics_port = parser.metrics_port
+metrics_host = parser.metrics_host
+tools.set_store(parser.store)
+# results of every crawl process, kept across runs
+result_store = ResultStore()
+# browser sessions of this process and of the summary workers, kept warm between runs
+sessions = SessionPool(make_driver, debug=debug)
+scheduler = CrawlScheduler(make_driver, "crawl_summary", n_workers=crawl_workers,
+                           debug=debug)
 
 if __name__ == "__main__":
+    if not debug:
+        logger.start() # before forking workers, so that they share one writer
     tools.log("=" * 42, debug)
     today = datetime.today()
     # Check https://docs.python.org/3/reference/lexical_analysis.html#f-strings for f-string
@@ -147,17 +311,25 @@ if __name__ == "__main__":
     if not path.exists(PROFILEPATH) or override_profile:
         create_profile()
 
+    if migrate_store and tools.store.name != "csv":
+        n = storage.migrate(tools.store, symbols if (k or debug) else None)
+        tools.log(f"Migrated {n} files to {tools.store.name} store", debug)
+
     if profile_info:
         res = crawl_profile_info_helper(symbols)
         pd.DataFrame(res).to_csv("tmp.csv")
         if override_profile:
             # store stock and currency information in stock_profile.csv
-            profiledf = tools.path2df(PROFILEPATH)
+            profiledf = tools.path2df(PROFILEPATH).copy()
             profiledf["Stock"] = res["Stock"]
             profiledf["Currency"] = res["Currency"]
             tools.to_csv(profiledf, PROFILEPATH, index=False)
 
-    if init or process_only:
+    if retry_failed:
+        crawl_failed()
+        init = False
+
+    elif init or process_only:
         download_historical_data(symbols)
         init = False
 
@@ -165,6 +337,8 @@ if __name__ == "__main__":
         crawl_summary(symbols)
 
     if not debug and schedule_crawler:
+        if metrics_port:
+            metrics.serve(metrics_port, metrics_host)
         schedule.every().monday.at("19:00").do(crawl_summary, symbols)
         schedule.every().tuesday.at("19:00").do(crawl_summary, symbols)
         schedule.every().wednesday.at("19:00").do(crawl_summary, symbols)
@@ -175,3 +349,6 @@ if __name__ == "__main__":
         while True:
             schedule.run_pending()
             time.sleep(1)
+
+    scheduler.close()
+    sessions.close()
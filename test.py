@@ -1,18 +1,74 @@
 # WRITE TEST
+import io
 import os
+import json
+import shutil
+import tempfile
+import warnings
 from datetime import datetime
+from functools import partial
+from urllib.request import urlopen
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from threading import Thread
 from multiprocessing import Process
-from crawler.preprocessor import init_process
-from crawler.crawler import ChromeDriver
-from utils import tools, DATADIR, PROFILEPATH, PROFILEBACKPATH
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import benchmark
+from crawler.preprocessor import (init_process, convert_dtypes, annualize, to_panel,
+                                  to_numeric, to_numeric_vectorized, month2digit,
+                                  process_text_symbol, convert_symbol)
+from crawler.aio import AsyncCrawler
+from crawler.crawler import ChromeDriver, SUMMARY_SECTIONS, STATISTICS_SECTIONS
+from crawler.fetcher import HTTPFetcher
+from crawler.pool import SessionPool
+from crawler import scheduler
+from crawler.scheduler import CrawlScheduler
+from crawler.parser import parsers, get_parser
+from crawler.replay import FixtureStore, RecordingFetcher, ReplayFetcher
+from crawler.retry import retry_failures
+from utils import (tools, logger, reader, storage, DATADIR, COMPANYDIR, LOGPATH, MAPPINGPATH,
+                   PROFILEPATH, PROFILEBACKPATH)
+from utils.cache import FileCache
+from utils.checkpoint import Checkpoint, Progress
+from utils.history import HistoryStore
+from utils.metrics import Metrics, metrics
+from utils.panel import load_panel
+from utils.results import ResultStore
+
+# fixtures copied into the working directory of tests that crawl
+FIXTURES = os.path.join("crawler", "fixtures")
+
+@contextmanager
+def workdir(*relpaths):
+    """Run in a temporary directory holding mapping.json and copies of relpaths."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for relpath in (MAPPINGPATH,) + relpaths:
+            if os.path.isdir(relpath):
+                shutil.copytree(relpath, os.path.join(tmpdir, relpath))
+            else:
+                os.makedirs(os.path.join(tmpdir, os.path.dirname(relpath)), exist_ok=True)
+                shutil.copyfile(relpath, os.path.join(tmpdir, relpath))
+        os.chdir(tmpdir)
+        try:
+            yield tmpdir
+        finally:
+            os.chdir(cwd)
 
 def test_sequential_crawl_summary():
     init, debug, headless = False, True, True
-    driver = ChromeDriver(init, debug, headless)
+    pool = SessionPool(lambda: ChromeDriver(init, debug, headless))
     symbols = ["AAPL", "TDOC", "NKLA"]
 
-    driver.crawl_summary(symbols)
-    driver.crawl_summary(symbols)
+    # the second run reuses the browser of the first
+    with pool.session() as driver:
+        driver.crawl_summary(symbols)
+    with pool.session() as driver:
+        driver.crawl_summary(symbols)
+    pool.close()
 
     for symbol in symbols:
         df = tools.get_df("summary", symbol, debug=True)
@@ -26,9 +82,10 @@ def test_sequential_crawl_summary():
 # test_sequential_crawl_summary()
 
 def crawl_summary_helper(symbols, init, debug, headless):
-    driver = ChromeDriver(init, debug, headless)
-    driver.crawl_summary(symbols)
-    driver.quit()
+    pool = SessionPool(lambda: ChromeDriver(init, debug, headless))
+    with pool.session() as driver:
+        driver.crawl_summary(symbols)
+    pool.close()
 
 def test_parallel_crawl_summary():
     if __name__ == "__main__":
@@ -59,3 +116,787 @@ def test_parallel_crawl_summary():
 
 # test parallel crawling
 test_parallel_crawl_summary()
+
+def test_convert_dtypes_golden():
+    """Compare convert_dtypes against outputs recorded from the per-cell implementation."""
+    with open(os.path.join("crawler", "fixtures", "convert_dtypes_golden.json")) as r_obj:
+        cases = json.load(r_obj)
+
+    for case in cases:
+        n_rows = len(next(iter(case["input"].values())))
+        # as recorded, and tiled to a long column
+        for repeat in [1, -(-1024 // n_rows)]:
+            df = pd.DataFrame({col : pd.Series([np.nan if v is None else v
+                                                for v in values] * repeat, dtype="object")
+                               for col, values in case["input"].items()})
+            convert_dtypes(df)
+            for col, expected in case["expected"].items():
+                name = f"{case['name']}/{col} x{repeat}"
+                expected = {**expected, "values" : expected["values"] * repeat}
+                if expected["dtype"] == "datetime":
+                    assert df[col].dtype.kind == "M", f"{name} is not datetime"
+                    values = [None if pd.isnull(v) else v.strftime("%Y-%m-%d")
+                              for v in df[col]]
+                else:
+                    assert str(df[col].dtype) == expected["dtype"], \
+                        f"{name} has dtype {df[col].dtype}, expected {expected['dtype']}"
+                    values = [None if pd.isnull(v) else v for v in df[col]]
+                assert values == expected["values"], \
+                    f"{name}: {values[:12]} != {expected['values'][:12]}"
+
+# test golden outputs of convert_dtypes
+test_convert_dtypes_golden()
+
+def test_to_numeric_fuzz():
+    """Compare to_numeric_vectorized with to_numeric per value on random cells."""
+    rng = np.random.default_rng(0)
+    pieces = ["", "-", "+", ".", ",", "0", "1", "12", "345", "6,789", "%", "M", "B", "T",
+              "k", "e", "N/A", " ", "1.2.3"]
+    for _ in range(5):
+        cells = ["".join(rng.choice(pieces, rng.integers(1, 5)))
+                 for _ in range(2048)]
+        series = pd.Series([np.nan if cell == "" else cell for cell in cells],
+                           dtype="object")
+        expected = series.apply(to_numeric)
+        res = to_numeric_vectorized(series)
+        # per value, numbers beyond int64 come back as uint64 and leave objects
+        if expected.dtype != "object":
+            assert res.dtype == expected.dtype, f"ERROR: {res.dtype} != {expected.dtype}"
+        expected = expected.astype("float64")
+        differ = ~((res == expected) | (res.isna() & expected.isna()))
+        assert not differ.any(), f"ERROR: {list(series[differ][:5])} converted differently"
+
+# test the vectorized conversion on random cells
+test_to_numeric_fuzz()
+
+def convert_dtypes_per_value(df):
+    """convert_dtypes as it was before vectorizing, one value at a time."""
+    def digitize_month(text):
+        if not isinstance(text, str):
+            return text
+        for month in month2digit.keys():
+            if month in text:
+                text = text.replace(month, month2digit[month])
+                break
+        return text
+
+    for col in df:
+        if tools.col2dtype.get(col) == "datetime":
+            df[col] = df[col].apply(digitize_month).apply(pd.to_datetime, errors="coerce")
+        elif col not in tools.col2dtype and df[col].dtype == "object":
+            df[col] = df[col].apply(to_numeric)
+
+def test_convert_dtypes_per_value():
+    """Compare convert_dtypes with the per-value version on statement-sized frames."""
+    rng = np.random.default_rng(1)
+    numbers = ["1.2B", "-3.45M", "678k", "1.5T", "12,345", "-0.5", "3", "12.5%", "-1%",
+               "N/A", "-", "1,2%", "∞", np.nan]
+    dates = ["Sep 26, 2020", "12/31/2020", "2020-06-30", "31 Mar 2021", "Mar 2021",
+             "2021-03-31T00:00:00", "N/A", np.nan]
+    for n_rows in [1, 4, 8, 40, 3000]:
+        df = pd.DataFrame({"Total Revenue" : rng.choice(numbers, n_rows),
+                           "Net Income" : rng.choice(numbers[:7], n_rows),
+                           "Most Recent Quarter" : rng.choice(dates, n_rows),
+                           "Fiscal Year Ends" : [dates[0]] * n_rows},
+                          dtype="object")
+        expected = df.copy()
+        with warnings.catch_warnings(): # per element parsing warns in newer pandas
+            warnings.simplefilter("ignore", UserWarning)
+            convert_dtypes_per_value(expected)
+        convert_dtypes(df)
+        for col in df:
+            name = f"{col} x{n_rows}"
+            if col in tools.col2dtype:
+                assert df[col].dtype.kind == "M", f"{name} is not datetime"
+                assert (pd.isna(df[col]) == pd.isna(expected[col])).all() \
+                    and (df[col].dropna() == expected[col].dropna()).all(), \
+                    f"{name}: {list(df[col][:8])} != {list(expected[col][:8])}"
+            else:
+                assert df[col].dtype == expected[col].dtype, \
+                    f"{name} has dtype {df[col].dtype}, expected {expected[col].dtype}"
+                assert df[col].equals(expected[col]), f"{name} converted differently"
+
+# test convert_dtypes against converting per value
+test_convert_dtypes_per_value()
+
+def serve_fixtures():
+    """Start a stand-in for finance.yahoo.com serving crawler/fixtures/pages."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fixture = os.path.join("crawler", "fixtures", "pages",
+                                   self.path.split("?")[0].strip("/") + ".html")
+            if not os.path.exists(fixture):
+                return self.send_error(404)
+            with open(fixture, "rb") as r_obj:
+                body = r_obj.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_http_crawl_summary():
+    with workdir(FIXTURES):
+        server = serve_fixtures()
+        fetcher = HTTPFetcher(host=f"http://127.0.0.1:{server.server_port}")
+        pool = SessionPool(lambda: ChromeDriver(False, True, fetcher=fetcher),
+                           max_pages=1)
+        with pool.session() as driver:
+            driver.sleep = lambda t=6: None
+            driver.crawl_summary(["AAPL"])
+        server.shutdown()
+
+        assert driver._driver is None, "Chrome started for static pages"
+        with pool.session() as reused:
+            assert reused is driver, "session not reused"
+            reused.pages = pool.max_pages
+        with pool.session() as recycled:
+            assert recycled is not driver, "worn out session not recycled"
+        pool.close()
+        df = tools.get_df("summary", "AAPL", debug=True)
+        assert df.index[0] == tools.get_today(), "AAPL has wrong date in the first row"
+        for col in ["Ask", "EPS", "Earnings Date", "Short Ratio", "Market Cap"]:
+            assert col in df.columns, f"ERROR: AAPL has no {col}"
+
+# test crawling against recorded pages
+test_http_crawl_summary()
+
+def test_parsers_agree():
+    """Every html parser must return what bs4 returns on the fixture pages."""
+    pages = os.path.join("crawler", "fixtures", "pages", "quote")
+    with open(os.path.join(pages, "AAPL.html")) as r_obj:
+        summary = r_obj.read()
+    with open(os.path.join(pages, "AAPL", "key-statistics.html")) as r_obj:
+        statistics = r_obj.read()
+
+    expected = {}
+    get_parser("bs4").parse_summary(summary, expected)
+    get_parser("bs4").parse_statistics(statistics, expected,
+                                       SUMMARY_SECTIONS | STATISTICS_SECTIONS)
+    for name in parsers:
+        data = {}
+        get_parser(name).parse_summary(summary, data)
+        get_parser(name).parse_statistics(statistics, data,
+                                          SUMMARY_SECTIONS | STATISTICS_SECTIONS)
+        assert list(data.items()) == list(expected.items()), f"{name} differs from bs4"
+
+# test html parsers against each other
+test_parsers_agree()
+
+def test_replay_crawl_summary():
+    """Record pages from the stand-in server, then crawl them offline."""
+    with workdir(FIXTURES):
+        server = serve_fixtures()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = FixtureStore(tmpdir)
+            recorder = RecordingFetcher(
+                HTTPFetcher(host=f"http://127.0.0.1:{server.server_port}"), store)
+            ChromeDriver(False, True, fetcher=recorder).crawl_summary(["AAPL"])
+            server.shutdown()
+            assert store.symbols("summary") == store.symbols("statistics") == ["AAPL"]
+
+            driver = ChromeDriver(False, True, fetcher=ReplayFetcher(store))
+            driver.crawl_summary(["AAPL", "NOPE"])
+
+        assert driver._driver is None, "Chrome started while replaying"
+        assert list(driver.results) == ["NOPE"], "unrecorded symbol did not fail"
+        df = tools.get_df("summary", "AAPL", debug=True)
+        for col in ["Ask", "EPS", "Earnings Date", "Short Ratio", "Market Cap"]:
+            assert col in df.columns, f"ERROR: AAPL has no {col}"
+
+# test crawling recorded pages offline
+test_replay_crawl_summary()
+
+def test_metrics():
+    """Check that a replayed crawl is timed and that snapshots merge."""
+    with workdir(FIXTURES):
+        metrics.reset()
+        driver = ChromeDriver(False, True, fetcher=ReplayFetcher())
+        driver.crawl_summary(["AAPL"])
+        histograms = metrics.to_dict()["histograms"]
+        for name in ['crawler_page_load_seconds{endpoint="summary",source="fetcher"}',
+                     'crawler_parse_seconds{page="summary"}',
+                     'crawler_symbol_seconds{section="summary"}']:
+            assert histograms[name]["count"] > 0, f"ERROR: {name} not observed"
+
+        merged = Metrics()
+        merged.merge(metrics.snapshot())
+        merged.merge(metrics.snapshot())
+        counters = metrics.to_dict()["counters"]
+        for name, value in merged.to_dict()["counters"].items():
+            assert value == 2 * counters[name], f"ERROR: {name} not merged"
+        assert "crawler_page_load_seconds_bucket" in merged.prometheus()
+
+    server = merged.serve(0)
+    try:
+        host, port = server.server_address
+        with urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert host == "127.0.0.1", f"ERROR: metrics served on {host}"
+    assert "crawler_page_load_seconds_bucket" in body
+
+# test metrics of a crawl
+test_metrics()
+
+def test_async_crawl_summary():
+    """Crawl recorded pages concurrently and check the rate and pool per host."""
+    with workdir(FIXTURES) as tmpdir:
+        result_store = ResultStore(os.path.join(tmpdir, "result.db"))
+        result_store.start_run()
+        driver = ChromeDriver(False, True, fetcher=ReplayFetcher(),
+                              result_store=result_store)
+        crawler = AsyncCrawler(driver, concurrency=4, rate=50)
+        crawler.crawl_summary(["AAPL", "NOPE", "NOPE2"])
+        df = tools.get_df("summary", "AAPL", debug=True)
+        report = result_store.finish_run()
+        result_store.close()
+
+    assert driver._driver is None, "Chrome started while replaying"
+    assert sorted(driver.results) == ["NOPE", "NOPE2"], "unrecorded symbols did not fail"
+    assert report["sections"]["summary"] == {**report["sections"]["summary"],
+                                             "ok" : 1, "failed" : 2}
+    assert df.index[0] == tools.get_today(), "AAPL has wrong date in the first row"
+    for col in ["Ask", "EPS", "Earnings Date", "Short Ratio", "Market Cap"]:
+        assert col in df.columns, f"ERROR: AAPL has no {col}"
+
+    # summary and statistics pages share the rate of their host, at most --rate
+    assert list(crawler.limiters) == ["finance.yahoo.com"], f"ERROR: {crawler.limiters}"
+    limiter = crawler.limiters["finance.yahoo.com"]
+    assert limiter.max_rate == 50 and max(limiter.rates.values()) <= 50
+
+    fetcher = HTTPFetcher()
+    AsyncCrawler(ChromeDriver(False, True, fetcher=fetcher), concurrency=32)
+    assert fetcher.pool.connection_pool_kw["maxsize"] == 32, "ERROR: pool not resized"
+
+# test crawling recorded pages concurrently
+test_async_crawl_summary()
+
+def test_logger():
+    """Check that records from several processes reach one json lines log."""
+    def log_symbols(i):
+        for j in range(100):
+            tools.log(f"[S{i}] Crawled summary", verbose=False,
+                      symbol=f"S{i}", stage="summary", duration=j)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger.stop()
+        logger.start(logpath := os.path.join(tmpdir, "log.jsonl"))
+        procs = [Process(target=log_symbols, args=(i,)) for i in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        logger.stop()
+        with open(logpath) as r_obj:
+            records = [json.loads(line) for line in r_obj]
+
+    assert len(records) == 400, f"ERROR: {len(records)} records logged"
+    for i in range(4):
+        durations = [r["duration"] for r in records if r["symbol"] == f"S{i}"]
+        assert durations == list(range(100)), f"ERROR: records of S{i} lost"
+
+    # without a listener, records go to stderr instead of a second writer
+    with workdir(), redirect_stderr(io.StringIO()) as stderr:
+        tools.log("[S0] Crawled summary", verbose=False, symbol="S0")
+        assert not os.path.exists(LOGPATH), "ERROR: log written without a listener"
+    logger.logger.handlers = [] # the handler holds the redirected stream
+    assert json.loads(stderr.getvalue())["symbol"] == "S0"
+
+# test logging from several processes
+test_logger()
+
+def test_result_store():
+    """Check that results of crawl processes end up in one report."""
+    def crawl(symbols, result_store):
+        ChromeDriver(False, True, fetcher=ReplayFetcher(),
+                     result_store=result_store).crawl_summary(symbols)
+
+    with workdir(FIXTURES):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result_store = ResultStore(os.path.join(tmpdir, "result.db"))
+            result_store.start_run()
+            procs = [Process(target=crawl, args=(symbols, result_store))
+                     for symbols in [["AAPL", "NOPE"], ["AAPL", "NOPE2"]]]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+            report = result_store.finish_run()
+
+            # a retry run of the failures is what is retried next
+            failures = [symbol for symbol, *_ in result_store.failures()]
+            result_store.start_run()
+            crawl(["AAPL", "NOPE"], result_store)
+            retried = [symbol for symbol, *_ in result_store.failures()]
+            result_store.close()
+
+        assert report["sections"]["summary"]["ok"] == 1
+        assert report["sections"]["summary"]["failed"] == 2
+        assert report["sections"]["summary"]["retried"] == 1, "AAPL attempts not merged"
+        for symbol in ["NOPE", "NOPE2"]:
+            failure = report["failed"][symbol]["summary"]
+            assert failure["result"] == [False, False], f"ERROR: {symbol} {failure}"
+            assert "failed to load" in failure["reason"], f"ERROR: {symbol} {failure}"
+        assert failures == ["NOPE", "NOPE2"], f"ERROR: failures {failures}"
+        assert retried == ["NOPE"], f"ERROR: failures after retry {retried}"
+
+# test results shared by crawl processes
+test_result_store()
+
+def test_checkpoint():
+    """Check that completed units survive a crash, also mid-line."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inpath = os.path.join(tmpdir, "checkpoint.txt")
+        checkpoint = Checkpoint(inpath, every=2)
+        for symbol in ["AAPL", "MSFT", "TSLA"]:
+            checkpoint.done(symbol, "history")
+        # crash: TSLA is not synced yet, a unit is cut short
+        with open(inpath, "a") as w_obj:
+            w_obj.write("AMZN\thist")
+
+        resumed = Checkpoint(inpath)
+        assert resumed.completed == {("AAPL", "history"), ("MSFT", "history")}
+        parent = Checkpoint(inpath) # of workers journaling units
+        resumed.done("TSLA", "history")
+        resumed.sync()
+        assert ("TSLA", "history") in Checkpoint(inpath), "ERROR: unit lost"
+        missing = parent.missing(["AAPL", "MSFT", "TSLA", "AMZN"], ["history"])
+        assert missing == [("AMZN", "history")], f"ERROR: missing {missing}"
+        resumed.clear()
+        assert not Checkpoint(inpath).completed
+
+# test checkpoint of the initial crawl
+test_checkpoint()
+
+def journal_download_dir(driver, symbols, checkpoint):
+    for symbol in symbols:
+        checkpoint.done(symbol, driver.download_dir)
+    checkpoint.sync()
+
+def test_parallel_init_workers():
+    """Check that workers of the initial crawl download to their own directory."""
+    symbols = [f"S{i}" for i in range(12)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint = Checkpoint(os.path.join(tmpdir, "checkpoint.txt"))
+        progress = Progress(len(symbols))
+        make_driver = partial(ChromeDriver, False, True, fetcher=ReplayFetcher(),
+                              isolate_downloads=True)
+        with CrawlScheduler(make_driver,
+                            partial(journal_download_dir, checkpoint=checkpoint),
+                            n_workers=3, stagger=0, debug=True) as scheduler:
+            scheduler.run(symbols, progress)
+        journal = Checkpoint(checkpoint.inpath).completed
+
+    assert sorted(symbol for symbol, _ in journal) == sorted(symbols)
+    download_dirs = {download_dir for _, download_dir in journal}
+    assert 1 < len(download_dirs) <= 3, f"ERROR: download dirs {download_dirs}"
+    assert progress.done == len(symbols), f"ERROR: progress {progress}"
+
+# test workers of the initial crawl
+test_parallel_init_workers()
+
+class FakeDriver:
+    """Stand-in for ChromeDriver leased by SessionPool."""
+    def __init__(self):
+        self._driver = None
+        self.pages = 0
+        self.results = {}
+
+    def quit(self):
+        pass
+
+def crawl_or_die(driver, symbols, checkpoint):
+    """Journal symbols, but exit the worker on the first attempt at 'DIE'."""
+    if symbols == ["DIE"] and not os.path.exists(marker := f"{checkpoint.inpath}.died"):
+        open(marker, "w").close()
+        os._exit(1)
+    journal_download_dir(driver, symbols, checkpoint)
+
+def test_scheduler_dead_workers():
+    """Check that batches of dead workers, also unmarked ones, are crawled by others."""
+    def work(worker_id, make_driver, method, tasks, *args):
+        if worker_id == 0: # takes a batch and dies before marking it in flight
+            tasks.get()
+            os._exit(1)
+        return scheduler_work(worker_id, make_driver, method, tasks, *args)
+
+    symbols = [f"S{i}" for i in range(6)] + ["DIE"]
+    scheduler_work, scheduler.work = scheduler.work, work
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = Checkpoint(os.path.join(tmpdir, "checkpoint.txt"))
+            FakeDriver.download_dir = tmpdir
+            with CrawlScheduler(FakeDriver,
+                                partial(crawl_or_die, checkpoint=checkpoint),
+                                n_workers=2, stagger=0, debug=True) as scheduler_:
+                scheduler_.run(symbols)
+            journal = Checkpoint(checkpoint.inpath).completed
+    finally:
+        scheduler.work = scheduler_work
+    assert sorted(symbol for symbol, _ in journal) == sorted(symbols), \
+        f"ERROR: crawled {sorted(journal)}"
+
+# test requeueing batches of dead workers
+test_scheduler_dead_workers()
+
+def test_retry_failures():
+    """Check that only failed sections are retried, summary first and together."""
+    class RetryDriver(FakeDriver):
+        def crawl_history(self, symbol):
+            calls.append((symbol, "history"))
+            result_store.add(symbol, "history", [True], 0.)
+
+        def crawl_financials(self, symbol): # fails every time
+            calls.append((symbol, "financials"))
+            self.results.setdefault(symbol, {})["financials"] = [False, True]
+            result_store.add(symbol, "financials", [False, True], 0., "no table")
+
+    def try_crawl(crawl_fn, symbol, fn_name):
+        crawl_fn(symbol)
+        return True
+
+    @contextmanager
+    def session():
+        yield RetryDriver()
+
+    calls, summaries = [], []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result_store = ResultStore(os.path.join(tmpdir, "result.db"))
+        result_store.start_run()
+        result_store.add("AAPL", "summary", [True, False], 0., "timeout")
+        result_store.add("MSFT", "history", None, 0., "TimeoutException")
+        result_store.add("TSLA", "financials", None, 0., "TimeoutException")
+        result_store.add("FB", "statistics", [True], 0.)
+        result_store.finish_run()
+
+        symbols = retry_failures(result_store, session, summaries.append, try_crawl,
+                                 max_retry=2, debug=True)
+        report = result_store.finish_run()
+        failures = result_store.failures()
+        result_store.close()
+
+    assert summaries == [["AAPL"]], f"ERROR: summary retries {summaries}"
+    # financials go first, and a failure is retried before history
+    assert calls == [("TSLA", "financials")] * 3 + [("MSFT", "history")], f"ERROR: {calls}"
+    assert symbols == ["MSFT", "TSLA"]
+    assert report["sections"]["history"]["ok"] == 1
+    assert [(symbol, section, attempts) for symbol, section, _, attempts, _ in failures] \
+        == [("TSLA", "financials", 3)], f"ERROR: failures after retry {failures}"
+
+# test retrying failed sections
+test_retry_failures()
+
+def test_annualize():
+    """Check the panel annualization against per-symbol rolling sums."""
+    rng = np.random.default_rng(0)
+    dfs = {}
+    for symbol, n, start in [("AAPL", 13, "2017-09-30"), ("MSFT", 9, "2018-06-30"),
+                             ("NKLA", 3, "2019-12-31")]:
+        dates = pd.date_range(start, periods=n, freq=pd.offsets.QuarterEnd())[::-1]
+        df = pd.DataFrame(rng.normal(size=(n, 3)), index=dates,
+                          columns=["Revenue", "Net Income", symbol])
+        df.iloc[rng.integers(n), 0] = np.nan
+        dfs[symbol] = df
+    # NKLA's fiscal year end is unknown
+    months = pd.Series({"AAPL" : 9, "MSFT" : 6, "NKLA" : np.nan})
+
+    yearly = annualize(to_panel(dfs), months)
+    for symbol, df in dfs.items():
+        expected = df.iloc[::-1].rolling(4, min_periods=1).sum().iloc[::-1]
+        if symbol == "NKLA":
+            expected = expected.iloc[::4]
+        else:
+            expected = expected[expected.index.month == months[symbol]]
+        result = yearly.loc[symbol][df.columns]
+        assert list(result.index) == list(expected.index), f"ERROR: {symbol} years"
+        assert np.allclose(result, expected, equal_nan=True), f"ERROR: {symbol} sums"
+
+# test annualization of quarterly statements
+test_annualize()
+
+def test_load_panel():
+    """Check a panel of summary columns against the files it is read from."""
+    symbols = ["AAPL", "MSFT", "NOPE"] # NOPE has no file
+    with workdir():
+        for symbol, n in [("AAPL", 3), ("MSFT", 2)]:
+            dates = pd.bdate_range(end="2020-12-31", periods=n)[::-1]
+            df = pd.DataFrame({"Ask" : np.arange(n) + .5,
+                               "EPS" : [np.nan] + [2.] * (n - 1), "Beta" : 1.},
+                              index=pd.Index(dates.strftime("%Y-%m-%d"), name="Date"))
+            tools.to_csv(df, tools.get_path("summary", symbol, debug=True))
+        panel = load_panel("summary", symbols, columns=["Ask", "EPS"], debug=True)
+        df = tools.get_df("summary", "AAPL", debug=True)
+        long = load_panel("summary", symbols, columns=["Ask", "EPS"], long=True,
+                          debug=True)
+        recent = load_panel("summary", symbols, start="2020-12-31", debug=True)
+        future = load_panel("summary", symbols, start="2100-01-01", debug=True)
+
+    assert list(panel.columns) == ["Ask", "EPS"]
+    assert set(panel.index.get_level_values("Symbol")) == {"AAPL", "MSFT"}
+    assert list(panel.loc["AAPL", "Ask"]) == list(df["Ask"])
+    assert list(long.columns) == ["Symbol", "Date", "Column", "Value"]
+    assert len(long) == panel.notna().sum().sum() == 8
+    assert len(recent) == 2 and list(recent.columns) == ["Ask", "EPS", "Beta"]
+    assert future.empty, "ERROR: date filter not applied"
+
+# test loading a panel of many symbols
+test_load_panel()
+
+def test_history_store():
+    """Check memory-mapped history against the dataframe it was written from."""
+    dates = pd.bdate_range(end="2020-12-31", periods=300)
+    df = pd.DataFrame({"Open" : np.arange(300.), "High" : np.arange(300.) + 1,
+                       "Low" : np.arange(300.) - 1, "Close" : np.arange(300.) + .5,
+                       "Adj Close" : np.arange(300.) + .25,
+                       "Volume" : np.arange(300.) * 10},
+                      index=pd.Index(dates.strftime("%Y-%m-%d")[::-1], name="Date"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = HistoryStore(tmpdir)
+        store.write("TEST", df, debug=True)
+        history = store.open("TEST", debug=True)
+        assert len(history) == 300
+        assert history.at("2020-12-31") == {**df.iloc[0].drop("Volume").to_dict(),
+                                            "Volume" : int(df["Volume"].iloc[0])}
+        assert history.at("2020-12-26") is None, "ERROR: Saturday found"
+        month = history.between("2020-12-01", "2020-12-31")
+        assert list(month.dates) == list(dates[dates >= "2020-12-01"])
+        assert np.shares_memory(month.prices, history.prices)
+        assert np.allclose(history.to_df().to_numpy(), df.to_numpy())
+
+        store.write("TEST", df.iloc[:10], debug=True) # replaced while mapped
+        assert len(store.open("TEST", debug=True)) == 10 and len(history) == 300
+
+        # a missing volume is not a day without trades
+        df.iloc[0, df.columns.get_loc("Volume")] = np.nan
+        store.write("TEST", df, debug=True)
+        assert store.open("TEST", debug=True).at("2020-12-31")["Volume"] is None
+        assert store.open("TEST", debug=True).at("2020-12-30")["Volume"] == 10
+
+        # readers always find arrays while the store is rewritten
+        writer = Thread(target=lambda: [store.write("TEST", df.iloc[:n], debug=True)
+                                        for n in range(50, 100)])
+        writer.start()
+        opened = []
+        while writer.is_alive():
+            opened.append(store.open("TEST", debug=True))
+        writer.join()
+        assert all(history is not None for history in opened), "ERROR: history not found"
+        assert len(os.listdir(store.locate("TEST", debug=True))) <= 3, "ERROR: old versions kept"
+
+# test the memory-mapped price history
+test_history_store()
+
+def test_parquet_store():
+    """Check that a newer .csv replaces parquet parts and that dtypes are kept."""
+    store = storage.ParquetStore()
+    with workdir():
+        df = pd.DataFrame({"Stock" : [True, np.nan], "Close" : ["1.5", "2"]},
+                          index=pd.Index(["2020-12-31", "2020-12-30"], name="Date"))
+        store.write(df, inpath := tools.get_path("summary", "TEST"))
+        assert store.exists(inpath) and not os.path.exists(inpath)
+        stored = store.read(inpath)
+        assert list(stored["Stock"].isna()) == [False, True], "ERROR: NaN became True"
+
+        tools.to_csv(df.iloc[:1], inpath) # e.g. a download moved by the crawler
+        part = store.parts(inpath)[0]
+        os.utime(inpath, ns=(os.stat(part).st_mtime_ns + 10**9,) * 2)
+        assert len(store.read(inpath)) == 1, "ERROR: newer .csv ignored"
+        assert len(store.read(inpath)) == 1 and len(store.parts(inpath)) == 1
+
+# test the parquet store
+test_parquet_store()
+
+def test_save_backup():
+    """Check that a journaled save counts as crawled and backs up the previous rows."""
+    with workdir():
+        driver = ChromeDriver(False, False, fetcher=ReplayFetcher())
+        driver.save("tmp", "TEST", {"Date" : "2020-12-30", "Beta" : "1.1"})
+        assert tools.store.exists(inpath := tools.get_path("tmp", "TEST"))
+        assert not os.path.exists(inpath), "ERROR: journal compacted on first save"
+        driver.save("tmp", "TEST", {"Date" : "2020-12-31", "Beta" : "1.2"})
+        assert len(tools.store.read(tools.get_path("tmp", "TEST", backup=True))) == 1
+        assert len(tools.store.read(inpath)) == 2
+
+# test appending crawled rows
+test_save_backup()
+
+def append_rows(inpath, first, n, compact_every):
+    """Append n rows of dates from first on, compacting as ChromeDriver.save does."""
+    store = storage.CSVStore()
+    for date in pd.date_range(first, periods=n):
+        store.append(pd.DataFrame({"Beta" : [1.]}, index=pd.Index([date.date()], name="Date")),
+                     inpath)
+        if store.pending(inpath) >= compact_every:
+            store.compact(inpath)
+
+def test_concurrent_appends():
+    """Check that no row is lost while processes append and compact one file."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inpath = os.path.join(tmpdir, "TEST_summary.csv")
+        procs = [Process(target=append_rows, args=(inpath, f"{2000 + i}-01-01", 40, 3))
+                 for i in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        assert len(storage.CSVStore().read(inpath)) == 160, "ERROR: appended rows lost"
+
+        # rewriting a file leaves its hard-linked backup as it was
+        storage.CSVStore().compact(inpath) # rows left in the journal are not linked
+        storage.snapshot(inpath, backpath := os.path.join(tmpdir, "backup.csv"))
+        tools.to_csv(pd.DataFrame({"Beta" : [2.]}), inpath)
+        assert len(pd.read_csv(backpath)) == 160, "ERROR: backup rewritten"
+
+# test appending to one file from several processes
+test_concurrent_appends()
+
+def test_to_dates():
+    """Check vectorized date parsing against per-element tools.to_date."""
+    index = pd.Index(["2020-12-31", "ttm", "9/30/2020", "Sep 26, 2020", None, "6/30/2020"])
+    expected = [tools.to_date(x) for x in index]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error") # no per-element fallback for 'ttm'
+        assert list(tools.to_dates(index).date) == expected
+        assert tools.to_dates(pd.Index(["ttm", "2020-12-31"])).isna().tolist() == [True, False]
+    # shapes of no listed format are inferred, not dropped
+    index = pd.Index(["2021-03-31T00:00:00", "2020-12-31T00:00:00", "31.03.2021", "ttm"])
+    assert [str(date.date()) for date in tools.to_dates(index)[:3]] \
+        == ["2021-03-31", "2020-12-31", "2021-03-31"]
+    assert tools.date_formats["0000-00-00a00:00:00"] is None
+    assert tools.date_formats["0/00/0000"] == "%m/%d/%Y"
+
+# test parsing dates of mixed formats
+test_to_dates()
+
+def test_incremental_process():
+    """Check that only files changed since the last preprocessing are processed."""
+    symbol = "INCREMENTAL"
+    history = pd.DataFrame({"Close" : [3., 2., 1.]}, index=pd.Index(
+        ["2020-12-31", "2020-12-30", "2020-12-29"], name="Date"))
+    with workdir(), redirect_stdout(io.StringIO()):
+        tools.to_csv(history.iloc[1:], tools.get_path("history", symbol))
+        first = init_process([symbol], False, True)
+        unchanged = init_process([symbol], False, True)
+        tools.to_csv(history, tools.get_path("history", symbol))
+        changed = init_process([symbol], False, True)
+        processed = tools.get_df("history", symbol, debug=True)
+        forced = init_process([symbol], False, True, force=True)
+
+    # preprocessing rewrites its inputs, a crawl meanwhile must not be skipped
+    def crawl_while_saving(col, symbol, *args, **kwargs):
+        save(col, symbol, *args, **kwargs)
+        if col == "history":
+            tools.store.append(history.iloc[:1], tools.get_path("history", symbol))
+    save = tools.backup_and_save_df
+    with workdir(), redirect_stdout(io.StringIO()):
+        tools.to_csv(history.iloc[1:], tools.get_path("history", symbol))
+        init_process([symbol], False, False)
+        rewritten = init_process([symbol], False, False)
+        tools.to_csv(history.iloc[1:], tools.get_path("history", symbol))
+        tools.backup_and_save_df = crawl_while_saving
+        try:
+            init_process([symbol], False, False)
+        finally:
+            tools.backup_and_save_df = save
+        crawled = init_process([symbol], False, False)
+        processed_crawl = tools.get_df("history", symbol)
+
+    assert len(first) == 1
+    assert unchanged == [], "ERROR: unchanged symbol processed"
+    assert changed == [(symbol, {}, None)] and len(processed) == 3
+    assert len(forced) == 1
+    assert rewritten == [], "ERROR: files rewritten by preprocessing are dirty"
+    assert crawled == [(symbol, {}, None)], "ERROR: file crawled meanwhile skipped"
+    assert len(processed_crawl) == 3
+
+# test skipping unchanged files in preprocessing
+test_incremental_process()
+
+def test_shared_cache():
+    """Check that cache hits are not copied and preprocessing leaves them as read."""
+    symbol = "SHARED"
+    summary = pd.DataFrame({"Open" : ["1.5", "2k"], "Volume (M)" : ["3", "4"]},
+                           index=pd.Index(["2020-12-31", "2020-12-30"], name="Date"))
+    with workdir(), redirect_stdout(io.StringIO()):
+        tools.to_csv(summary, tools.get_path("summary", symbol))
+        df = tools.get_df("summary", symbol, convert_index_to_datetime=False)
+        before = df.copy()
+        process_text_symbol(symbol, False, True)
+        tools.to_csv(summary, tools.get_path("summary", symbol, debug=True))
+        debug_df = tools.path2df(tools.get_path("summary", symbol, debug=True))
+        convert_symbol(symbol, False, True)
+        hit = tools.get_df("summary", symbol, convert_index_to_datetime=False)
+        debug_hit = tools.path2df(tools.get_path("summary", symbol, debug=True))
+
+    assert hit is df, "ERROR: cache hit copied"
+    assert df.equals(before) and list(df.columns) == list(before.columns), \
+        "ERROR: cached df modified by process_text_symbol"
+    assert debug_hit is not debug_df and debug_df["Open"].tolist() == ["1.5", "2k"], \
+        "ERROR: cached df modified by convert_symbol"
+
+# test sharing cached dataframes
+test_shared_cache()
+
+def test_index_cache():
+    """Check that byte-offset indexes are rebuilt on change and evicted by memory."""
+    df = pd.DataFrame({"Close" : np.arange(100.)}, index=pd.Index(
+        pd.date_range("2020-01-01", periods=100).date, name="Date"))
+    cache = reader._indexes
+    try:
+        with workdir():
+            for symbol in ["A", "B"]:
+                tools.to_csv(df, tools.get_path("history", symbol))
+            # room for one index only
+            nbytes = reader.IndexedCSV(inpath := tools.get_path("history", "A")).nbytes()
+            reader._indexes = FileCache(3 * nbytes // 2, sizeof=reader.IndexedCSV.nbytes)
+            index = reader.get_index(inpath)
+            assert reader.get_index(inpath) is index
+            assert len(index) == 100 and index.column("Close", 99) == ["99.0"]
+            reader.get_index(tools.get_path("history", "B"))
+            stats = reader._indexes.stats()
+            tools.to_csv(df.iloc[:10], inpath)
+            rebuilt = reader.get_index(inpath)
+    finally:
+        reader._indexes = cache
+
+    assert stats["entries"] == 1 and stats["evictions"] == 1, \
+        f"ERROR: indexes not bounded {stats}"
+    assert rebuilt is not index and len(rebuilt) == 10
+
+# test bounding the byte-offset indexes of get_data
+test_index_cache()
+
+def test_parallel_process():
+    """Check that preprocessing in a process pool matches the serial run."""
+    outputs = []
+    for workers in [1, 2]:
+        metrics.reset()
+        with workdir(), redirect_stdout(io.StringIO()):
+            symbols = benchmark.generate(4, 8)
+            init_process(symbols, False, False, workers, chunksize=1)
+            files = {}
+            for root, _, filenames in os.walk(COMPANYDIR):
+                for filename in filenames:
+                    with open(os.path.join(root, filename)) as r_obj:
+                        files[os.path.join(root, filename)] = r_obj.read()
+        histograms = {name : histogram["count"]
+                      for name, histogram in metrics.to_dict()["histograms"].items()}
+        outputs.append((files, metrics.to_dict()["counters"], histograms))
+
+    (serial, *serial_metrics), (parallel, *parallel_metrics) = outputs
+    assert sorted(serial) == sorted(parallel), "ERROR: different files written"
+    for filename, content in serial.items():
+        assert content == parallel[filename], f"ERROR: {filename} differs"
+    assert serial_metrics == parallel_metrics, "ERROR: metrics not merged"
+
+# test preprocessing with several workers
+test_parallel_process()
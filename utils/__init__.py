@@ -2,16 +2,30 @@ from os import path
 
 # path to crawler dir
 CRAWLERDIR = "crawler"
-# path to log
-LOGPATH = path.join(CRAWLERDIR, "log.txt")
+# path to log (json lines)
+LOGPATH = path.join(CRAWLERDIR, "log.jsonl")
 # path to result
 RESULTPATH = path.join(CRAWLERDIR, "result.json")
+# path to results of every run
+RESULTDBPATH = path.join(CRAWLERDIR, "result.db")
+# path to journal of completed units of the initial crawl
+CHECKPOINTPATH = path.join(CRAWLERDIR, "checkpoint.txt")
+# path to metrics
+METRICSPATH = path.join(CRAWLERDIR, "metrics.json")
 # path to mapping.json
 MAPPINGPATH = path.join(CRAWLERDIR, "mapping.json")
+# path to recorded pages
+FIXTUREDIR = path.join(CRAWLERDIR, "fixtures", "recorded")
 # path to data directory
 DATADIR = path.join("data")
 # path to company directory
 COMPANYDIR = path.join(DATADIR, "company")
+# path to binary price history
+HISTORYDIR = path.join(DATADIR, "history")
+# path to signatures of preprocessed files
+MANIFESTPATH = path.join(DATADIR, "manifest.json")
+# path to columnar store
+STOREDIR = path.join(DATADIR, "store")
 # path to profile
 PROFILEPATH = path.join(DATADIR, "stock_profile.csv")
 # path to backup profile
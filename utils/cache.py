@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+
+class FileCache:
+    """LRU cache of DataFrames read from files, bounded by memory.
+
+        An entry is only served while the signature of its file (mtime and
+        size, see Store.signature) is unchanged, so writes made through save or
+        backup_and_save_df are seen on the next read. Callers share the cached
+        frame, so those editing it in place (e.g. convert_dtypes) copy it
+        first; a copy(deep=False) is enough to replace its index or columns.
+        Other objects are cached given sizeof(obj), their size in bytes."""
+    def __init__(self, max_bytes=256 * 2 ** 20, sizeof=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda df: int(df.memory_usage(index=True,
+                                                                deep=True).sum()))
+        self.entries = OrderedDict() # key -> (signature, df, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, signature, load):
+        """Return the cached df for key (not to be modified), calling load()
+            on a miss."""
+        with self.lock:
+            if (entry := self.entries.get(key)) and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        if (df := load()) is None:
+            return
+        nbytes = self.sizeof(df)
+
+        with self.lock:
+            if (entry := self.entries.pop(key, None)):
+                self.nbytes -= entry[2]
+            if nbytes <= self.max_bytes:
+                self.entries[key] = (signature, df, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, n) = self.entries.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+        return df
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {"hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "entries" : len(self.entries),
+                "bytes" : self.nbytes}
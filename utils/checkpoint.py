@@ -0,0 +1,108 @@
+import os
+import time
+from datetime import timedelta
+
+from utils import CHECKPOINTPATH
+
+
+class Checkpoint:
+    """Journal of completed (symbol, section) units of a long crawl.
+
+        Units are appended as "symbol<TAB>section" lines and fsynced every
+        `every` units or `interval` seconds, so a crash loses at most one
+        batch, which is crawled again on restart. Lines are written with
+        one append each, so processes can share a journal."""
+    def __init__(self, inpath=CHECKPOINTPATH, every=20, interval=60):
+        self.inpath = inpath
+        self.every = every
+        self.interval = interval # seconds
+        self.torn = False # whether the journal ends within a line
+        self.completed = self.load()
+        self.pending = []
+        self.synced = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.sync()
+
+    def __contains__(self, unit):
+        return unit in self.completed
+
+    def load(self):
+        if not os.path.exists(self.inpath):
+            return set()
+        with open(self.inpath) as r_obj:
+            lines = r_obj.read().split("\n")
+        # the last line may have been cut short by a crash
+        self.torn = lines.pop() != ""
+        return {tuple(line.split("\t")) for line in lines if line.count("\t") == 1}
+
+    def done(self, symbol, section):
+        """Mark section of symbol completed."""
+        self.completed.add((symbol, section))
+        self.pending.append(f"{symbol}\t{section}\n")
+        if (len(self.pending) >= self.every
+                or time.monotonic() - self.synced >= self.interval):
+            self.sync()
+
+    def sync(self):
+        """Write and fsync the pending units."""
+        if self.pending:
+            if dir_ := os.path.dirname(self.inpath):
+                os.makedirs(dir_, exist_ok=True)
+            fd = os.open(self.inpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                lines = "".join(self.pending)
+                os.write(fd, (f"\n{lines}" if self.torn else lines).encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.pending, self.torn = [], False
+        self.synced = time.monotonic()
+
+    def missing(self, symbols, sections):
+        """Return the units of symbols and sections not completed.
+
+            The journal is read again, so that units completed by other
+            processes (e.g. workers of the initial crawl) count."""
+        self.sync()
+        self.completed = self.load()
+        return [(symbol, section) for symbol in symbols for section in sections
+                if (symbol, section) not in self.completed]
+
+    def clear(self):
+        """Forget every unit, e.g. after the crawl has gone through all symbols."""
+        self.completed, self.pending, self.torn = set(), [], False
+        if os.path.exists(self.inpath):
+            os.remove(self.inpath)
+
+
+class Progress:
+    """Count symbols of a crawl and estimate when it ends.
+
+        Skipped symbols count as done but not towards the rate of the ETA."""
+    def __init__(self, total, every=10):
+        self.total = total
+        self.every = every # report every this many symbols
+        self.done = self.skipped = 0
+        self.start = time.monotonic()
+
+    def step(self, skipped=False):
+        """Count a symbol and return a report every self.every symbols, else None."""
+        self.done += 1
+        self.skipped += skipped
+        if self.done % self.every and self.done != self.total:
+            return
+        return str(self)
+
+    def eta(self):
+        if not (crawled := self.done - self.skipped):
+            return None
+        seconds = (time.monotonic() - self.start) / crawled * (self.total - self.done)
+        return timedelta(seconds=round(seconds))
+
+    def __str__(self):
+        return (f"{self.done}/{self.total} symbols ({self.skipped} skipped), "
+                f"ETA {self.eta()}")
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from utils import tools, HISTORYDIR
+
+# columns of symbol_history.csv, stored as float64 arrays (NaN if missing)
+PRICES = ["Open", "High", "Low", "Close", "Adj Close"]
+VOLUME = "Volume"
+
+
+def to_days(dates):
+    """Return dates as int32 days since 1970-01-01."""
+    return (pd.DatetimeIndex(dates).to_numpy().astype("datetime64[D]")
+            .astype("int64").astype("int32"))
+
+
+def to_day(date):
+    return np.int32(np.datetime64(pd.Timestamp(date), "D").astype("int64"))
+
+
+class History:
+    """Daily prices of a symbol as arrays sorted by day (memory-mapped).
+
+        Lookups binary-search the int32 day index, and between() slices the
+        arrays without copying them."""
+    def __init__(self, days, prices, volume):
+        self.days = days # int32 (n,)
+        self.prices = prices # float64 (n, len(PRICES))
+        self.volume = volume # float64 (n,), NaN if not known
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def dates(self):
+        return pd.DatetimeIndex(self.days.astype("datetime64[D]"))
+
+    def at(self, date):
+        """Return {column : value} of date, or None if not a trading day.
+
+            Volume is None if not known, which is not a day without trades."""
+        i = np.searchsorted(self.days, day := to_day(date))
+        if i == len(self.days) or self.days[i] != day:
+            return
+        volume = self.volume[i]
+        return {**dict(zip(PRICES, self.prices[i].tolist())),
+                VOLUME : None if np.isnan(volume) else int(volume)}
+
+    def between(self, start=None, end=None):
+        """Return the History of days in [start, end] as views of this one."""
+        i = 0 if start is None else np.searchsorted(self.days, to_day(start))
+        j = (len(self.days) if end is None
+             else np.searchsorted(self.days, to_day(end), side="right"))
+        return History(self.days[i:j], self.prices[i:j], self.volume[i:j])
+
+    def to_df(self):
+        """Return a DataFrame (copy) like symbol_history.csv, latest first."""
+        df = pd.DataFrame(np.asarray(self.prices), index=self.dates, columns=PRICES)
+        df[VOLUME] = np.asarray(self.volume)
+        df.index.name = "Date"
+        return df.iloc[::-1]
+
+
+class HistoryStore:
+    """Binary copies of symbol_history.csv files, opened as memory maps.
+
+        Each write makes a version directory root/<symbol>/<n>/
+        (root/debug/<symbol>/<n>/ in debug) holding days.npy, prices.npy and
+        volume.npy, plus the signature of the .csv they were built from.
+        root/<symbol>/current names the version to read and is swapped with
+        os.replace, so readers never see a symbol without arrays; the
+        previous version is kept for readers opening it meanwhile. Memory
+        maps are shared by the page cache of every process reading them, so
+        opening the whole universe costs little memory until rows are
+        touched."""
+    def __init__(self, root=HISTORYDIR):
+        self.root = root
+
+    def locate(self, symbol, debug=False):
+        return (path.join(self.root, "debug", symbol) if debug
+                else path.join(self.root, symbol))
+
+    def version(self, symbol, debug=False):
+        """Return the directory of the current version of symbol, or None."""
+        dir_ = self.locate(symbol, debug)
+        try:
+            with open(path.join(dir_, "current")) as r_obj:
+                return path.join(dir_, r_obj.read().strip())
+        except FileNotFoundError:
+            return
+
+    def source(self, symbol, debug=False):
+        return tools.get_path("history", symbol, debug=debug)
+
+    def signature(self, symbol, debug=False):
+        return json.loads(json.dumps(tools.store.signature(self.source(symbol, debug))))
+
+    def stale(self, symbol, debug=False):
+        """Return True if symbol_history.csv changed since it was last written."""
+        if (dir_ := self.version(symbol, debug)) is None:
+            return True
+        try:
+            with open(path.join(dir_, "signature.json")) as r_obj:
+                return json.load(r_obj) != self.signature(symbol, debug)
+        except FileNotFoundError:
+            return True
+
+    def write(self, symbol, df, debug=False):
+        """Write df (as read from symbol_history.csv) in place of symbol's arrays."""
+        dates = tools.to_dates(df.index)
+        df = df[mask := ~pd.isnull(dates)].copy()
+        df.index = dates[mask]
+        df = df[~df.index.duplicated(keep="last")].sort_index()
+        prices = np.column_stack(
+            [pd.to_numeric(df[col], errors="coerce").to_numpy(dtype="float64")
+             if col in df else np.full(len(df), np.nan) for col in PRICES])
+        volume = (pd.to_numeric(df[VOLUME], errors="coerce").to_numpy(dtype="float64")
+                  if VOLUME in df else np.full(len(df), np.nan))
+
+        # readers keep the maps of replaced files, so write a new version
+        os.makedirs(dir_ := self.locate(symbol, debug), exist_ok=True)
+        current = self.version(symbol, debug)
+        versions = [int(name) for name in os.listdir(dir_) if name.isdigit()]
+        os.makedirs(newdir := path.join(dir_, str(max(versions, default=-1) + 1)))
+        np.save(path.join(newdir, "days.npy"), to_days(df.index))
+        np.save(path.join(newdir, "prices.npy"), prices)
+        np.save(path.join(newdir, "volume.npy"), volume)
+        with open(path.join(newdir, "signature.json"), "w") as w_obj:
+            json.dump(self.signature(symbol, debug), w_obj)
+        with open(tmppath := path.join(dir_, "current.tmp"), "w") as w_obj:
+            w_obj.write(path.basename(newdir))
+        os.replace(tmppath, path.join(dir_, "current"))
+
+        # keep the previous version for readers opening it, drop the rest
+        keep = {"current", path.basename(newdir), current and path.basename(current)}
+        for name in set(os.listdir(dir_)) - keep:
+            if path.isdir(oldpath := path.join(dir_, name)):
+                shutil.rmtree(oldpath, ignore_errors=True)
+            else:
+                os.remove(oldpath)
+
+    def build(self, symbol, debug=False):
+        """Write symbol's arrays from symbol_history.csv; False if there is none."""
+        if not tools.store.exists(inpath := self.source(symbol, debug)):
+            return False
+        self.write(symbol, tools.store.read(inpath), debug)
+        return True
+
+    def open(self, symbol, debug=False):
+        """Return the History of symbol memory-mapped, or None if not written."""
+        for _ in range(2): # the version read may be dropped by two writes meanwhile
+            if (dir_ := self.version(symbol, debug)) is None:
+                return
+            try:
+                return History(*(np.load(path.join(dir_, f"{name}.npy"), mmap_mode="r")
+                                 for name in ["days", "prices", "volume"]))
+            except FileNotFoundError:
+                continue
+
+    def load(self, symbols=None, debug=False):
+        """Return {symbol : History}, (re)building arrays of changed .csv files."""
+        symbols = tools.get_symbols() if symbols is None else symbols
+        histories = {}
+        for symbol in symbols:
+            if self.stale(symbol, debug):
+                self.build(symbol, debug)
+            if (history := self.open(symbol, debug)) is not None:
+                histories[symbol] = history
+        return histories
+
+
+# binary history of tools.store's history files
+history_store = HistoryStore()
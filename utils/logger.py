@@ -0,0 +1,132 @@
+import os
+import json
+import queue
+import atexit
+import logging
+import multiprocessing
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from utils import LOGPATH
+
+# fields a record may carry besides its message (passed as tools.log(..., **fields))
+FIELDS = ("symbol", "stage", "duration")
+# rotate the log at this size, keeping this many old logs (log.jsonl.1, ...)
+MAX_BYTES = 10 * 2**20
+BACKUP_COUNT = 5
+# flush at least every this many records, even when records keep coming
+CAPACITY = 256
+
+logger = logging.getLogger("crawler")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+listener = None
+owner = None # pid of the process writing the log
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as one JSON line."""
+    def format(self, record):
+        line = {"time" : datetime.fromtimestamp(record.created).isoformat(),
+                "level" : record.levelname,
+                "pid" : record.process,
+                "msg" : record.getMessage().strip()}
+        for field in FIELDS:
+            if (value := getattr(record, field, None)) is not None:
+                line[field] = value
+        return json.dumps(line)
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that keeps the file open and flushes in batches.
+
+        StreamHandler flushes after every record; here records stay in the
+        file buffer until capacity records are pending or the listener
+        finds the queue empty."""
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT,
+                 capacity=CAPACITY):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding="utf-8")
+        self.capacity = capacity
+        self.pending = 0
+        # shouldRollover() seeks the file, which would flush it on every record
+        self.size = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + self.terminator # ascii, see json.dumps
+            if self.maxBytes and self.size + len(line) > self.maxBytes:
+                self.doRollover()
+                self.size = 0
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(line)
+            self.size += len(line)
+            self.pending += 1
+            if self.pending >= self.capacity:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        super().flush()
+        self.pending = 0
+
+
+class Listener(QueueListener):
+    """QueueListener that flushes its handlers whenever the queue runs empty."""
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
+
+
+def start(logpath=LOGPATH):
+    """Write records of this process and of processes forked from it to logpath.
+
+        Records are put on a multiprocessing queue, so logging never touches
+        the file on the caller's path; one listener thread in this process
+        is the only writer. Only main.py starts it, before starting crawl
+        workers; other processes log to stderr (see log)."""
+    global listener, owner
+    if listener is not None:
+        return
+    if dir_ := os.path.dirname(logpath):
+        os.makedirs(dir_, exist_ok=True)
+    handler = BatchedRotatingFileHandler(logpath)
+    handler.setFormatter(JSONFormatter())
+    records = multiprocessing.Queue()
+    listener = Listener(records, handler)
+    listener.start()
+    owner = os.getpid()
+    logger.handlers = [QueueHandler(records)]
+    atexit.register(stop)
+
+
+def stop():
+    """Write the records left in the queue and close the log."""
+    global listener
+    if listener is None or owner != os.getpid():
+        return # not started, or forked from the process that started it
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    logger.handlers = []
+    listener = None
+
+
+def log(msg, level=logging.INFO, **fields):
+    """Log msg to the listener of start(), or to stderr if there is none.
+
+        A process that neither started the listener nor was forked from the
+        one that did (e.g. tests, library use or a spawned worker) must not
+        become a second writer of the log file."""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JSONFormatter())
+        logger.handlers = [handler]
+    logger.log(level, msg, extra=fields)
@@ -0,0 +1,68 @@
+import os
+import json
+
+from utils import tools, MANIFESTPATH
+
+
+class Manifest:
+    """Signatures of the input files of each (symbol, dataset) when last preprocessed.
+
+        A dataset is dirty if the (mtime, size) of any of its inputs differs
+        from the manifest, e.g. because the crawler appended rows to it.
+        Inputs are recorded as they were before processing, so that one
+        crawled while being processed is processed again next run, except
+        those still as preprocessing rewrote them, which are clean until
+        crawled again. Entries of debug runs, which write elsewhere, are
+        kept apart."""
+    def __init__(self, inpath=MANIFESTPATH, inputs=None):
+        self.inpath = inpath
+        self.inputs = inputs or {} # {dataset : [files it is made from]}
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.inpath, "r") as r_obj:
+                return json.load(r_obj)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def paths(self, symbol, dataset):
+        return [tools.get_path(col, symbol)
+                for col in self.inputs.get(dataset, [dataset])]
+
+    def signature(self, symbol, dataset):
+        sig = [tools.store.signature(inpath) for inpath in self.paths(symbol, dataset)]
+        return json.loads(json.dumps(sig)) # as read back from the manifest
+
+    def section(self, debug):
+        return self.entries.setdefault("debug" if debug else "data", {})
+
+    def dirty(self, symbol, datasets, debug=False):
+        """Return datasets of symbol whose inputs changed since last recorded."""
+        recorded = self.section(debug).get(symbol, {})
+        return [dataset for dataset in datasets
+                if recorded.get(dataset) != self.signature(symbol, dataset)]
+
+    def update(self, symbol, signatures, written=None, debug=False):
+        """Record signatures ({dataset : signature} taken before processing)
+            of symbol.
+
+            An input whose current signature is the one preprocessing left
+            it with (written, {path : signature}) is recorded at that one."""
+        written = json.loads(json.dumps(written or {}))
+        recorded = self.section(debug).setdefault(symbol, {})
+        for dataset, before in signatures.items():
+            recorded[dataset] = [
+                sig if written.get(inpath, False) == sig else old
+                for inpath, sig, old in zip(self.paths(symbol, dataset),
+                                            self.signature(symbol, dataset), before)]
+
+    def save(self):
+        if dir_ := os.path.dirname(self.inpath):
+            os.makedirs(dir_, exist_ok=True)
+        with open(tmppath := f"{self.inpath}.tmp", "w") as w_obj:
+            json.dump(self.entries, w_obj)
+        os.replace(tmppath, self.inpath)
+
+    def clear(self, debug=False):
+        self.entries.pop("debug" if debug else "data", None)
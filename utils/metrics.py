@@ -0,0 +1,157 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds (seconds) of histogram buckets, from a fetch to a reboot
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf"))
+
+
+def key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, n in enumerate(other["counts"]):
+            self.counts[i] += n
+        self.count += other["count"]
+        self.sum += other["sum"]
+
+    def to_dict(self):
+        return {"count" : self.count, "sum" : self.sum, "counts" : list(self.counts)}
+
+
+class Metrics:
+    """Counters and histograms of a run, labelled like Prometheus metrics.
+
+        Worker processes send snapshot()s that the parent merge()s, so one
+        process writes the metrics of a whole run with dump() or serves them
+        to Prometheus with serve()."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        k = key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def observe(self, name, value, **labels):
+        k = key(name, labels)
+        with self.lock:
+            if k not in self.histograms:
+                self.histograms[k] = Histogram()
+            self.histograms[k].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block in histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Return the metrics as picklable, json-able lists."""
+        with self.lock:
+            return {"counters" : [[name, list(labels), value]
+                                  for (name, labels), value in self.counters.items()],
+                    "histograms" : [[name, list(labels), histogram.to_dict()]
+                                    for (name, labels), histogram
+                                    in self.histograms.items()]}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, labels, value in snapshot["counters"]:
+                k = (name, tuple(map(tuple, labels)))
+                self.counters[k] = self.counters.get(k, 0) + value
+            for name, labels, histogram in snapshot["histograms"]:
+                k = (name, tuple(map(tuple, labels)))
+                if k not in self.histograms:
+                    self.histograms[k] = Histogram()
+                self.histograms[k].merge(histogram)
+
+    def to_dict(self):
+        with self.lock:
+            counters = {f"{name}{label_text(labels)}" : value
+                        for (name, labels), value in sorted(self.counters.items())}
+            histograms = {}
+            for (name, labels), h in sorted(self.histograms.items()):
+                histograms[f"{name}{label_text(labels)}"] = {
+                    "count" : h.count,
+                    "sum" : h.sum,
+                    "mean" : h.sum / h.count if h.count else None,
+                    "buckets" : {str(le) : n for le, n in zip(h.buckets, h.counts)}}
+        return {"counters" : counters, "histograms" : histograms}
+
+    def dump(self, outpath):
+        with open(outpath, "w") as w_obj:
+            json.dump(self.to_dict(), w_obj, indent=4)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{label_text(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for le, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    le = "+Inf" if le == float("inf") else le
+                    lines.append(f"{name}_bucket{label_text(labels + (('le', le),))} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {h.sum}")
+                lines.append(f"{name}_count{label_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics at http://host:port/metrics from a daemon thread.
+
+            Only this machine can scrape them unless host is e.g. 0.0.0.0."""
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# metrics of this process
+metrics = Metrics()
@@ -0,0 +1,59 @@
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utils import tools
+
+
+def read_symbol(dataset, symbol, columns=None, start=None, end=None, yearly=False,
+                debug=False):
+    """Return rows of dataset of symbol dated in [start, end], or None if missing."""
+    if not tools.store.exists(inpath := tools.get_path(dataset, symbol, yearly,
+                                                      debug=debug)):
+        return
+    df = tools.store.read(inpath, columns=columns)
+    dates = tools.to_dates(df.index)
+    mask = ~pd.isnull(dates)
+    if start is not None:
+        mask &= dates >= start
+    if end is not None:
+        mask &= dates <= end
+    df = df[mask]
+    df.index = dates[mask]
+    return df
+
+
+def load_panel(dataset, symbols=None, columns=None, start=None, end=None,
+               long=False, yearly=False, workers=8, debug=False):
+    """Load dataset (e.g. 'summary') of many symbols into one frame.
+
+        Files are read in a thread pool straight from tools.store, without
+        filling tools.cache, and only the index and columns (all if None)
+        are parsed. Rows outside of [start, end] are dropped per symbol
+        before stacking, so memory holds only what is returned. The frame is
+        indexed by (Symbol, Date), or has Symbol, Date, Column and Value
+        columns if long (NaN values dropped). symbols default to those in
+        stock_profile.csv; missing files are skipped."""
+    symbols = tools.get_symbols() if symbols is None else list(symbols)
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    read = partial(read_symbol, dataset, columns=columns, start=start, end=end,
+                   yearly=yearly, debug=debug)
+    with ThreadPoolExecutor(workers) as executor:
+        dfs = {symbol : df for symbol, df in zip(symbols, executor.map(read, symbols))
+               if df is not None and len(df)}
+
+    if not dfs:
+        panel = pd.DataFrame(columns=columns or [], index=pd.MultiIndex.from_arrays(
+            [[], []], names=["Symbol", "Date"]))
+    else:
+        panel = pd.concat(dfs, names=["Symbol", "Date"], sort=False)
+    if columns is not None: # requested order, missing columns as NaN
+        panel = panel.reindex(columns=list(columns))
+
+    if long:
+        # newer pandas keep NaN in stack()
+        return (panel.rename_axis(columns="Column").stack().dropna().rename("Value")
+                .reset_index())
+    return panel
@@ -0,0 +1,68 @@
+import io
+import os
+import csv
+import sys
+
+from utils.cache import FileCache
+
+
+class IndexedCSV:
+    """Random access to the rows of a .csv file through a byte-offset index.
+
+        The index is built with one pass over the raw bytes and remembers the
+        (mtime, size) of the file it was built from, so get_index() rebuilds
+        it whenever the file changes."""
+    def __init__(self, inpath, sep=","):
+        self.inpath = inpath
+        self.sep = sep
+        self.signature = signature(inpath)
+        with open(inpath, "rb") as r_obj:
+            self.header = next(csv.reader([r_obj.readline().decode()],
+                                          delimiter=sep), [])
+            self.offsets = []
+            offset, quoted = r_obj.tell(), False
+            for line in r_obj:
+                if not quoted and line.strip(): # skip blank lines like csv.DictReader
+                    self.offsets.append(offset)
+                # a record only ends on a line break outside of quotes
+                quoted ^= line.count(b'"') % 2 == 1
+                offset += len(line)
+            self.offsets.append(offset) # end of the last row
+        self.col2i = {col : i for i, col in enumerate(self.header)}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def nbytes(self):
+        return sys.getsizeof(self.offsets) + sum(map(sys.getsizeof, self.offsets))
+
+    def rows(self, i_start=0, i_end=None):
+        """Return rows [i_start, i_end) as lists of strings."""
+        i_start, i_end, _ = slice(i_start, i_end).indices(len(self))
+        if i_start >= i_end:
+            return []
+        with open(self.inpath, "rb") as r_obj:
+            r_obj.seek(self.offsets[i_start])
+            chunk = r_obj.read(self.offsets[i_end] - self.offsets[i_start])
+        return [row for row in csv.reader(io.StringIO(chunk.decode()),
+                                          delimiter=self.sep) if row]
+
+    def column(self, col, i_start=0, i_end=None):
+        """Return values of col in rows [i_start, i_end) as strings."""
+        i = self.col2i[col]
+        return [row[i] if i < len(row) else "" for row in self.rows(i_start, i_end)]
+
+
+def signature(inpath):
+    stat = os.stat(inpath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# IndexedCSVs of the files read last, bounded by the memory of their offsets
+_indexes = FileCache(max_bytes=64 * 2 ** 20, sizeof=IndexedCSV.nbytes)
+
+
+def get_index(inpath, sep=","):
+    """Return the IndexedCSV of inpath, rebuilding it if the file changed."""
+    return _indexes.get((inpath, sep), signature(inpath),
+                        lambda: IndexedCSV(inpath, sep))
@@ -0,0 +1,170 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+from utils import RESULTDBPATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER,
+    symbol TEXT,
+    section TEXT,
+    bitmap INTEGER, -- bit i is set if part i of section was crawled
+    parts INTEGER, -- number of parts, 0 if the crawl raised before any
+    attempts INTEGER,
+    seconds REAL,
+    reason TEXT, -- why the last attempt failed
+    PRIMARY KEY (run, symbol, section)
+);
+"""
+
+# results of a (symbol, section) are merged over attempts within a run
+UPSERT = """
+INSERT INTO results
+SELECT coalesce(max(id), 0), ?, ?, ?, ?, 1, ?, ? FROM runs WHERE true
+ON CONFLICT (run, symbol, section) DO UPDATE SET
+    bitmap = bitmap | excluded.bitmap,
+    parts = max(parts, excluded.parts),
+    attempts = attempts + 1,
+    seconds = seconds + excluded.seconds,
+    reason = excluded.reason
+"""
+
+
+def to_bitmap(result):
+    """Return result ([True, False, ...] per part of a section) as an int."""
+    return sum(1 << i for i, ok in enumerate(result) if ok)
+
+
+def from_bitmap(bitmap, parts):
+    return [bool(bitmap >> i & 1) for i in range(parts)]
+
+
+def finished(bitmap, parts):
+    return parts > 0 and bitmap == (1 << parts) - 1
+
+
+class ResultStore:
+    """Results of crawled (symbol, section)s of every run, in SQLite.
+
+        All crawl processes write to the same database in WAL mode, where
+        writers do not block readers and each add() is one short
+        transaction. A run is started by the main process with start_run();
+        workers add() to the latest run, so they need not know its id."""
+    def __init__(self, dbpath=RESULTDBPATH, timeout=30):
+        self.dbpath = dbpath
+        self.timeout = timeout # seconds to wait for another writer
+        self.lock = threading.Lock()
+        self._conn = None
+        self.pid = None
+
+    def __getstate__(self):
+        return {"dbpath" : self.dbpath, "timeout" : self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def conn(self):
+        """Connection of this process, opened on first use (also after a fork)."""
+        if self._conn is None or self.pid != os.getpid():
+            if dir_ := os.path.dirname(self.dbpath):
+                os.makedirs(dir_, exist_ok=True)
+            self._conn = sqlite3.connect(self.dbpath, timeout=self.timeout,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self.pid = os.getpid()
+        return self._conn
+
+    def start_run(self):
+        """Start a run that results are added to and return its id."""
+        with self.lock:
+            return self.conn.execute("INSERT INTO runs (started) VALUES (?)",
+                                     (time.time(),)).lastrowid
+
+    def finish_run(self):
+        """Mark the latest run finished and return its report."""
+        with self.lock:
+            self.conn.execute("UPDATE runs SET finished = ? "
+                              "WHERE id = (SELECT max(id) FROM runs)", (time.time(),))
+        return self.report()
+
+    def last_run(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT coalesce(max(id), 0) FROM runs").fetchone()[0]
+
+    def failures(self, run=None):
+        """Return (symbol, section, result, attempts, reason)s that failed in run.
+
+            run defaults to the latest run with results, so that a retry run
+            that failed again is retried next."""
+        if run is None:
+            with self.lock:
+                run = self.conn.execute(
+                    "SELECT coalesce(max(run), 0) FROM results").fetchone()[0]
+        return [(symbol, section, from_bitmap(bitmap, parts), attempts, reason)
+                for symbol, section, bitmap, parts, attempts, _, reason
+                in self.rows(run) if not finished(bitmap, parts)]
+
+    def add(self, symbol, section, result, seconds, reason=None):
+        """Add an attempt at crawling section of symbol to the latest run.
+
+            result is a list of booleans per part of section, or None if
+            the attempt failed before crawling any part."""
+        bitmap, parts = to_bitmap(result := result or []), len(result)
+        if finished(bitmap, parts):
+            reason = None
+        with self.lock:
+            self.conn.execute(UPSERT, (symbol, section, bitmap, parts, seconds, reason))
+
+    def rows(self, run=None):
+        """Return (symbol, section, bitmap, parts, attempts, seconds, reason) of run."""
+        run = self.last_run() if run is None else run
+        with self.lock:
+            return self.conn.execute(
+                "SELECT symbol, section, bitmap, parts, attempts, seconds, reason "
+                "FROM results WHERE run = ? ORDER BY symbol, section", (run,)).fetchall()
+
+    def report(self, run=None):
+        """Return a summary of run (the latest by default) with its failures."""
+        run = self.last_run() if run is None else run
+        with self.lock:
+            started, finished_ = self.conn.execute(
+                "SELECT started, finished FROM runs WHERE id = ?",
+                (run,)).fetchone() or (None, None)
+        report = {"run" : run,
+                  "started" : started and datetime.fromtimestamp(started).isoformat(),
+                  "finished" : (finished_ and
+                                datetime.fromtimestamp(finished_).isoformat()),
+                  "sections" : {},
+                  "failed" : {}}
+        for symbol, section, bitmap, parts, attempts, seconds, reason in self.rows(run):
+            ok = finished(bitmap, parts)
+            stats = report["sections"].setdefault(
+                section, {"ok" : 0, "failed" : 0, "retried" : 0, "seconds" : 0.})
+            stats["ok" if ok else "failed"] += 1
+            stats["retried"] += attempts > 1
+            stats["seconds"] = round(stats["seconds"] + seconds, 3)
+            if not ok:
+                report["failed"].setdefault(symbol, {})[section] = {
+                    "result" : from_bitmap(bitmap, parts),
+                    "attempts" : attempts,
+                    "seconds" : round(seconds, 3),
+                    "reason" : reason}
+        return report
+
+    def close(self):
+        if self._conn is not None and self.pid == os.getpid():
+            self._conn.close()
+        self._conn = None
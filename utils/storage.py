@@ -0,0 +1,338 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from os import path
+
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+
+import pandas as pd
+
+from utils import COMPANYDIR, STOREDIR
+
+
+class CSVStore:
+    """Store each (symbol, dataset) as a single .csv file (default layout).
+
+        Appended rows go to a small journal next to the file
+        (e.g. AAPL_summary.csv.journal) and are merged into it by compact(), so
+        the main file is only ever replaced, never modified in place. This keeps
+        hard-linked backups valid. Crawl processes may share a file, so
+        appending, compacting and writing hold a lock on its directory."""
+    name = "csv"
+
+    def locate(self, inpath):
+        return inpath
+
+    def journal(self, inpath):
+        return f"{inpath}.journal"
+
+    def exists(self, inpath):
+        return path.exists(inpath) or path.exists(self.journal(inpath))
+
+    def signature(self, inpath):
+        return filesig(inpath), filesig(self.journal(inpath))
+
+    def read(self, inpath, sep=",", index_col=0, columns=None):
+        """Read inpath with its journal, only the index and columns if given."""
+        df = (read_csv(inpath, sep, index_col, columns)
+              if path.exists(inpath) else None)
+        if path.exists(journal := self.journal(inpath)):
+            df = upsert(df, read_csv(journal, sep, index_col, columns),
+                        index_col is not None)
+        return df
+
+    def write(self, df, outpath, index=True):
+        mkdir_for(outpath)
+        with locked(path.dirname(outpath)):
+            replace_csv(df, outpath, index=index)
+            if path.exists(journal := self.journal(outpath)):
+                os.remove(journal)
+
+    def append(self, df, outpath, index=True):
+        """Append rows to the journal of outpath without rewriting history."""
+        mkdir_for(journal := self.journal(outpath))
+        with locked(path.dirname(journal)):
+            if path.exists(journal):
+                header = pd.read_csv(journal, nrows=0, index_col=0 if index else None)
+                if list(header.columns) != list(df.columns):
+                    self.compact(outpath) # journal needs a single header
+            df.to_csv(journal, mode="a", header=not path.exists(journal), index=index)
+
+    def pending(self, inpath):
+        """Return the number of journaled rows not yet compacted."""
+        if not path.exists(journal := self.journal(inpath)):
+            return 0
+        with open(journal, "r") as r_obj:
+            return max(sum(1 for _ in r_obj) - 1, 0)
+
+    def compact(self, inpath, backpath=None):
+        """Merge the journal into inpath, snapshotting the old file to backpath."""
+        if not path.exists(self.journal(inpath)):
+            return
+        with locked(path.dirname(inpath)): # no row appended meanwhile is lost
+            df = self.read(inpath)
+            if backpath and path.exists(inpath):
+                snapshot(inpath, backpath)
+            self.write(df, inpath)
+
+    def backup(self, from_, to_):
+        if path.exists(from_):
+            snapshot(from_, to_)
+        if path.exists(journal := self.journal(from_)):
+            mkdir_for(to_)
+            shutil.copyfile(journal, self.journal(to_))
+
+    def move(self, from_, to_):
+        for frompath, topath in [(from_, to_),
+                                 (self.journal(from_), self.journal(to_))]:
+            if path.exists(frompath):
+                mkdir_for(topath)
+                os.replace(frompath, topath)
+
+
+class ParquetStore:
+    """Columnar store keyed by (symbol, dataset).
+
+        A dataset is a directory of parquet parts under STOREDIR, e.g.
+        data/store/AAPL/AAPL_summary/part-00000.parquet. Appending writes a
+        new part and never rewrites history; reading concatenates parts in
+        order, keeping the newest row per index. Parts are immutable, so
+        backups are hard links. Paths are given as the .csv path returned by
+        tools.get_path, so callers do not need to know which backend is active.
+        A .csv written there after the parts (e.g. a download moved by the
+        crawler) replaces them on the next read or append. Writing, appending
+        and compacting hold a lock on the directory of the symbol."""
+    name = "parquet"
+
+    def __init__(self, root=STOREDIR):
+        self.root = root
+
+    def locate(self, inpath):
+        relpath = path.relpath(path.splitext(inpath)[0], COMPANYDIR)
+        if relpath.startswith(".."): # outside of COMPANYDIR (e.g. profile)
+            return inpath
+        return path.join(self.root, relpath)
+
+    def parts(self, inpath):
+        if not path.isdir(dir_ := self.locate(inpath)):
+            return []
+        return sorted(path.join(dir_, f) for f in os.listdir(dir_)
+                      if f.endswith(".parquet"))
+
+    def exists(self, inpath):
+        return bool(self.parts(inpath)) or path.exists(inpath)
+
+    def signature(self, inpath):
+        return tuple(filesig(p) for p in self.parts(inpath) + [inpath])
+
+    def import_csv(self, inpath, sep=","):
+        """Replace the parts of inpath with its .csv if that is newer than them."""
+        if ((parts := self.parts(inpath)) and path.exists(inpath)
+                and filesig(inpath)[0] > max(filesig(part)[0] for part in parts)):
+            self.write(read_csv(inpath, sep), inpath)
+
+    def read(self, inpath, sep=",", index_col=0, columns=None):
+        """Read the parts of inpath, only the index and columns if given."""
+        self.import_csv(inpath, sep)
+        if not (parts := self.parts(inpath)):
+            # not migrated yet, fall back to .csv
+            return read_csv(inpath, sep, index_col, columns)
+        df = read_parquet(parts[0], columns)
+        for part in parts[1:]:
+            df = upsert(df, read_parquet(part, columns), df.index.name is not None)
+        if index_col is None and df.index.name is not None:
+            df = df.reset_index()
+        return df
+
+    def write(self, df, outpath, index=True):
+        if (dir_ := self.locate(outpath)) == outpath:
+            return CSVStore().write(df, outpath, index=index)
+        os.makedirs(path.dirname(dir_), exist_ok=True)
+        with locked(path.dirname(dir_)):
+            if path.isdir(dir_):
+                shutil.rmtree(dir_)
+            self.append(df, outpath, index=index)
+
+    def append(self, df, outpath, index=True):
+        if (dir_ := self.locate(outpath)) == outpath:
+            return CSVStore().append(df, outpath, index=index)
+        os.makedirs(path.dirname(dir_), exist_ok=True)
+        with locked(path.dirname(dir_)):
+            self.import_csv(outpath)
+            os.makedirs(dir_, exist_ok=True)
+            n = len(self.parts(outpath))
+            typed_df(df).to_parquet(path.join(dir_, f"part-{n:05d}.parquet"),
+                                    index=index)
+
+    def pending(self, inpath):
+        """Return the number of appended parts not yet compacted."""
+        return max(len(self.parts(inpath)) - 1, 0)
+
+    def compact(self, inpath, backpath=None):
+        """Merge all parts of inpath into one, snapshotting the old parts to backpath."""
+        if not self.pending(inpath):
+            return
+        with locked(path.dirname(self.locate(inpath))):
+            df = self.read(inpath)
+            if backpath:
+                self.backup(inpath, backpath)
+            self.write(df, inpath)
+
+    def backup(self, from_, to_):
+        if (dir_ := self.locate(from_)) == from_:
+            return CSVStore().backup(from_, to_)
+        if path.isdir(dir_):
+            if path.isdir(todir := self.locate(to_)):
+                shutil.rmtree(todir)
+            for part in self.parts(from_):
+                snapshot(part, path.join(todir, path.basename(part)))
+
+    def move(self, from_, to_):
+        if (dir_ := self.locate(from_)) == from_:
+            return CSVStore().move(from_, to_)
+        if path.isdir(dir_):
+            if path.isdir(todir := self.locate(to_)):
+                shutil.rmtree(todir)
+            os.makedirs(path.dirname(todir), exist_ok=True)
+            os.replace(dir_, todir)
+
+
+stores = {"csv" : CSVStore, "parquet" : ParquetStore}
+
+
+def get_store(name="csv"):
+    if name not in stores:
+        raise Exception(f"ERROR get_store(): unknown store '{name}', "
+                        f"choose from {list(stores)}")
+    return stores[name]()
+
+
+def mkdir_for(outpath):
+    if (dir_ := path.dirname(outpath)) and not path.exists(dir_):
+        os.makedirs(dir_, exist_ok=True)
+
+
+# directories locked by the current thread
+held = threading.local()
+
+
+@contextmanager
+def locked(dir_):
+    """Hold an exclusive lock on dir_ across processes and threads.
+
+        Reentrant within a thread (e.g. compact() called by append()), and a
+        no-op without fcntl."""
+    dirs = held.__dict__.setdefault("dirs", set())
+    if fcntl is None or (dir_ := path.abspath(dir_ or ".")) in dirs:
+        yield
+        return
+    fd = os.open(dir_, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        dirs.add(dir_)
+        yield
+    finally:
+        dirs.discard(dir_)
+        os.close(fd) # releases the lock
+
+
+def filesig(inpath):
+    """Return (mtime, size) of inpath or None if it does not exist."""
+    try:
+        stat = os.stat(inpath)
+    except FileNotFoundError:
+        return
+    return stat.st_mtime_ns, stat.st_size
+
+
+def replace_csv(df, outpath, index=True):
+    """Write df to outpath through a temporary file, so that hard links to the
+        old file (backups) keep their content."""
+    df.to_csv(tmppath := f"{outpath}.tmp", index=index)
+    os.replace(tmppath, outpath)
+
+
+def snapshot(from_, to_):
+    """Hard-link from_ to to_, falling back to a copy across file systems."""
+    mkdir_for(to_)
+    if path.exists(to_):
+        os.remove(to_)
+    try:
+        os.link(from_, to_)
+    except OSError:
+        shutil.copyfile(from_, to_)
+
+
+def read_csv(inpath, sep=",", index_col=0, columns=None):
+    """Read inpath, parsing only the index column and columns (all if None)."""
+    usecols = None
+    if columns is not None:
+        header, wanted = pd.read_csv(inpath, sep=sep, nrows=0).columns, set(columns)
+        usecols = [col for i, col in enumerate(header)
+                   if col in wanted or i == index_col]
+    return pd.read_csv(inpath, sep=sep, index_col=index_col, usecols=usecols)
+
+
+def read_parquet(part, columns=None):
+    """Read part, only the index and those of columns it has if given."""
+    if columns is not None:
+        import pyarrow.parquet as pq # engine of to_parquet
+        names = set(pq.read_schema(part).names)
+        columns = [col for col in columns if col in names]
+    return pd.read_parquet(part, columns=columns)
+
+
+def upsert(df, newdf, indexed=True):
+    """Concatenate newdf to df keeping the newest row per index, latest first."""
+    df = pd.concat([newdf] if df is None else [df, newdf], axis=0,
+                   ignore_index=not indexed)
+    if not indexed:
+        return df
+    df = df[~df.index.duplicated(keep="last")]
+    return df.sort_index(ascending=False)
+
+
+def typed_df(df):
+    """Coerce columns to the types in col2dtype so that they are stored typed.
+
+        Columns without a declared type keep numeric dtypes as they are, and
+        mixed object columns are stored as strings."""
+    from utils.tools import col2dtype
+
+    df = df.copy()
+    for col in df.columns:
+        dtype = col2dtype.get(col)
+        if dtype == "datetime":
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        elif dtype == "bool": # nullable, astype("bool") makes NaN True
+            df[col] = df[col].replace({"True" : True, "False" : False}).astype("boolean")
+        elif dtype == "float":
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+        elif df[col].dtype == "object":
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+
+def migrate(store, symbols=None):
+    """Copy the existing .csv tree under COMPANYDIR into store (one-shot).
+
+        Only the current files are migrated; backup/debug/original copies stay
+        as they are. Return the number of migrated files."""
+    n = 0
+    symbols = symbols if symbols is not None else sorted(os.listdir(COMPANYDIR))
+    for symbol in symbols:
+        if not path.isdir(dir_ := path.join(COMPANYDIR, symbol)):
+            continue
+        for filename in sorted(os.listdir(dir_)):
+            if not filename.endswith(".csv"):
+                continue
+            inpath = path.join(dir_, filename)
+            df = CSVStore().read(inpath)
+            store.write(df, inpath)
+            n += 1
+    return n
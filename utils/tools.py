@@ -1,6 +1,7 @@
-import csv
+import re
 import sys
 import json
+import warnings
 from datetime import datetime, timedelta
 from functools import lru_cache
 from os import path, rename, system
@@ -8,7 +9,9 @@ from os import path, rename, system
 import numpy as np
 import pandas as pd
 
-from utils import PROFILEPATH, COMPANYDIR, LOGPATH, RESULTPATH, MAPPINGPATH
+from utils import PROFILEPATH, COMPANYDIR, RESULTPATH, MAPPINGPATH
+from utils import logger, reader, storage
+from utils.cache import FileCache
 
 
 def get_mapping():
@@ -19,6 +22,20 @@ mapping = get_mapping()
 col2filename = mapping["col2filename"]
 col2dtype = mapping["col2dtype"]
 
+# storage backend used by get_df, path2df and backup_and_save_df
+store = storage.get_store("csv")
+# dataframes read by path2df, invalidated when their file changes
+cache = FileCache()
+# {path : signature} of files as preprocessing left them, see Manifest.update
+written = {}
+
+
+def set_store(name):
+    """Select storage backend ('csv' or 'parquet')."""
+    global store
+    store = storage.get_store(name)
+    cache.clear()
+
 
 def cp(from_, to_):
     if path.exists(from_):
@@ -52,13 +69,13 @@ def to_csv(df, outpath, index=True):
         n = len(splitted := outpath.split("/"))
         if n > 1 and not path.exists(outdir := path.join(*splitted[:n - 1])):
             mkdir(outdir)
-        df.to_csv(outpath, index=index)
+        storage.replace_csv(df, outpath, index=index) # keeps hard-linked backups
 
 
-def log(msg, debug=False, verbose=True):
+def log(msg, debug=False, verbose=True, **fields):
+    """Log msg (with symbol, stage or duration fields) through utils.logger."""
     if not debug:
-        with open(LOGPATH, "a") as w_obj:
-            w_obj.write(f"{msg.strip()}\n")
+        logger.log(msg, **fields)
 
     if verbose:
         print(msg)
@@ -131,10 +148,9 @@ def name_append(*args, sep="_", filetype=None):
     return ".".join([tmp, filetype]) if filetype else tmp
 
 
-@lru_cache()
 def get_df(col, symbol=None, yearly=False, sep=",",
            index_col=0, convert_index_to_datetime=True, debug=False):
-    if path.exists(inpath := get_path(col, symbol, yearly, debug=debug)):
+    if store.exists(inpath := get_path(col, symbol, yearly, debug=debug)):
         return path2df(inpath, sep, index_col, convert_index_to_datetime)
 
 
@@ -147,27 +163,97 @@ def to_date(x):
         return res
 
 
-@lru_cache()
+# formats of dates in crawled files, tried in order
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%b %d, %Y", "%B %d, %Y", "%Y-%m-%d %H:%M:%S",
+                "%d-%b-%Y", "%Y%m%d"]
+# format of each shape of date (digits as 0, letters as a), None if unknown
+date_formats = {}
+
+
+def date_shape(x):
+    return re.sub("[A-Za-z]", "a", re.sub("[0-9]", "0", x))
+
+
+def date_format(x):
+    """Return the format of date string x, cached by its shape."""
+    if (shape := date_shape(x)) not in date_formats:
+        for fmt in DATE_FORMATS:
+            try:
+                datetime.strptime(x, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            fmt = None
+        date_formats[shape] = fmt
+    return date_formats[shape]
+
+
+def parse_dates(values, fmt):
+    """Parse values with fmt, or with a format inferred by pandas if None."""
+    if fmt is not None:
+        return pd.to_datetime(values, format=fmt, errors="coerce")
+    if not values.str.contains(r"\d", na=False).any(): # e.g. 'ttm', not a date
+        return pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    with warnings.catch_warnings(): # parsed per element if no format is inferred
+        warnings.simplefilter("ignore", UserWarning)
+        return pd.to_datetime(values, errors="coerce")
+
+
+def to_dates(values):
+    """Parse values (e.g. an index) as a DatetimeIndex, NaT where not a date.
+
+        Strings are parsed in one vectorized call per distinct format: all
+        values with the format of the first one, then whatever failed
+        grouped by shape. Shapes of none of DATE_FORMATS (e.g.
+        '2021-03-31T00:00:00') are parsed in one call each with a format
+        inferred by pandas, and strings without digits (e.g. 'ttm') are NaT.
+        Other values are left to pd.to_datetime."""
+    if isinstance(values, pd.DatetimeIndex):
+        return values
+    values = pd.Index(values)
+    if pd.api.types.infer_dtype(values, skipna=True) != "string":
+        return pd.DatetimeIndex(pd.to_datetime(values, errors="coerce"))
+
+    strings = pd.Series(values.to_numpy(dtype="object"))
+    notnull = strings.notna().to_numpy()
+    if not notnull.any():
+        return pd.DatetimeIndex([pd.NaT] * len(values))
+    dates = pd.Series(parse_dates(strings, date_format(strings[notnull].iloc[0])))
+    # values in other formats (e.g. 'ttm' or a mixed index) by shape
+    if (failed := dates.isna().to_numpy() & notnull).any():
+        rest = strings[failed]
+        for shape, group in rest.groupby(rest.map(date_shape)):
+            dates[group.index] = parse_dates(group, date_format(group.iloc[0]))
+    return pd.DatetimeIndex(dates)
+
+
 def path2df(inpath, sep=",", index_col=0, convert_index_to_datetime=True):
-    if path.exists(inpath):
-        df = pd.read_csv(inpath, sep=sep, index_col=index_col)
+    """Read inpath from the store, from cache if unchanged (see FileCache)."""
+    def load():
+        df = store.read(inpath, sep=sep, index_col=index_col)
         if convert_index_to_datetime:
-            df.index = df.index.map(to_date)
+            df.index = pd.Index(to_dates(df.index).date, name=df.index.name)
         return df
 
+    if store.exists(inpath):
+        return cache.get((inpath, sep, index_col, convert_index_to_datetime),
+                         store.signature(inpath), load)
+
 
 def backup_and_save_df(col, symbol, df, init, debug, index=True):
     outpath = get_path(col, symbol, debug=debug)
-    if not debug and path.exists(outpath):
+    if not debug and store.exists(outpath):
         if init:
             originalpath = get_path(col, symbol, original=True)
-            cp(outpath, originalpath) # store the original file if init
+            store.backup(outpath, originalpath) # store the original file if init
         backpath = get_path(col, symbol, backup=True)
-        mv(outpath, backpath)
-    to_csv(df, outpath, index=index)
+        store.move(outpath, backpath)
+    if df is not None:
+        store.write(df, outpath, index=index)
+    written[outpath] = store.signature(outpath)
 
 
-@lru_cache()
 def get_data(col,
              symbol=None,
              yearly=False,
@@ -175,47 +261,32 @@ def get_data(col,
              i_start=None,
              i_end=None,
              sep=","):
-    def reader2next(r):
-        try:
-            return next(r)
-        except StopIteration:
-            return
+    """Return the i-th value (or values in [i_start, i_end)) of col.
 
-    profile = True if not symbol else False
-
-    if not path.exists(inpath := get_path(col, symbol, yearly)):
+        Rows are read through a byte-offset index of the file that is rebuilt
+        when the file changes, and the slice is converted in one pass."""
+    if not store.exists(inpath := get_path(col, symbol, yearly)):
         return
 
-    skip_ttm = (True if col2filename[col] in ["cash_flow", "income_statement"]
-                else False)
-
     if i is not None:
         i_start = i
         i_end = i + 1
 
-    with open(inpath, "r") as r_obj:
-        reader = csv.DictReader(r_obj, delimiter=sep)
-
-        #if skip_ttm and reader2next(reader) is None:
-        #    return
-
-        ri = 0
-        dates, res = [], []
-        data = reader2next(reader)
-        while ri < i_end and data:
-            if ri >= i_start:
-                if not profile:
-                    dates.append(data["Date"])
-                if col2dtype[col] == "datetime":
-                    res.append(pd.to_datetime(data[col], errors="coerce"))
-                elif col2dtype[col] == "float":
-                    res.append(pd.to_numeric(data[col], errors="coerce"))
-                elif col2dtype[col] == "bool":
-                    res.append(bool(data[col]))
-                else:
-                    res.append(data[col])
-
-            ri += 1
-            data = reader2next(reader)
-
-    return res[-1] if i is not None else res
+    if store.name != "csv" or store.pending(inpath):
+        df = path2df(inpath, sep, index_col=None, convert_index_to_datetime=False)
+        values = df[col].iloc[i_start:i_end]
+    else:
+        values = reader.get_index(inpath, sep).column(col, i_start, i_end)
+
+    values = pd.Series(values, dtype="object")
+    if col2dtype.get(col) == "datetime":
+        values = pd.Series(to_dates(values))
+    elif col2dtype.get(col) == "float":
+        values = pd.to_numeric(values, errors="coerce")
+    elif col2dtype.get(col) == "bool":
+        values = values.astype("bool")
+    res = list(values)
+
+    if i is not None:
+        return res[-1] if res else None
+    return res